@@ -1,27 +1,23 @@
 import os
-import json
+import sys
 import numpy as np
+import results_store
 
-def load_metrics_from_files():
-    metrics = {
-        'answer_relevancy': [],
-        'answer_correctness': [], 
-        'semantic_similarity': []
-    }
-    
-    for file in os.listdir('QnA'):
-        if not file.startswith('file_eval') or not file.endswith('.json'):
-            continue
-            
-        with open(f'QnA/{file}', 'r') as f:
-            data = json.loads(f.read())
-            for entry in data:
-                for metric in metrics.keys():
-                    value = entry.get(metric)
-                    if value and not np.isnan(value):
-                        metrics[metric].append(value)
-                        
-    return metrics
+# Bootstrap confidence intervals and paired run comparisons (`ci` and `compare` modes).
+BOOTSTRAP_RESAMPLES = int(os.getenv("BOOTSTRAP_RESAMPLES", 2000))
+BOOTSTRAP_CONFIDENCE = float(os.getenv("BOOTSTRAP_CONFIDENCE", 0.95))
+BOOTSTRAP_SEED = int(os.getenv("BOOTSTRAP_SEED", 0))
+# Resamples are drawn in blocks of about this many values, so memory stays bounded for any bank size.
+BOOTSTRAP_BLOCK_VALUES = 1 << 22
+# calculate_statistics' "Top N%" figures are the (100 - N)th percentiles.
+STATISTIC_PERCENTILES = {'p90': 10, 'p95': 5, 'p99': 1}
+
+def load_metrics_from_files(run_ids=None):
+    """
+    Evaluation metrics from the results store: the latest score of every row, or
+    those of `run_ids`. file_eval_* files with no rows in the store are imported first.
+    """
+    return results_store.load_metrics('evaluation', run_ids)
 
 def calculate_statistics(metrics):
     stats = {}
@@ -39,6 +35,201 @@ def calculate_statistics(metrics):
     return stats
 
 
+def _resample_blocks(n, resamples, rng):
+    """Index matrices of bootstrap resamples, one row per resample, `resamples` rows in all."""
+    rows = max(1, BOOTSTRAP_BLOCK_VALUES // max(n, 1))
+    for start in range(0, resamples, rows):
+        yield rng.integers(0, n, size=(min(rows, resamples - start), n), dtype=np.int32)
+
+
+def _order_positions(n):
+    """(lower index, upper index, weight) of each STATISTIC_PERCENTILES percentile, as np.percentile interpolates."""
+    position = np.array([q / 100 * (n - 1) for q in STATISTIC_PERCENTILES.values()])
+    lower = np.floor(position).astype(np.int64)
+    return lower, np.minimum(lower + 1, n - 1), position - lower
+
+
+def bootstrap_statistics(values, resamples=BOOTSTRAP_RESAMPLES, rng=None):
+    """
+    The statistics of calculate_statistics (avg and the p90/p95/p99 lower tails)
+    over `resamples` bootstrap resamples, each block of resamples computed as one
+    array operation.
+
+    `values` is one array of scores, or several (rows of a 2-D array) over the
+    same questions, which then share resamples. The values are sorted once, so
+    sorting each resample's indices puts its order statistics at fixed
+    positions: no per-resample percentile calls.
+
+    Returns:
+        dict: Statistic name -> array with one value per resample (one row per
+            column of `values` when it is 2-D)
+    """
+    rng = rng if rng is not None else np.random.default_rng(BOOTSTRAP_SEED)
+    values = np.asarray(values, dtype=np.float64)
+    columns = np.sort(np.atleast_2d(values), axis=1)
+    n = columns.shape[1]
+    lower, upper, weight = _order_positions(n)
+    means = []
+    tails = []
+    for idx in _resample_blocks(n, resamples, rng):
+        idx.sort(axis=1)
+        means.append([column.take(idx).mean(axis=1) for column in columns])
+        low, high = columns[:, idx[:, lower]], columns[:, idx[:, upper]]
+        tails.append(low + (high - low) * weight)
+    means = np.concatenate(means, axis=1)
+    tails = np.concatenate(tails, axis=1)
+    stats = {'avg': means}
+    for i, name in enumerate(STATISTIC_PERCENTILES):
+        stats[name] = tails[:, :, i]
+    if values.ndim == 1:
+        stats = {name: column[0] for name, column in stats.items()}
+    return stats
+
+
+def _interval(samples, confidence):
+    alpha = (1 - confidence) / 2
+    low, high = np.percentile(samples, [100 * alpha, 100 * (1 - alpha)])
+    return low, high
+
+
+def calculate_confidence_intervals(metrics, resamples=BOOTSTRAP_RESAMPLES, confidence=BOOTSTRAP_CONFIDENCE,
+                                   seed=BOOTSTRAP_SEED):
+    """
+    Percentile bootstrap confidence intervals for every statistic of calculate_statistics.
+
+    Args:
+        metrics (dict): Metric name -> list of values, as load_metrics_from_files returns
+        resamples (int): Bootstrap resamples per metric
+        confidence (float): Confidence level of the intervals
+        seed (int): Seed of the resampling
+
+    Returns:
+        dict: metric -> statistic -> (estimate, low, high)
+    """
+    rng = np.random.default_rng(seed)
+    point = calculate_statistics(metrics)
+    # Metrics with as many scores (usually all of them) are resampled together.
+    by_length = {}
+    for metric in point:
+        by_length.setdefault(len(metrics[metric]), []).append(metric)
+    intervals = {}
+    for group in by_length.values():
+        boot = bootstrap_statistics([metrics[metric] for metric in group], resamples, rng)
+        for i, metric in enumerate(group):
+            intervals[metric] = {
+                name: (value, *_interval(boot[name][i], confidence)) for name, value in point[metric].items()
+            }
+    return intervals
+
+
+def paired_values(metric, run_a, run_b, stage='evaluation'):
+    """Scores of `metric` in two runs for the questions both runs scored, aligned question by question."""
+    store = results_store.get_store()
+    hashes_a, values_a = store.by_question(stage, metric, run_a)
+    hashes_b, values_b = store.by_question(stage, metric, run_b)
+    _, index_a, index_b = np.intersect1d(hashes_a.astype(str), hashes_b.astype(str), assume_unique=True,
+                                         return_indices=True)
+    return values_a[index_a], values_b[index_b]
+
+
+def paired_tests(a, b, resamples=BOOTSTRAP_RESAMPLES, confidence=BOOTSTRAP_CONFIDENCE, rng=None):
+    """
+    Paired comparison of two runs' per-question scores: the mean difference
+    (b - a) with a paired bootstrap confidence interval, and a two-sided
+    sign-flip permutation test of it. The permutation test flips the sign of
+    each question's difference at random, which is exact under the null that
+    the two runs are interchangeable; the resamples of a block are one
+    matrix-vector product.
+
+    Returns:
+        dict: n, mean_a, mean_b, diff, low, high, p_value, wins, losses, ties
+    """
+    rng = rng if rng is not None else np.random.default_rng(BOOTSTRAP_SEED)
+    diff = np.asarray(b, dtype=np.float64) - np.asarray(a, dtype=np.float64)
+    n = len(diff)
+    if n == 0:
+        return {'n': 0}
+    observed = diff.mean()
+
+    boot = np.concatenate([diff.take(idx).mean(axis=1) for idx in _resample_blocks(n, resamples, rng)])
+    low, high = _interval(boot, confidence)
+
+    extreme = 0
+    total = diff.sum()
+    rows = max(1, BOOTSTRAP_BLOCK_VALUES // n)
+    for start in range(0, resamples, rows):
+        # One random bit per question: with signs s = 2 * bit - 1, sum(s * diff) = 2 * (bits @ diff) - sum(diff).
+        random_bytes = rng.integers(0, 256, size=(min(rows, resamples - start), (n + 7) // 8), dtype=np.uint8)
+        bits = np.unpackbits(random_bytes, axis=1, count=n).astype(np.float64)
+        permuted = (2 * (bits @ diff) - total) / n
+        # Tolerance so rounding does not hide ties with the observed difference.
+        extreme += int(np.count_nonzero(np.abs(permuted) >= abs(observed) * (1 - 1e-9)))
+    return {
+        'n': n,
+        'mean_a': float(np.mean(a)),
+        'mean_b': float(np.mean(b)),
+        'diff': float(observed),
+        'low': float(low),
+        'high': float(high),
+        'p_value': (extreme + 1) / (resamples + 1),
+        'wins': int(np.count_nonzero(diff > 0)),
+        'losses': int(np.count_nonzero(diff < 0)),
+        'ties': int(np.count_nonzero(diff == 0)),
+    }
+
+
+def compare_runs(run_a, run_b, metrics=None, resamples=BOOTSTRAP_RESAMPLES, confidence=BOOTSTRAP_CONFIDENCE,
+                 seed=BOOTSTRAP_SEED):
+    """
+    Compare two evaluation runs question by question.
+
+    Args:
+        run_a (str): Baseline run id
+        run_b (str): Run compared against it
+        metrics (list): Metrics to compare, all evaluation metrics if None
+
+    Returns:
+        dict: metric -> paired_tests result
+    """
+    rng = np.random.default_rng(seed)
+    return {
+        metric: paired_tests(*paired_values(metric, run_a, run_b), resamples, confidence, rng)
+        for metric in metrics or results_store.STAGES['evaluation']['metrics']
+    }
+
+
+def print_comparison(run_a, run_b, comparison, confidence=BOOTSTRAP_CONFIDENCE):
+    print(f"\n{run_b} vs {run_a} (paired by question, {confidence:.0%} CI of the mean difference):")
+    for metric, result in comparison.items():
+        if not result['n']:
+            print(f"\n{metric}: no questions scored in both runs")
+            continue
+        print(f"\n{metric} over {result['n']} questions:")
+        print(f"Mean: {result['mean_a']:.3f} -> {result['mean_b']:.3f}")
+        print(f"Difference: {result['diff']:+.3f} [{result['low']:+.3f}, {result['high']:+.3f}]")
+        print(f"Permutation test p-value: {result['p_value']:.4f}")
+        print(f"Better / worse / unchanged: {result['wins']} / {result['losses']} / {result['ties']}")
+
+
+def load_latencies(run_ids=None, metric='time_to_answer'):
+    """Agent latency (seconds) of every answered question recorded by chats.py: time to answer, or time to first token."""
+    return results_store.load_metrics('chat', run_ids, [metric])[metric]
+
+
+def calculate_latency_statistics(latencies):
+    # Lower is better here, so these are the usual upper percentiles.
+    if not latencies:
+        return {}
+    latencies = np.array(latencies)
+    return {
+        'p50': np.percentile(latencies, 50),
+        'p90': np.percentile(latencies, 90),
+        'p99': np.percentile(latencies, 99),
+        'avg': np.mean(latencies),
+        'count': len(latencies)
+    }
+
+
 def plot_metric_histograms(metrics):
     import matplotlib.pyplot as plt
     import seaborn as sns
@@ -160,16 +351,57 @@ def plot_metric_correlations(metrics):
     plt.close()
 
 
-if __name__ == "__main__":
-    metrics = load_metrics_from_files()
-    stats = calculate_statistics(metrics)
+def report(run_ids=None, intervals_only=False):
+    """
+    Print the evaluation metrics with bootstrap confidence intervals and, unless
+    `intervals_only`, the agent latency statistics and the metric correlation plot.
+    """
+    metrics = load_metrics_from_files(run_ids)
+    intervals = calculate_confidence_intervals(metrics)
     
-    print("\nPercentile Analysis (in decreasing order - higher values are better):")
-    for metric, values in stats.items():
+    print("\nPercentile Analysis (in decreasing order - higher values are better), "
+          f"with {BOOTSTRAP_CONFIDENCE:.0%} bootstrap confidence intervals:")
+    for metric, values in intervals.items():
         print(f"\n{metric}:")
-        print(f"Top 90% (P90): {values['p90']:.3f}")
-        print(f"Top 95% (P95): {values['p95']:.3f}")
-        print(f"Top 99% (P99): {values['p99']:.3f}")
-        print(f"Average: {values['avg']:.3f}")
+        for label, name in (("Top 90% (P90)", 'p90'), ("Top 95% (P95)", 'p95'), ("Top 99% (P99)", 'p99'),
+                            ("Average", 'avg')):
+            value, low, high = values[name]
+            print(f"{label}: {value:.3f} [{low:.3f}, {high:.3f}]")
+    if intervals_only:
+        return
+
+    latency = calculate_latency_statistics(load_latencies())
+    if latency:
+        print(f"\nAgent latency over {latency['count']} answers (seconds, lower is better):")
+        print(f"P50: {latency['p50']:.2f}")
+        print(f"P90: {latency['p90']:.2f}")
+        print(f"P99: {latency['p99']:.2f}")
+        print(f"Average: {latency['avg']:.2f}")
+    first_token = calculate_latency_statistics(load_latencies(metric='time_to_first_token'))
+    if first_token:
+        print(f"\nTime to first token over {first_token['count']} streamed answers (seconds, lower is better):")
+        print(f"P50: {first_token['p50']:.2f}")
+        print(f"P90: {first_token['p90']:.2f}")
+        print(f"P99: {first_token['p99']:.2f}")
+        print(f"Average: {first_token['avg']:.2f}")
     #plot_metric_histograms(metrics)
-    plot_metric_correlations(metrics)
\ No newline at end of file
+    plot_metric_correlations(metrics)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == 'breakdown':
+        # python analysis.py breakdown [run_id|document|file] [RUN_ID ...]
+        results_store.print_breakdown('evaluation', sys.argv[2] if len(sys.argv) > 2 else 'run_id', sys.argv[3:])
+        sys.exit(0)
+    if len(sys.argv) > 1 and sys.argv[1] == 'compare':
+        # python analysis.py compare RUN_A RUN_B
+        if len(sys.argv) != 4:
+            print("Usage: python analysis.py compare RUN_A RUN_B\n\nEvaluation runs:")
+            for run in results_store.get_store().runs('evaluation'):
+                print(f"  {run['run_id']}")
+            sys.exit(1)
+        print_comparison(sys.argv[2], sys.argv[3], compare_runs(sys.argv[2], sys.argv[3]))
+        sys.exit(0)
+    # python analysis.py ci [RUN_ID ...] reports only the confidence intervals.
+    ci_only = len(sys.argv) > 1 and sys.argv[1] == 'ci'
+    report(sys.argv[2:] if ci_only else None, intervals_only=ci_only)
@@ -0,0 +1,176 @@
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+from dotenv import load_dotenv
+import odin_client
+import chats
+import chunk_store
+import odin_simulator
+
+load_dotenv()
+
+"""
+End-to-end benchmarks of the harness against the local Odin simulator.
+
+Each scenario starts a fresh simulator (odin_simulator.py) on a free port, points
+odin_client at it and runs the harness code unchanged, so the numbers measure
+the harness itself: how fast it gets questions through at a given concurrency,
+how much latency it adds on top of the server's, and how it copes with faults.
+
+chat       Answer BENCH_QUESTIONS questions with chats.answer_questions at every
+           concurrency in BENCH_CONCURRENCY, once streaming and once polling
+faults     The same at the highest concurrency with BENCH_ERROR_RATE server errors
+           and a BENCH_RATE_LIMIT requests/s limit
+export     Export every document's chunks with chunk_store.export_chunks
+
+Per run: throughput (questions/s), P50/P90 time to answer and time to first
+token, harness overhead (mean time to answer minus the simulator's mean answer
+latency), polls per question, HTTP requests served and outcome counts. Results
+are printed and written to Benchmark/benchmark_<time>.json.
+
+`python benchmark.py [SCENARIO ...]` runs the given scenarios (default: all).
+
+Config (environment):
+BENCH_QUESTIONS         Questions per chat run                          (default 200)
+BENCH_CONCURRENCY       Comma-separated chat concurrencies              (default 1,8,32)
+BENCH_ANSWER_LATENCY    Simulated answer latency                        (default lognormal:0.2,0.5)
+BENCH_ERROR_RATE        Server error rate in the faults scenario        (default 0.05)
+BENCH_RATE_LIMIT        Requests/s limit in the faults scenario         (default 50)
+"""
+
+BENCH_QUESTIONS = int(os.getenv("BENCH_QUESTIONS", 200))
+BENCH_CONCURRENCY = [int(c) for c in os.getenv("BENCH_CONCURRENCY", "1,8,32").split(',')]
+BENCH_ANSWER_LATENCY = os.getenv("BENCH_ANSWER_LATENCY", "lognormal:0.2,0.5")
+BENCH_ERROR_RATE = float(os.getenv("BENCH_ERROR_RATE", 0.05))
+BENCH_RATE_LIMIT = float(os.getenv("BENCH_RATE_LIMIT", 50))
+PROJECT_ID = 'benchmark'
+OUTPUT_DIR = 'Benchmark'
+
+
+def run_simulated(corpus, run, **config):
+    """Run `run(simulator)` against a fresh simulator built with `config`, restoring odin_client afterwards."""
+    config.setdefault('answer_latency', BENCH_ANSWER_LATENCY)
+    config.setdefault('first_token_latency', 'const:0')
+    simulator = odin_simulator.Simulator(corpus, **config)
+    server = odin_simulator.start(simulator, port=0)
+    base_url = odin_client.BASE_URL
+    odin_client.configure(base_url=server.url)
+    try:
+        return run(simulator)
+    finally:
+        odin_client.configure(base_url=base_url)
+        server.shutdown()
+        server.server_close()
+
+
+def _percentile(values, q):
+    return float(np.percentile(values, q)) if len(values) else None
+
+
+def bench_chat(corpus, questions, concurrency, stream=True, **config):
+    """Answer `questions` at `concurrency` and summarise throughput, latency and outcomes."""
+    chats.STREAM_ANSWERS = 'auto' if stream else 'false'
+    chats._streaming_supported = True
+
+    def run(simulator):
+        records = [{'question': question} for question in questions]
+
+        async def answer():
+            await chats.answer_questions(records, PROJECT_ID, chats.ChatPool(PROJECT_ID, size=concurrency))
+            await odin_client.aclose()
+
+        start = time.monotonic()
+        asyncio.run(answer())
+        elapsed = time.monotonic() - start
+        timings = [record['timing'] for record in records]
+        answered = [t for t in timings if t['outcome'] == 'answered']
+        time_to_answer = np.array([t['time_to_answer'] for t in answered])
+        first_token = np.array([t['time_to_first_token'] for t in answered if t['time_to_first_token'] is not None])
+        outcomes = {}
+        for t in timings:
+            outcomes[t['outcome']] = outcomes.get(t['outcome'], 0) + 1
+        return {
+            'concurrency': concurrency,
+            'stream': stream,
+            'questions': len(records),
+            'seconds': elapsed,
+            'throughput': len(answered) / elapsed,
+            'p50': _percentile(time_to_answer, 50),
+            'p90': _percentile(time_to_answer, 90),
+            'ttft_p50': _percentile(first_token, 50),
+            'ttft_p90': _percentile(first_token, 90),
+            'overhead': float(time_to_answer.mean() - np.mean(simulator.answer_times)) if len(answered) else None,
+            'polls_per_question': sum(t['polls'] for t in timings) / len(timings),
+            'requests': simulator.counters['requests'],
+            'outcomes': outcomes,
+        }
+
+    return run_simulated(corpus, run, **config)
+
+
+def bench_export(corpus):
+    def run(simulator):
+        with tempfile.TemporaryDirectory() as directory:
+            store = chunk_store.ChunkStore(os.path.join(directory, 'chunks.sqlite'))
+            start = time.monotonic()
+            docs = asyncio.run(chunk_store.export_chunks(PROJECT_ID, store))
+            elapsed = time.monotonic() - start
+            store.close()
+        return {
+            'documents': len(docs),
+            'chunks': sum(len(chunks) for chunks in corpus.documents.values()),
+            'seconds': elapsed,
+            'documents_per_second': len(docs) / elapsed,
+            'requests': simulator.counters['requests'],
+        }
+
+    return run_simulated(corpus, run)
+
+
+def print_chat_results(results):
+    print(f"\n{'conc':>5} {'stream':>6} {'q/s':>7} {'p50':>6} {'p90':>6} {'ttft50':>6} {'overhd':>6} "
+          f"{'polls/q':>7} {'reqs':>6}  outcomes")
+
+    def cell(value, width, spec='.2f'):
+        return f"{value:>{width}{spec}}" if value is not None else f"{'-':>{width}}"
+
+    for r in results:
+        print(f"{r['concurrency']:>5} {str(r['stream']):>6} {cell(r['throughput'], 7)} {cell(r['p50'], 6)} "
+              f"{cell(r['p90'], 6)} {cell(r['ttft_p50'], 6)} {cell(r['overhead'], 6)} "
+              f"{r['polls_per_question']:>7.2f} {r['requests']:>6}  {r['outcomes']}")
+
+
+def main(scenarios):
+    corpus = odin_simulator.Corpus.load()
+    questions = sorted(corpus.answers)[:BENCH_QUESTIONS]
+    print(f"Benchmarking with {len(questions)} questions and {len(corpus.documents)} documents")
+    results = {}
+    if 'chat' in scenarios:
+        results['chat'] = [bench_chat(corpus, questions, concurrency, stream)
+                           for concurrency in BENCH_CONCURRENCY for stream in (True, False)]
+        print_chat_results(results['chat'])
+    if 'faults' in scenarios:
+        results['faults'] = [bench_chat(corpus, questions, max(BENCH_CONCURRENCY), stream,
+                                        error_rate=BENCH_ERROR_RATE, rate_limit=BENCH_RATE_LIMIT)
+                             for stream in (True, False)]
+        print(f"\nWith {BENCH_ERROR_RATE:.0%} server errors and a {BENCH_RATE_LIMIT:g} requests/s limit:")
+        print_chat_results(results['faults'])
+    if 'export' in scenarios:
+        results['export'] = bench_export(corpus)
+        e = results['export']
+        print(f"\nExported {e['documents']} documents ({e['chunks']} chunks) in {e['seconds']:.2f}s, "
+              f"{e['documents_per_second']:.1f} documents/s over {e['requests']} requests")
+
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    path = os.path.join(OUTPUT_DIR, f"benchmark_{time.strftime('%Y%m%dT%H%M%S')}.json")
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=4)
+    print(f"\nResults written to {path}")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:] or ['chat', 'faults', 'export'])
@@ -0,0 +1,192 @@
+import os
+import re
+import sys
+import zlib
+import numpy as np
+import qna_io
+from dedup_questions import DIGIT, NEGATIONS
+
+"""
+Cheap-first metric cascade for evaluation.py.
+
+Cheap signals are computed for the whole dataset at once (hashed term-count
+matrices give lexical F1 as an array operation, embedding similarity comes from
+the local embedding index) and decide a metric for a row when its value is known
+without the judge. Only the remaining rows go to the ragas LLM metrics.
+
+Tier     Rows                                        Decision
+rule     ground truth is "not present in context"    answer_correctness = 0.25 * similarity
+rule     response empty or 'failed'                  answer_relevancy = 0, answer_correctness = 0.25 * similarity
+rule     response is a short, outright refusal       answer_relevancy = 0 (ragas' noncommittal rule)
+lexical  response ~ ground truth (lexical F1 >= CASCADE_EXACT_F1, off by default)
+         with the same numbers and negations         answer_correctness = 0.75 + 0.25 * similarity
+judge    everything else                             ragas LLM metric
+
+answer_correctness is 0.75 * factual F1 + 0.25 * similarity in ragas; the rule
+tiers are the cases where the factual F1 is known to be 0 (or 1). On the
+existing file_eval_*.json the ground-truth-refusal rule reproduces the judge to
+within 1e-4. `python cascade.py calibrate [EXACT_F1]` re-checks every tier against the
+judge scores already on disk and reports the aggregate change per metric; with
+EXACT_F1 it tries the lexical tier at that threshold. The lexical tier stays off
+(CASCADE_EXACT_F1=0) until such a calibration supports a threshold.
+"""
+
+# 0 turns the lexical tier off.
+CASCADE_EXACT_F1 = float(os.getenv("CASCADE_EXACT_F1", 0))
+CASCADE_TOLERANCE = float(os.getenv("CASCADE_TOLERANCE", 0.01))
+# Responses longer than this are never treated as outright refusals.
+REFUSAL_MAX_TOKENS = 30
+HASH_DIM = 1 << 14
+
+REFERENCE_REFUSAL = re.compile(r"not present in (the )?(given )?context", re.I)
+RESPONSE_REFUSAL = re.compile(
+    r"not present in (the )?(given |provided )?context"
+    r"|(i|we) (don't|do not|cannot|can't|couldn't|could not) (know|find|answer)"
+    r"|(no|not enough) (relevant )?information (is )?(available|provided|found)"
+    r"|unable to (find|answer|locate)",
+    re.I
+)
+TOKEN = re.compile(r"\w+")
+
+JUDGED_METRICS = ('answer_relevancy', 'answer_correctness')
+
+
+def tokenize(text):
+    return TOKEN.findall((text or "").lower())
+
+
+def hashed_counts(texts, dim=HASH_DIM):
+    """
+    Sparse term counts of `texts` using the hashing trick: the sorted distinct
+    codes row * dim + term and how often each occurs.
+    """
+    codes = [i * dim + zlib.crc32(token.encode('utf-8')) % dim
+             for i, text in enumerate(texts) for token in tokenize(text)]
+    return np.unique(np.asarray(codes, dtype=np.int64), return_counts=True)
+
+
+def lexical_f1(a, b, n, dim=HASH_DIM):
+    """Token-overlap F1 of each of the `n` rows of two hashed_counts."""
+    (codes_a, counts_a), (codes_b, counts_b) = a, b
+    shared, index_a, index_b = np.intersect1d(codes_a, codes_b, assume_unique=True, return_indices=True)
+    overlap = np.bincount(shared // dim, weights=np.minimum(counts_a[index_a], counts_b[index_b]), minlength=n)
+    len_a = np.bincount(codes_a // dim, weights=counts_a, minlength=n)
+    len_b = np.bincount(codes_b // dim, weights=counts_b, minlength=n)
+    precision = np.divide(overlap, len_a, out=np.zeros_like(overlap), where=len_a > 0)
+    recall = np.divide(overlap, len_b, out=np.zeros_like(overlap), where=len_b > 0)
+    total = precision + recall
+    return np.divide(2 * precision * recall, total, out=np.zeros_like(total), where=total > 0)
+
+
+def _key_tokens(text):
+    return frozenset(token for token in tokenize(text) if token in NEGATIONS or DIGIT.search(token))
+
+
+def cheap_signals(q_n_a_s, similarity):
+    """
+    Cheap signals for every record, as arrays.
+
+    Args:
+        q_n_a_s (list): Records with 'response' and 'ground_truth'
+        similarity (np.ndarray): Embedding similarity of each response to its ground truth
+    """
+    responses = [q_n_a.get('response') or '' for q_n_a in q_n_a_s]
+    references = [q_n_a.get('ground_truth') or '' for q_n_a in q_n_a_s]
+    return {
+        'similarity': np.asarray(similarity, dtype=np.float64),
+        'lexical_f1': lexical_f1(hashed_counts(responses), hashed_counts(references), len(q_n_a_s)),
+        # "... in 2023" reads almost like "... in 2024" but is wrong.
+        'same_keys': np.array([_key_tokens(r) == _key_tokens(g) for r, g in zip(responses, references)], dtype=bool),
+        'response_failed': np.array([r.strip() in ('', 'failed') for r in responses]),
+        'response_refusal': np.array([
+            len(tokenize(r)) <= REFUSAL_MAX_TOKENS and RESPONSE_REFUSAL.search(r) is not None for r in responses
+        ]),
+        'reference_refusal': np.array([REFERENCE_REFUSAL.search(r) is not None for r in references]),
+    }
+
+
+def decide(signals, exact_f1=CASCADE_EXACT_F1):
+    """
+    Decide what the cheap tiers can.
+
+    Returns:
+        tuple: (values, tiers) dicts keyed by metric; values are arrays with NaN
+            where the judge is still needed, tiers are arrays of tier names
+    """
+    n = len(signals['similarity'])
+    similarity = signals['similarity']
+    values = {metric: np.full(n, np.nan) for metric in JUDGED_METRICS}
+    tiers = {metric: np.full(n, 'judge', dtype=object) for metric in JUDGED_METRICS}
+
+    def assign(metric, mask, value, tier):
+        mask = mask & (tiers[metric] == 'judge')
+        values[metric][mask] = np.broadcast_to(value, n)[mask]
+        tiers[metric][mask] = tier
+
+    failed = signals['response_failed']
+    assign('answer_relevancy', failed, 0.0, 'rule')
+    assign('answer_relevancy', signals['response_refusal'], 0.0, 'rule')
+    assign('answer_correctness', signals['reference_refusal'] | failed, 0.25 * similarity, 'rule')
+    if exact_f1 > 0:
+        lexical = (signals['lexical_f1'] >= exact_f1) & signals['same_keys']
+        assign('answer_correctness', lexical, 0.75 + 0.25 * similarity, 'lexical')
+    return values, tiers
+
+
+def tier_report(tiers):
+    """Count of rows decided by each tier, per metric."""
+    report = {}
+    for metric, labels in tiers.items():
+        names, counts = np.unique(labels.astype(str), return_counts=True)
+        report[metric] = dict(zip(names.tolist(), counts.tolist()))
+    return report
+
+
+def print_tier_report(tiers):
+    for metric, counts in tier_report(tiers).items():
+        total = sum(counts.values())
+        judged = counts.get('judge', 0)
+        print(f"{metric}: " + ", ".join(f"{tier} {count}" for tier, count in sorted(counts.items()))
+              + f" ({total - judged}/{total} decided without the judge)")
+
+
+def _scalar(value):
+    if isinstance(value, list):
+        value = value[0] if value else None
+    return np.nan if value is None else float(value)
+
+
+def calibrate(directory='QnA', tolerance=CASCADE_TOLERANCE, exact_f1=CASCADE_EXACT_F1):
+    """
+    Replay the cascade over evaluated files and compare its decisions with the
+    judge scores already recorded there. No API calls are made; the recorded
+    semantic_similarity stands in for the embedding index.
+    """
+    rows = []
+    for file in qna_io.list_files(directory, 'file_eval'):
+        rows.extend(qna_io.read_records(file))
+    similarity = np.array([_scalar(row.get('semantic_similarity')) for row in rows])
+    values, tiers = decide(cheap_signals(rows, similarity), exact_f1)
+    print(f"Calibrating on {len(rows)} rows")
+    print_tier_report(tiers)
+
+    ok = True
+    for metric in JUDGED_METRICS:
+        judge = np.array([_scalar(row.get(metric)) for row in rows])
+        decided = ~np.isnan(values[metric]) & ~np.isnan(judge)
+        mixed = np.where(decided, values[metric], judge)
+        delta = np.nanmean(mixed) - np.nanmean(judge)
+        ok = ok and abs(delta) <= tolerance
+        print(f"\n{metric}: aggregate {np.nanmean(judge):.4f} -> {np.nanmean(mixed):.4f} (delta {delta:+.4f}, tolerance {tolerance})")
+        for tier in sorted(set(tiers[metric][decided])):
+            mask = decided & (tiers[metric] == tier)
+            error = np.abs(values[metric][mask] - judge[mask])
+            print(f"  {tier}: {mask.sum()} rows, mean abs error {error.mean():.4f}, max {error.max():.4f}")
+    print("\nWithin tolerance" if ok else "\nOutside tolerance")
+    return ok
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == 'calibrate':
+        sys.exit(0 if calibrate(exact_f1=float(sys.argv[2]) if len(sys.argv) > 2 else CASCADE_EXACT_F1) else 1)
+    print("Usage: python cascade.py calibrate [EXACT_F1]")
@@ -1,20 +1,77 @@
-import requests
 import os
+import asyncio
+import random
+import time
+import uuid
 from datetime import datetime
 import json
+from collections import deque
 from dotenv import load_dotenv
+import odin_client
+import qna_io
+import rate_limiter
+import results_store
 
 load_dotenv()
 
-X_API_KEY = os.getenv("X_API_KEY")
-X_API_SECRET = os.getenv("X_API_SECRET")
-
 PROJECT_ID = os.getenv("PROJECT_ID")
 CHAT_ID = os.getenv("CHAT_ID")
 
-def submit_question(question, project_id, chat_id):
-    questions_url = f"http://localhost:8001/v3/chat/message"
-    data = {
+# Number of questions in flight at once; each one gets its own chat.
+CHAT_CONCURRENCY = int(os.getenv("CHAT_CONCURRENCY", 8))
+# A chat is retired after this many questions so its history stays short.
+QUESTIONS_PER_CHAT = int(os.getenv("QUESTIONS_PER_CHAT", 10))
+# Records read ahead per file while answering; bounds memory for any file size.
+ANSWER_WINDOW = int(os.getenv("ANSWER_WINDOW", CHAT_CONCURRENCY * 4))
+
+# Answer polling backs off exponentially (with full jitter) until the deadline.
+ANSWER_DEADLINE = float(os.getenv("ANSWER_DEADLINE", 120))
+POLL_BASE_DELAY = float(os.getenv("POLL_BASE_DELAY", 0.25))
+POLL_MAX_DELAY = float(os.getenv("POLL_MAX_DELAY", 8))
+# A chat creation or submission refused with 429 or a 5xx is sent again, with the same
+# backoff (or the server's Retry-After), up to this many times in all.
+SUBMIT_ATTEMPTS = int(os.getenv("SUBMIT_ATTEMPTS", 5))
+
+# Read answers as a stream (SSE, NDJSON or chunked text) when the message endpoint
+# offers one: 'auto' asks for a stream and polls for the rest of the run once the
+# server replies with a plain submission, 'true' always asks, 'false' always polls.
+STREAM_ANSWERS = os.getenv("STREAM_ANSWERS", "auto").lower()
+
+# A 404 from the per-message endpoint may only mean that one message is not there yet, so
+# the endpoint is taken to be missing on a 405, or after this many 404s in a row.
+MESSAGE_ENDPOINT_MISSES = 3
+
+# Flipped off once the server is found to have no per-message endpoint.
+_message_endpoint_supported = True
+_message_misses = 0
+# Flipped off (in 'auto' mode) the first time the server does not stream an answer.
+_streaming_supported = True
+
+
+def _chat_form(project_id, name=None):
+    return {
+        'project_id': project_id,
+        'name': name or f"eval-{uuid.uuid4().hex[:8]}",
+    }
+
+
+def _chat_id(response):
+    if response.status_code == 200:
+        return response.json().get('chat_id')
+    print(f"Failed to create chat with status code {response.status_code}")
+    return None
+
+
+def create_chat(project_id, name=None):
+    return _chat_id(_post("/chat/create", _chat_form(project_id, name)))
+
+
+async def create_chat_async(project_id, name=None):
+    return _chat_id(await _apost("/chat/create", _chat_form(project_id, name)))
+
+
+def _message_form(question, project_id, chat_id):
+    return {
         'message': question,
         'project_id': project_id,
         'chat_id': chat_id,
@@ -25,61 +82,656 @@ def submit_question(question, project_id, chat_id):
         'is_regenerating': 'false',
         'request_metadata': json.dumps({"files_metadata":[],"time": datetime.now().isoformat()})
     }
-    headers = {
-        'Content-Type': 'application/x-www-form-urlencoded',
-        "X-API-KEY": X_API_KEY, 
-        "X-API-SECRET": X_API_SECRET
-    }
-    response = requests.post(questions_url, data=data, headers=headers)
-    return True if response.status_code == 200 else False
 
-def _get_answer(question, project_id, chat_id, extended_response=False):
 
-    headers = {
-        "X-API-KEY": X_API_KEY, 
-        "X-API-SECRET": X_API_SECRET
-    }
-    questions_url = f"http://localhost:8001/project/{project_id}/chat/{chat_id}?prompt_debug=True"
-    response = requests.get(questions_url,  headers=headers)
-    if response.status_code == 200:
-        for msg in response.json()['messages']:
-            if msg['message'] == question:
-                if extended_response:
-                    return msg
-                else:
-                    return msg['response'] 
-    else:
+def new_stats():
+    """Per-question timing and retry counters, filled in by passing `stats=` to the calls below."""
+    return {'submitted_at': None, 'submit_latency': None, 'answer_latency': None, 'time_to_answer': None,
+            'polls': 0, 'retries': 0, 'status_codes': {}, 'outcome': None,
+            'streamed': False, 'time_to_first_token': None, 'tokens': None, 'tokens_per_second': None}
+
+
+def _record_status(stats, response):
+    if stats is not None:
+        code = str(response.status_code)
+        stats['status_codes'][code] = stats['status_codes'].get(code, 0) + 1
+    return response
+
+
+def _submitted(response):
+    if response.status_code != 200:
+        return False
+    # Callers only test truthiness, so fall back to True when no ID is returned.
+    return _message_id(response) or True
+
+
+def _message_id(response):
+    try:
+        body = response.json()
+    except ValueError:
+        return None
+    if not isinstance(body, dict):
+        return None
+    return body.get('message_id') or body.get('id')
+
+
+def _resubmit_delay(response, delays, attempt, stats):
+    """
+    Seconds to wait before sending a request again after `response` (None if the
+    connection failed), or None if the request is not to be sent again.
+    """
+    if attempt + 1 >= SUBMIT_ATTEMPTS:
+        return None
+    if response is not None and not (response.status_code == 429 or response.status_code >= 500):
+        return None
+    if stats is not None:
+        stats['retries'] += 1
+    delay = next(delays)
+    wait = rate_limiter.retry_after(response.headers) if response is not None else None
+    return delay if wait is None else wait
+
+
+def _post(path, data, stats=None):
+    """
+    POST `data` to `path`, sending it again while the connection fails or the
+    server answers 429 or 5xx, up to SUBMIT_ATTEMPTS times.
+    """
+    import requests
+
+    delays = _backoff_delays()
+    for attempt in range(SUBMIT_ATTEMPTS):
+        try:
+            response = _record_status(stats, odin_client.post(path, data=data))
+        except requests.ConnectionError:
+            if attempt + 1 >= SUBMIT_ATTEMPTS:
+                raise
+            response = None
+        delay = _resubmit_delay(response, delays, attempt, stats)
+        if delay is None:
+            return response
+        time.sleep(delay)
+
+
+async def _apost(path, data, stats=None):
+    """Async variant of `_post`."""
+    import httpx
+
+    delays = _backoff_delays()
+    for attempt in range(SUBMIT_ATTEMPTS):
+        try:
+            response = _record_status(stats, await odin_client.apost(path, data=data))
+        except httpx.TransportError:
+            if attempt + 1 >= SUBMIT_ATTEMPTS:
+                raise
+            response = None
+        delay = _resubmit_delay(response, delays, attempt, stats)
+        if delay is None:
+            return response
+        await asyncio.sleep(delay)
+
+
+def submit_question(question, project_id, chat_id, stats=None):
+    start = time.monotonic()
+    if stats is not None:
+        stats['submitted_at'] = time.time()
+    response = _post("/v3/chat/message", _message_form(question, project_id, chat_id), stats)
+    if stats is not None:
+        stats['submit_latency'] = time.monotonic() - start
+    return _submitted(response)
+
+
+async def submit_question_async(question, project_id, chat_id, stats=None):
+    start = time.monotonic()
+    if stats is not None:
+        stats['submitted_at'] = time.time()
+    response = await _apost("/v3/chat/message", _message_form(question, project_id, chat_id), stats)
+    if stats is not None:
+        stats['submit_latency'] = time.monotonic() - start
+    return _submitted(response)
+
+
+def _message_path(project_id, chat_id, message_id):
+    return f"/project/{project_id}/chat/{chat_id}/message/{message_id}?prompt_debug=True"
+
+
+def _history_path(project_id, chat_id):
+    return f"/project/{project_id}/chat/{chat_id}?prompt_debug=True"
+
+
+def _read_message(response):
+    """
+    Read a single-message response. Returns the message, None if the endpoint
+    did not have it (read the chat history instead), or 'failed' on any other error.
+    """
+    global _message_endpoint_supported, _message_misses
+    if response.status_code == 404:
+        _message_misses += 1
+    elif response.status_code != 405:
+        _message_misses = 0
+    if response.status_code == 405 or _message_misses >= MESSAGE_ENDPOINT_MISSES:
+        _message_endpoint_supported = False
+    if response.status_code in (404, 405):
+        return None
+    if response.status_code != 200:
+        return 'failed'
+    return response.json()
+
+
+def _read_history(response, question, message_id):
+    if response.status_code != 200:
+        return 'failed'
+    return _find_message(response.json()['messages'], question, message_id)
+
+
+def _find_message(messages, question, message_id):
+    if message_id is not None:
+        for msg in messages:
+            if msg.get('id', msg.get('message_id')) == message_id:
+                return msg
+        return None
+    # Without an ID the most recent message with the same text is the one we asked.
+    for msg in reversed(messages):
+        if msg['message'] == question:
+            return msg
+    return None
+
+
+def _answer_from(msg, question, extended_response):
+    if msg == 'failed':
         print(f"Failed to get answer for question: {question}")
+        return 'failed'
+    # The message exists as soon as it is submitted; it is answered once it has a response.
+    if msg is None or not msg.get('response'):
+        return 'failed'
+    if extended_response:
+        return msg
+    return msg['response']
+
+
+def _get_answer(question, project_id, chat_id, extended_response=False, message_id=None, stats=None):
+    import requests
+
+    if message_id is True:
+        # submit_question succeeded but the server did not hand back an ID.
+        message_id = None
+    msg = None
+    try:
+        if message_id is not None and _message_endpoint_supported:
+            response = odin_client.get(_message_path(project_id, chat_id, message_id))
+            msg = _read_message(_record_status(stats, response))
+        if msg is None:
+            response = _record_status(stats, odin_client.get(_history_path(project_id, chat_id)))
+            msg = _read_history(response, question, message_id)
+    except (requests.ConnectionError, requests.Timeout):
+        # A dropped connection is a failed poll like any other; the caller backs off and polls again.
+        msg = 'failed'
+    return _answer_from(msg, question, extended_response)
+
+
+async def _get_answer_async(question, project_id, chat_id, extended_response=False, message_id=None, stats=None):
+    import httpx
+
+    if message_id is True:
+        message_id = None
+    msg = None
+    try:
+        if message_id is not None and _message_endpoint_supported:
+            response = await odin_client.aget(_message_path(project_id, chat_id, message_id))
+            msg = _read_message(_record_status(stats, response))
+        if msg is None:
+            response = _record_status(stats, await odin_client.aget(_history_path(project_id, chat_id)))
+            msg = _read_history(response, question, message_id)
+    except httpx.TransportError:
+        msg = 'failed'
+    return _answer_from(msg, question, extended_response)
+
+
+def _count_poll(stats, answer, start):
+    if stats is None:
+        return
+    stats['polls'] += 1
+    if answer == 'failed':
+        stats['retries'] += 1
+    stats['answer_latency'] = time.monotonic() - start
+
+
+def _backoff_delays(base=POLL_BASE_DELAY, cap=POLL_MAX_DELAY):
+    attempt = 0
+    while True:
+        yield random.uniform(0, min(cap, base * 2 ** attempt))
+        attempt += 1
+
+
+def get_answer(question, project_id, chat_id, extended_response=False, message_id=None, deadline=ANSWER_DEADLINE,
+               stats=None):
+    """
+    Poll for the answer to a submitted question until it arrives or the deadline passes.
+
+    Args:
+        question (str): Question text, used to find the message when no ID is known
+        project_id (str): Project identifier
+        chat_id (str): Chat the question was submitted to
+        extended_response (bool): Return the whole message instead of just the response
+        message_id (str): ID returned by `submit_question`, if any
+        deadline (float): Seconds to keep polling before giving up
+        stats (dict): If given (see `new_stats`), polls, retries, status codes
+            and the time spent polling are recorded in it
+
+    Returns:
+        str | dict: The answer (or message), or 'failed'
+    """
+    start = time.monotonic()
+    for delay in _backoff_delays():
+        answer = _get_answer(question, project_id, chat_id, extended_response, message_id, stats)
+        _count_poll(stats, answer, start)
+        if answer != 'failed':
+            return answer
+        remaining = deadline - (time.monotonic() - start)
+        if remaining <= 0:
+            break
+        time.sleep(min(delay, remaining))
     return 'failed'
 
 
-def get_answer(question, project_id, chat_id, extended_response=False):
-    count = 5
-    while count > 0:
-        answer = _get_answer(question, project_id, chat_id, extended_response)
+async def get_answer_async(question, project_id, chat_id, extended_response=False, message_id=None,
+                           deadline=ANSWER_DEADLINE, stats=None):
+    """Async variant of `get_answer`."""
+    start = time.monotonic()
+    for delay in _backoff_delays():
+        answer = await _get_answer_async(question, project_id, chat_id, extended_response, message_id, stats)
+        _count_poll(stats, answer, start)
         if answer != 'failed':
             return answer
-        count -= 1
-        import time; time.sleep(1)
+        remaining = deadline - (time.monotonic() - start)
+        if remaining <= 0:
+            break
+        await asyncio.sleep(min(delay, remaining))
     return 'failed'
 
 
+STREAM_CONTENT_TYPES = ('text/event-stream', 'application/x-ndjson', 'application/jsonl', 'text/plain')
+# Fields that carry the next piece of text in a streamed JSON event.
+STREAM_TEXT_FIELDS = ('token', 'delta', 'content', 'text')
+
+
+class StreamError(Exception):
+    pass
+
+
+def _use_streaming():
+    if STREAM_ANSWERS == 'true':
+        return True
+    return STREAM_ANSWERS == 'auto' and _streaming_supported
+
+
+def _no_streaming():
+    global _streaming_supported
+    if STREAM_ANSWERS == 'auto' and _streaming_supported:
+        print("Chat endpoint does not stream answers; polling instead")
+        _streaming_supported = False
+
+
+async def _stream_events(response):
+    """Yield (event name, data) for every event of a streamed response; raw text chunks are named 'text'."""
+    content_type = response.headers.get('content-type', '')
+    if content_type.startswith('text/event-stream'):
+        name = None
+        data = []
+        async for line in response.aiter_lines():
+            if not line:
+                if data:
+                    yield name, '\n'.join(data)
+                name = None
+                data = []
+                continue
+            if line.startswith(':'):
+                continue
+            field, _, value = line.partition(':')
+            value = value[1:] if value.startswith(' ') else value
+            if field == 'data':
+                data.append(value)
+            elif field == 'event':
+                name = value
+        if data:
+            yield name, '\n'.join(data)
+    elif content_type.startswith('text/plain'):
+        async for chunk in response.aiter_text():
+            if chunk:
+                yield 'text', chunk
+    else:
+        async for line in response.aiter_lines():
+            if line.strip():
+                yield None, line
+
+
+def _read_event(name, data):
+    """
+    (text, message) carried by one streamed event: the next piece of the answer,
+    and the whole message if the event has one (servers often send it last).
+    Returns None at the end-of-stream marker.
+    """
+    if name == 'text':
+        return data, None
+    if data.strip() == '[DONE]' or name in ('done', 'end'):
+        return None
+    try:
+        event = json.loads(data)
+    except ValueError:
+        event = data
+    if name == 'error' or (isinstance(event, dict) and event.get('error')):
+        raise StreamError(event.get('error') if isinstance(event, dict) else event)
+    if not isinstance(event, dict):
+        return str(event), None
+    if event.get('response'):
+        return '', event
+    choices = event.get('choices')
+    if choices:
+        # OpenAI-style chunk.
+        return (choices[0].get('delta') or {}).get('content') or '', None
+    for field in STREAM_TEXT_FIELDS:
+        if isinstance(event.get(field), str):
+            return event[field], None
+    return '', None
+
+
+async def _read_stream(response, stats):
+    """Read a streamed answer to the end. Returns (text, final message or None)."""
+    pieces = []
+    message = None
+    first = last = None
+    async for name, data in _stream_events(response):
+        event = _read_event(name, data)
+        if event is None:
+            break
+        text, final = event
+        if final is not None:
+            message = final
+        if text:
+            last = time.monotonic()
+            first = first or last
+            pieces.append(text)
+            if stats is not None and stats['time_to_first_token'] is None:
+                stats['time_to_first_token'] = stats['submit_latency'] + (first - stats['_headers_at'])
+    if stats is not None:
+        # One event is taken as one token; the rate covers the tokens after the first.
+        stats['tokens'] = len(pieces)
+        if len(pieces) > 1 and last > first:
+            stats['tokens_per_second'] = (len(pieces) - 1) / (last - first)
+    return ''.join(pieces), message
+
+
+async def stream_question_async(question, project_id, chat_id, extended_response=False, deadline=ANSWER_DEADLINE,
+                                stats=None):
+    """
+    Submit a question asking for the answer as a stream, and read it as it arrives.
+
+    Args:
+        question (str): Question text
+        project_id (str): Project identifier
+        chat_id (str): Chat to ask in
+        extended_response (bool): Return the whole message instead of just the response
+        deadline (float): Seconds to wait for the stream to finish
+        stats (dict): If given (see `new_stats`), submit latency and retries, time
+            to first token, token count and tokens per second are recorded in it
+
+    Returns:
+        tuple: (True, answer or 'failed') when the server streamed the answer;
+            (False, submit result) when it replied with a plain submission whose
+            answer has to be polled, the result being what `submit_question_async`
+            returns, or None if the streamed request was rejected (or never got a
+            response) and should be resubmitted without asking for a stream. A
+            stream that breaks after the server took the question also comes
+            back as (False, True), to poll for its answer.
+    """
+    import httpx
+
+    form = dict(_message_form(question, project_id, chat_id), stream='true')
+    start = time.monotonic()
+    if stats is not None:
+        stats['submitted_at'] = time.time()
+
+    responded = False
+
+    async def consume():
+        nonlocal responded
+        delays = _backoff_delays()
+        for attempt in range(SUBMIT_ATTEMPTS):
+            async with odin_client.astream("POST", "/v3/chat/message", data=form,
+                                           headers={'Accept': 'text/event-stream'}) as response:
+                headers_at = time.monotonic()
+                if stats is not None:
+                    stats['submit_latency'] = headers_at - start
+                    stats['_headers_at'] = headers_at
+                _record_status(stats, response)
+                content_type = response.headers.get('content-type', '')
+                if response.status_code == 200 and content_type.startswith(STREAM_CONTENT_TYPES):
+                    responded = True
+                    text, message = await _read_stream(response, stats)
+                    if stats is not None:
+                        stats['answer_latency'] = time.monotonic() - headers_at
+                        stats['streamed'] = True
+                    return True, (text, message)
+                await response.aread()
+                delay = _resubmit_delay(response, delays, attempt, stats)
+                if delay is None:
+                    if response.status_code in (400, 415, 422) and STREAM_ANSWERS == 'auto':
+                        # Possibly the stream flag itself that was refused.
+                        _no_streaming()
+                        return False, None
+                    if response.status_code == 200:
+                        _no_streaming()
+                    return False, _submitted(response)
+            await asyncio.sleep(delay)
+
+    try:
+        streamed, result = await asyncio.wait_for(consume(), deadline)
+    except asyncio.TimeoutError:
+        print(f"Answer stream timed out for question: {question}")
+        return True, 'failed'
+    except StreamError as e:
+        print(f"Answer stream failed for question: {question} ({type(e).__name__}: {e})")
+        return True, 'failed'
+    except httpx.HTTPError as e:
+        # The connection, not the answer, failed: ask again without a stream, or poll if the question got through.
+        print(f"Answer stream broke for question: {question} ({type(e).__name__}: {e}); polling instead")
+        return False, True if responded else None
+    finally:
+        if stats is not None:
+            stats.pop('_headers_at', None)
+    if not streamed:
+        return False, result
+    text, message = result
+    if message is None:
+        message = {'message': question, 'response': text}
+    elif not message.get('response'):
+        message['response'] = text
+    if extended_response and 'citation_source' not in message:
+        # The stream only carried text; the stored message has the rest.
+        stored = await _get_answer_async(question, project_id, chat_id, True, _message_id_of(message), stats)
+        if stored != 'failed':
+            message = stored
+    if not message.get('response'):
+        return True, 'failed'
+    return True, message if extended_response else message['response']
+
+
+def _message_id_of(message):
+    return message.get('message_id') or message.get('id')
+
+
+async def ask_question_async(question, project_id, chat_id, extended_response=False, deadline=ANSWER_DEADLINE,
+                             stats=None):
+    """
+    Ask a question and wait for the answer: read as a stream when STREAM_ANSWERS
+    allows it and the server streams, polled for otherwise.
+
+    Args:
+        question (str): Question text
+        project_id (str): Project identifier
+        chat_id (str): Chat to ask in
+        extended_response (bool): Return the whole message instead of just the response
+        deadline (float): Seconds to wait for the answer
+        stats (dict): If given (see `new_stats`), timings are recorded in it,
+            along with the outcome and, once answered, the time to answer
+
+    Returns:
+        str | dict: The answer (or message), or 'failed'
+    """
+    stats = stats if stats is not None else new_stats()
+    submitted = None
+    if _use_streaming():
+        streamed, result = await stream_question_async(question, project_id, chat_id, extended_response, deadline,
+                                                       stats)
+        if streamed:
+            stats['outcome'] = 'stream_failed' if result == 'failed' else 'answered'
+            if result != 'failed':
+                stats['time_to_answer'] = stats['submit_latency'] + stats['answer_latency']
+            return result
+        submitted = result
+    if submitted is None:
+        submitted = await submit_question_async(question, project_id, chat_id, stats)
+    if not submitted:
+        stats['outcome'] = 'submit_failed'
+        return 'failed'
+    answer = await get_answer_async(question, project_id, chat_id, extended_response, submitted, deadline, stats)
+    stats['outcome'] = 'timeout' if answer == 'failed' else 'answered'
+    if answer != 'failed':
+        stats['time_to_answer'] = stats['submit_latency'] + stats['answer_latency']
+    return answer
+
+
+class ChatPool:
+    """
+    Pool of chat sessions shared by concurrent questions.
+
+    Every chat has at most one question in flight, so answers never interleave,
+    and a chat is retired once it has served `questions_per_chat` questions.
+    A replacement chat is created lazily the next time one is needed.
+    """
+
+    def __init__(self, project_id, size=CHAT_CONCURRENCY, questions_per_chat=QUESTIONS_PER_CHAT):
+        self.project_id = project_id
+        self.size = size
+        self.questions_per_chat = questions_per_chat
+        self._idle = asyncio.Queue()
+        self._uses = {}
+        self._live = 0
+
+    async def acquire(self):
+        if self._idle.empty() and self._live < self.size:
+            self._live += 1
+        else:
+            chat_id = await self._idle.get()
+            if chat_id is not None:
+                return chat_id
+            # The slot of a retired chat: fill it with a new one.
+        chat_id = await create_chat_async(self.project_id)
+        if chat_id is None:
+            # Hand the slot on so waiting questions are not stranded.
+            self._idle.put_nowait(None)
+            raise RuntimeError(f"Failed to create chat for project {self.project_id}")
+        self._uses[chat_id] = 0
+        return chat_id
+
+    def release(self, chat_id):
+        self._uses[chat_id] += 1
+        if self._uses[chat_id] >= self.questions_per_chat:
+            del self._uses[chat_id]
+            self._idle.put_nowait(None)
+        else:
+            self._idle.put_nowait(chat_id)
+
+
+async def _answer_question(pool, q_n_a, project_id):
+    question = q_n_a['question']
+    stats = new_stats()
+    q_n_a['timing'] = stats
+    try:
+        chat_id = await pool.acquire()
+    except RuntimeError as e:
+        print(e)
+        q_n_a['response'] = 'failed'
+        stats['outcome'] = 'no_chat'
+        return q_n_a
+    try:
+        print(f"Submitting question: {question}")
+        response = await ask_question_async(question, project_id, chat_id, stats=stats)
+    finally:
+        pool.release(chat_id)
+    print(f"Response: {response}")
+    q_n_a['response'] = response
+    return q_n_a
+
+
+async def answer_questions(q_n_a_s, project_id, pool=None):
+    """
+    Answer a list of QnA records concurrently, filling in their 'response'.
+
+    Args:
+        q_n_a_s (list): Records with a 'question' key, updated in place
+        project_id (str): Project identifier
+        pool (ChatPool): Pool to draw chats from, a new one is created if None
+
+    Returns:
+        list: The same records, in their original order
+    """
+    if pool is None:
+        pool = ChatPool(project_id)
+    await asyncio.gather(*(_answer_question(pool, q_n_a, project_id) for q_n_a in q_n_a_s))
+    return q_n_a_s
+
+
+async def answer_files(files, project_id, run_id=None, answered=None):
+    """
+    Answer every record of the given (test_qna path, file_ans path) files.
+    Each answer's timing is also recorded in the results store under `run_id`.
+
+    `answered`, if given, maps a record to an earlier answered copy of it, or
+    None; those copies are written as they are, without asking again.
+    """
+    # One pool for every file so the pipeline does not drain at file boundaries.
+    pool = ChatPool(project_id)
+    store = results_store.get_store()
+    run_id = store.start_run('chat', run_id)
+
+    async def answer_file(src, dst):
+        # Stream records through a bounded window, writing answers in input order.
+        window = deque()
+        file = qna_io.stem(os.path.basename(dst))
+        row = 0
+
+        async def write_next():
+            nonlocal row
+            future, reused = window.popleft()
+            q_n_a = await future
+            writer.write(q_n_a)
+            if not reused:
+                # Only answers measured in this run go into its timings.
+                store.put_rows(run_id, 'chat', file, [(row, q_n_a)])
+            row += 1
+
+        with qna_io.RecordWriter(dst) as writer:
+            for q_n_a in qna_io.read_records(src):
+                earlier = answered(q_n_a) if answered is not None else None
+                if earlier is not None:
+                    future = asyncio.get_running_loop().create_future()
+                    future.set_result(earlier)
+                    window.append((future, True))
+                    continue
+                window.append((asyncio.ensure_future(_answer_question(pool, q_n_a, project_id)), False))
+                if len(window) >= ANSWER_WINDOW:
+                    await write_next()
+            while window:
+                await write_next()
+
+    await asyncio.gather(*(answer_file(src, dst) for src, dst in files))
+    await odin_client.aclose()
+
+
 if __name__ == "__main__":
-    count = 0
-    for file in os.listdir('QnA'):
-        if not file.endswith('.json'):
-            continue
-
-        with open(f'QnA/{file}', 'r') as f:    
-            count += 1
-            questions = f.read()
-            q_n_a_s = json.loads(questions)
-            for q_n_a in q_n_a_s:
-                print(f"Submitting question: {q_n_a['question']}")
-                submit_question(q_n_a['question'], PROJECT_ID, CHAT_ID)
-                response = get_answer(q_n_a['question'], PROJECT_ID, CHAT_ID)
-                print(f"Response: {response}")
-                q_n_a['response'] = response
-
-            with open(f'QnA/file_ans_{count}.json', 'w') as f2:
-                json.dump(q_n_a_s, f2)
+    files = []
+    for file in qna_io.list_files('QnA', 'test_qna'):
+        # test_qna_N is answered in file_ans_N, as pipeline.py does.
+        number = qna_io.stem(os.path.basename(file))[len('test_qna_'):]
+        files.append((file, f'QnA/file_ans_{number}.jsonl'))
+    asyncio.run(answer_files(files, PROJECT_ID))
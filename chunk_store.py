@@ -0,0 +1,208 @@
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from dotenv import load_dotenv
+import odin_client
+
+load_dotenv()
+
+"""
+Local, content-addressed copy of the knowledge base chunks.
+
+`export_chunks` pulls every document's chunks with concurrent paginated requests
+and stores them in SQLite; chunk text is stored once per sha256, documents map
+to an ordered list of chunk hashes. Question generation and citation matching
+read chunks from here instead of calling the API again.
+
+Config (environment):
+CHUNK_STORE          Path of the SQLite store              (default chunks.sqlite)
+EXPORT_CONCURRENCY   Chunk page requests in flight         (default 16)
+EXPORT_PAGE_SIZE     Chunks per API page when exporting    (default 100)
+"""
+
+CHUNK_STORE_PATH = os.getenv("CHUNK_STORE", "chunks.sqlite")
+EXPORT_CONCURRENCY = int(os.getenv("EXPORT_CONCURRENCY", 16))
+EXPORT_PAGE_SIZE = int(os.getenv("EXPORT_PAGE_SIZE", 100))
+DOCUMENTS_PAGE_SIZE = 100
+
+
+def chunk_hash(content):
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+class ChunkStore:
+    def __init__(self, path=CHUNK_STORE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS chunks (
+                sha256 TEXT PRIMARY KEY,
+                content TEXT
+            );
+            CREATE TABLE IF NOT EXISTS documents (
+                content_key TEXT PRIMARY KEY,
+                doc TEXT,
+                total_chunks INTEGER,
+                exported_at REAL
+            );
+            CREATE TABLE IF NOT EXISTS document_chunks (
+                content_key TEXT,
+                position INTEGER,
+                sha256 TEXT,
+                PRIMARY KEY (content_key, position)
+            );
+        """)
+        self._conn.commit()
+
+    def put_document(self, doc, chunks):
+        """Replace the stored chunks of `doc` with `chunks` (a list of strings, in order)."""
+        hashes = [chunk_hash(chunk) for chunk in chunks]
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO chunks (sha256, content) VALUES (?, ?)", zip(hashes, chunks)
+            )
+            self._conn.execute("DELETE FROM document_chunks WHERE content_key = ?", (doc['content_key'],))
+            self._conn.executemany(
+                "INSERT INTO document_chunks (content_key, position, sha256) VALUES (?, ?, ?)",
+                [(doc['content_key'], position, sha) for position, sha in enumerate(hashes)]
+            )
+            self._conn.execute(
+                "INSERT OR REPLACE INTO documents (content_key, doc, total_chunks, exported_at) VALUES (?, ?, ?, ?)",
+                (doc['content_key'], json.dumps(doc, sort_keys=True), len(chunks), time.time())
+            )
+            self._conn.commit()
+
+    def get_document(self, content_key):
+        with self._lock:
+            row = self._conn.execute("SELECT doc FROM documents WHERE content_key = ?", (content_key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def documents(self):
+        with self._lock:
+            rows = self._conn.execute("SELECT doc FROM documents ORDER BY content_key").fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def total_pages(self, content_key, page_size=40):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT total_chunks FROM documents WHERE content_key = ?", (content_key,)
+            ).fetchone()
+        if row is None:
+            return 0
+        return (row[0] + page_size - 1) // page_size
+
+    def chunks(self, content_key, page=None, page_size=40):
+        """Chunks of a document in order, or only the 1-based `page` of `page_size` chunks."""
+        query = """
+            SELECT c.content FROM document_chunks d JOIN chunks c ON c.sha256 = d.sha256
+            WHERE d.content_key = ? ORDER BY d.position
+        """
+        params = (content_key,)
+        if page is not None:
+            query += " LIMIT ? OFFSET ?"
+            params = (content_key, page_size, (page - 1) * page_size)
+        with self._lock:
+            rows = self._conn.execute(query, params).fetchall()
+        return [row[0] for row in rows]
+
+    def digest(self, content_keys=None):
+        """sha256 over the chunk hashes of every document (or only `content_keys`), in order."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT content_key, position, sha256 FROM document_chunks ORDER BY content_key, position"
+            ).fetchall()
+        keep = None if content_keys is None else set(content_keys)
+        sha = hashlib.sha256()
+        for content_key, position, chunk in rows:
+            if keep is None or content_key in keep:
+                sha.update(f"{content_key}\0{position}\0{chunk}\n".encode('utf-8'))
+        return sha.hexdigest()
+
+    def all_chunks(self):
+        with self._lock:
+            rows = self._conn.execute("SELECT sha256, content FROM chunks").fetchall()
+        return dict(rows)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+async def list_documents(project_id, page_size=DOCUMENTS_PAGE_SIZE):
+    """Every document in the knowledge base, following pagination until a short page."""
+    docs = []
+    page = 1
+    while True:
+        response = await odin_client.apost(
+            f"/v3/project/{project_id}/knowledgebase",
+            json={"page": page, "page_size": page_size, "project_id": project_id}
+        )
+        response.raise_for_status()
+        batch = response.json()['docs']
+        docs.extend(batch)
+        if len(batch) < page_size:
+            return docs
+        page += 1
+
+
+async def _fetch_chunk_page(project_id, content_key, page, page_size, semaphore):
+    async with semaphore:
+        response = await odin_client.apost(
+            f"/project/{project_id}/document/chunks",
+            json={"content_key": content_key, "page": page, "page_size": page_size}
+        )
+    response.raise_for_status()
+    return response.json()
+
+
+async def export_document(project_id, doc, semaphore, page_size=EXPORT_PAGE_SIZE):
+    """All chunk texts of `doc`, in order. Page 1 tells us how many more pages to fetch."""
+    first = await _fetch_chunk_page(project_id, doc['content_key'], 1, page_size, semaphore)
+    rest = await asyncio.gather(*(
+        _fetch_chunk_page(project_id, doc['content_key'], page, page_size, semaphore)
+        for page in range(2, first.get('total_pages', 1) + 1)
+    ))
+    return [chunk['content'] for data in [first] + list(rest) for chunk in data['chunks']]
+
+
+async def export_chunks(project_id, store, concurrency=EXPORT_CONCURRENCY, refresh=False):
+    """
+    Export the chunks of every document into `store`.
+
+    Documents whose listing entry is unchanged since the last export are skipped
+    unless `refresh` is set.
+
+    Returns:
+        list: The documents in the knowledge base
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    docs = await list_documents(project_id)
+
+    async def export(doc):
+        if not refresh and store.get_document(doc['content_key']) == json.loads(json.dumps(doc, sort_keys=True)):
+            return False
+        try:
+            chunks = await export_document(project_id, doc, semaphore)
+        except Exception as e:
+            print(f"Failed to export chunks of {doc['content_key']}: {e}")
+            return False
+        store.put_document(doc, chunks)
+        print(f"Exported {len(chunks)} chunks of {doc['content_key']}")
+        return True
+
+    exported = await asyncio.gather(*(export(doc) for doc in docs))
+    print(f"Exported {sum(exported)} of {len(docs)} documents, {len(docs) - sum(exported)} unchanged or failed")
+    await odin_client.aclose()
+    return docs
+
+
+if __name__ == "__main__":
+    store = ChunkStore()
+    asyncio.run(export_chunks(os.getenv("PROJECT_ID"), store))
+    store.close()
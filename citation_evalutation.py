@@ -1,7 +1,8 @@
-import json
-from chats import submit_question, get_answer
+from chats import create_chat, submit_question, get_answer
 from dotenv import load_dotenv
-import os
+import qna_io
+import citation_matching
+import results_store
 
 load_dotenv()
 
@@ -10,40 +11,67 @@ chat_id = "d039ac53ef1343d0861d11"
 
 
 def evaluate_citations(citations, relevant_chunks):
-    total_chunks = len(relevant_chunks)
-    filtered_chunks = list(filter(lambda x: x in relevant_chunks, citations))
-    missing_chunks = list(filter(lambda x: x not in relevant_chunks, citations))
-
-    return {
-        "precision_score": len(filtered_chunks) / total_chunks,
-        "redundancy_score": len(missing_chunks) / total_chunks,
-    }
+    """
+    Score one question's citations against its relevant chunks with the fuzzy
+    matcher in citation_matching.py (sub-spans and whitespace variants of a
+    chunk count as matches). Use citation_matching.score_citations to score
+    many questions in one pass.
+    """
+    scores = citation_matching.score_citations([citations], [relevant_chunks])
+    return {metric: values[0].item() for metric, values in scores.items()}
 
 
 def get_citations_from_chat(chat_response):
     return [x['match_string'] for x in chat_response["citation_source"]["source_mapping"]]
 
-if __name__ == "__main__":
-    with open('questions_bank.json', 'r') as f:
-        questions_bank = json.load(f)
+def evaluate_bank(bank_path, output_path, project_id, chat_id=None, run_id=None):
+    """
+    Ask every question of the bank with the extended response and score the
+    chunks it cites, writing each record to `output_path` and the results
+    store. A new chat is created when `chat_id` is None.
 
+    Returns:
+        int: Number of questions that could not be submitted or answered
+    """
     failed_to_submit_qeuestion = 0
-    for question in questions_bank:
+    failed_to_answer = 0
+    chat_id = chat_id or create_chat(project_id)
+    store = results_store.get_store()
+    run_id = store.start_run('citation', run_id)
+    writer = qna_io.RecordWriter(output_path)
+    for row, question in enumerate(qna_io.read_records(bank_path)):
         print(question)
-        if  submit_question(question["question"], project_id, chat_id):
+        message_id = submit_question(question["question"], project_id, chat_id)
+        if message_id:
             print("Question submitted successfully")
         else:
             print("Question submission failed")
             failed_to_submit_qeuestion += 1
+            writer.write(question)
             continue
-        answer = get_answer(question["question"], project_id, chat_id, extended_response=True)
+        answer = get_answer(question["question"], project_id, chat_id, extended_response=True, message_id=message_id)
         print(answer)
+        if answer == 'failed':
+            # No 'citations' key, so citation_matching.py does not rescore it as empty.
+            print("Answer failed")
+            failed_to_answer += 1
+            question['citation_failed'] = True
+            writer.write(question)
+            continue
         citations = get_citations_from_chat(answer)
         print(citations)
         evaluation = evaluate_citations(citations, question["relevant_chunks"])
-        
+        # Kept so the file can be rescored later: python citation_matching.py
+        question["citations"] = citations
+        question['citation_failed'] = False
+
         print(evaluation)
         question.update(evaluation)
-        
-    with open('RetriverEval/citation_eval.json', 'w') as f:
-        json.dump(questions_bank, f, indent=4)
+        writer.write(question)
+        store.put_rows(run_id, 'citation', 'citation_eval', [(row, question)])
+    writer.close()
+    return failed_to_submit_qeuestion + failed_to_answer
+
+
+if __name__ == "__main__":
+    evaluate_bank(qna_io.find_file('questions_bank'), 'RetriverEval/citation_eval.jsonl', project_id, chat_id)
@@ -0,0 +1,270 @@
+import os
+import re
+import sys
+import unicodedata
+import zlib
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+import qna_io
+
+"""
+Fuzzy citation matching against a question's relevant chunks.
+
+Text is normalized (NFKC, lower case, words only, so whitespace and markdown
+differences disappear) and cut into word n-gram shingles hashed to 64 bits.
+Shingles are keyed by question, so matching every question of a bank is one set
+operation over flat arrays:
+
+span_precision   share of the cited text's shingles found in the relevant chunks
+span_recall      share of the relevant chunks' shingles covered by the citations
+span_f1          harmonic mean of the two
+precision_score  citations matching a relevant chunk / number of relevant chunks
+redundancy_score citations matching none / number of relevant chunks
+
+A citation matches when at least CITATION_MATCH_THRESHOLD of its shingles occur
+in the question's relevant chunks, so sub-spans and whitespace variants of a
+chunk count as matches, not as redundant citations.
+
+`python citation_matching.py [FILE ...]` rescores result files (records with
+'citations' and 'relevant_chunks', default RetriverEval/citation_eval.jsonl)
+in place.
+
+Config (environment):
+CITATION_NGRAM             Words per shingle                  (default 3)
+CITATION_MATCH_THRESHOLD   Shingle share for a citation match (default 0.5)
+"""
+
+CITATION_NGRAM = int(os.getenv("CITATION_NGRAM", 3))
+CITATION_MATCH_THRESHOLD = float(os.getenv("CITATION_MATCH_THRESHOLD", 0.5))
+
+TOKEN = re.compile(r"\w+")
+# Odd 64-bit multipliers for the rolling shingle hash and for keying shingles by question.
+HASH_BASE = np.uint64(0x100000001B3)
+QUESTION_MIX = np.uint64(0x9E3779B97F4A7C15)
+
+
+def normalize(text):
+    return unicodedata.normalize('NFKC', text or '').lower()
+
+
+def tokenize(text):
+    return TOKEN.findall(normalize(text))
+
+
+_token_cache = {}
+
+
+def _token_id(token):
+    # crc32 keeps ids stable across processes, unlike hash().
+    token_id = _token_cache.get(token)
+    if token_id is None:
+        token_id = _token_cache[token] = zlib.crc32(token.encode('utf-8')) + 1
+    return token_id
+
+
+def _distinct_shingles(texts, n):
+    ids = []
+    owner = []
+    for i, text in enumerate(texts):
+        tokens = [_token_id(token) for token in tokenize(text)]
+        ids.extend(tokens)
+        owner.extend([i] * len(tokens))
+    ids = np.asarray(ids, dtype=np.uint64)
+    owner = np.asarray(owner, dtype=np.int64)
+    lengths = np.bincount(owner, minlength=len(texts))
+    powers = HASH_BASE ** np.arange(n, dtype=np.uint64)
+
+    text_index = [np.zeros(0, dtype=np.int64)]
+    hashes = [np.zeros(0, dtype=np.uint64)]
+    if len(ids) >= n:
+        windows = sliding_window_view(ids, n)
+        window_owner = sliding_window_view(owner, n)
+        # Drop windows that span two texts.
+        inside = window_owner[:, 0] == window_owner[:, -1]
+        text_index.append(window_owner[inside, 0])
+        hashes.append((windows[inside] * powers).sum(axis=1, dtype=np.uint64))
+    starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    for i in np.nonzero((lengths > 0) & (lengths < n))[0]:
+        tokens = ids[starts[i]:starts[i] + lengths[i]]
+        text_index.append(np.array([i], dtype=np.int64))
+        hashes.append(np.array([(tokens * powers[:len(tokens)]).sum(dtype=np.uint64)], dtype=np.uint64))
+    text_index = np.concatenate(text_index)
+    order = np.argsort(text_index, kind='stable')
+    return text_index[order], np.concatenate(hashes)[order]
+
+
+def shingles(texts, n=CITATION_NGRAM):
+    """
+    Hashed word n-grams of every text.
+
+    Texts shorter than `n` words become a single shingle of all their words.
+    Each distinct text is tokenized once, however often it repeats (relevant
+    chunks recur across the questions generated from one page).
+
+    Returns:
+        tuple: (text index, shingle hash) arrays, one entry per shingle
+    """
+    distinct = {}
+    inverse = np.fromiter((distinct.setdefault(text, len(distinct)) for text in texts), dtype=np.int64, count=len(texts))
+    distinct_index, distinct_hashes = _distinct_shingles(list(distinct), n)
+
+    # Gather each text's run of shingles from its distinct text's run.
+    counts = np.bincount(distinct_index, minlength=len(distinct))
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    text_counts = counts[inverse]
+    total = int(text_counts.sum())
+    offsets = np.arange(total) - np.repeat(np.cumsum(text_counts) - text_counts, text_counts)
+    source = np.repeat(starts[inverse], text_counts) + offsets
+    return np.repeat(np.arange(len(texts)), text_counts), distinct_hashes[source]
+
+
+def _keyed(question, hashes):
+    return hashes ^ (question.astype(np.uint64) * QUESTION_MIX)
+
+
+def _isin_sorted(values, sorted_unique):
+    """np.isin for a sorted, de-duplicated haystack, by binary search."""
+    if len(sorted_unique) == 0:
+        return np.zeros(len(values), dtype=bool)
+    position = np.minimum(np.searchsorted(sorted_unique, values), len(sorted_unique) - 1)
+    return sorted_unique[position] == values
+
+
+def _ratio(numerator, denominator):
+    numerator = np.asarray(numerator, dtype=np.float64)
+    return np.divide(numerator, denominator, out=np.full(len(numerator), np.nan), where=denominator > 0)
+
+
+def score_citations(citations, relevant_chunks, n=CITATION_NGRAM, threshold=CITATION_MATCH_THRESHOLD):
+    """
+    Score the citations of many questions at once.
+
+    Args:
+        citations (list): Per question, the list of cited strings
+        relevant_chunks (list): Per question, the list of relevant chunk texts
+        n (int): Words per shingle
+        threshold (float): Share of a citation's shingles that must occur in the
+            relevant chunks for it to count as a match
+
+    Returns:
+        dict: Metric name -> array with one value per question (NaN when undefined)
+    """
+    n_questions = len(citations)
+    cite_question = np.repeat(np.arange(n_questions), [len(c) for c in citations])
+    chunk_question = np.repeat(np.arange(n_questions), [len(r) for r in relevant_chunks])
+    cite_text, cite_hash = shingles([c for cs in citations for c in cs], n)
+    chunk_text, chunk_hash = shingles([r for rs in relevant_chunks for r in rs], n)
+
+    # Sorted distinct shingles of each question's relevant chunks.
+    relevant_keys, first = np.unique(_keyed(chunk_question[chunk_text], chunk_hash), return_index=True)
+    chunk_key_question = chunk_question[chunk_text[first]]
+
+    # Per citation: distinct shingles, and the share found in its question's chunks.
+    cite_keys = _keyed(cite_question[cite_text], cite_hash)
+    _, first = np.unique(_keyed(cite_text, cite_hash), return_index=True)
+    hits = _isin_sorted(cite_keys[first], relevant_keys)
+    n_citations = len(cite_question)
+    shingle_counts = np.bincount(cite_text[first], minlength=n_citations)
+    hit_share = _ratio(np.bincount(cite_text[first], weights=hits, minlength=n_citations), shingle_counts)
+    matched = np.nan_to_num(hit_share) >= threshold
+
+    # Per question: distinct shingles of all citations against all relevant chunks.
+    question_keys, first = np.unique(cite_keys, return_index=True)
+    key_question = cite_question[cite_text[first]]
+    overlap = np.bincount(key_question, weights=_isin_sorted(question_keys, relevant_keys), minlength=n_questions)
+    cited = np.bincount(key_question, minlength=n_questions)
+    covered = np.bincount(chunk_key_question, weights=_isin_sorted(relevant_keys, question_keys), minlength=n_questions)
+    relevant = np.bincount(chunk_key_question, minlength=n_questions)
+
+    span_precision = _ratio(overlap, cited)
+    span_recall = _ratio(covered, relevant)
+    total = span_precision + span_recall
+    span_f1 = _ratio(2 * span_precision * span_recall, total)
+    # No overlap, or no citations at all while there was something to cite.
+    span_f1[(total == 0) | (span_recall == 0)] = 0.0
+
+    n_relevant = np.array([len(r) for r in relevant_chunks])
+    n_matched = np.bincount(cite_question, weights=matched, minlength=n_questions)
+    per_question = np.bincount(cite_question, minlength=n_questions)
+    return {
+        'precision_score': _ratio(n_matched, n_relevant),
+        'redundancy_score': _ratio(per_question - n_matched, n_relevant),
+        'span_precision': span_precision,
+        'span_recall': span_recall,
+        'span_f1': span_f1,
+    }
+
+
+def best_matches(retrieved, relevant_chunks, n=CITATION_NGRAM, threshold=CITATION_MATCH_THRESHOLD):
+    """
+    For every retrieved text, the position of the relevant chunk of the same
+    question it matches best.
+
+    A text matches a chunk when at least `threshold` of its shingles occur in
+    that chunk; relevant chunks often overlap, so each shingle is credited to
+    every chunk that contains it. Ties go to the earlier (more relevant) chunk.
+
+    Args:
+        retrieved (list): Per question, the list of retrieved texts
+        relevant_chunks (list): Per question, the list of relevant chunk texts
+
+    Returns:
+        np.ndarray: Relevant chunk position per retrieved text, flattened in
+            question order, -1 where nothing matches
+    """
+    n_questions = len(retrieved)
+    item_question = np.repeat(np.arange(n_questions), [len(r) for r in retrieved])
+    chunk_question = np.repeat(np.arange(n_questions), [len(r) for r in relevant_chunks])
+    chunk_position = np.concatenate([np.zeros(0, dtype=np.int64)] + [np.arange(len(r)) for r in relevant_chunks])
+    item_text, item_hash = shingles([t for ts in retrieved for t in ts], n)
+    chunk_text, chunk_hash = shingles([r for rs in relevant_chunks for r in rs], n)
+    n_items = len(item_question)
+    best = np.full(n_items, -1, dtype=np.int64)
+    if n_items == 0 or len(chunk_text) == 0:
+        return best
+
+    # Distinct (chunk, shingle) pairs sorted by shingle key.
+    chunk_keys = _keyed(chunk_question[chunk_text], chunk_hash)
+    _, first = np.unique(_keyed(chunk_text, chunk_hash), return_index=True)
+    order = np.argsort(chunk_keys[first], kind='stable')
+    sorted_keys = chunk_keys[first][order]
+    sorted_chunks = chunk_text[first][order]
+
+    # Distinct shingles of each retrieved text, expanded to every chunk holding them.
+    _, first = np.unique(_keyed(item_text, item_hash), return_index=True)
+    items = item_text[first]
+    keys = _keyed(item_question[items], item_hash[first])
+    lo = np.searchsorted(sorted_keys, keys, side='left')
+    hi = np.searchsorted(sorted_keys, keys, side='right')
+    counts = hi - lo
+    pair_item = np.repeat(items, counts)
+    pair_chunk = sorted_chunks[np.repeat(lo, counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)]
+
+    # Share of each text's shingles found in each chunk; keep the best chunk per text.
+    n_chunks = len(chunk_question)
+    pairs, hits = np.unique(pair_item * n_chunks + pair_chunk, return_counts=True)
+    pair_item, pair_chunk = pairs // n_chunks, pairs % n_chunks
+    share = hits / np.bincount(items, minlength=n_items)[pair_item]
+    keep = share >= threshold
+    pair_item, pair_chunk, share = pair_item[keep], pair_chunk[keep], share[keep]
+    order = np.lexsort((chunk_position[pair_chunk], -share, pair_item))
+    pair_item, pair_chunk = pair_item[order], pair_chunk[order]
+    leading = np.concatenate(([True], pair_item[1:] != pair_item[:-1])) if len(pair_item) else np.zeros(0, dtype=bool)
+    best[pair_item[leading]] = chunk_position[pair_chunk[leading]]
+    return best
+
+
+def score_records(records):
+    """Add the citation metrics to every record that has 'citations'; returns the records."""
+    scored = [record for record in records if 'citations' in record]
+    scores = score_citations([r['citations'] for r in scored], [r.get('relevant_chunks') or [] for r in scored])
+    for i, record in enumerate(scored):
+        record.update({metric: values[i].item() for metric, values in scores.items()})
+    return records
+
+
+if __name__ == "__main__":
+    for path in sys.argv[1:] or ['RetriverEval/citation_eval.jsonl']:
+        records = score_records(qna_io.load_records(path))
+        qna_io.write_records(path, records)
+        print(f"Rescored {sum('citations' in r for r in records)} of {len(records)} records in {path}")
@@ -0,0 +1,410 @@
+import itertools
+import os
+import re
+import sys
+import time
+import numpy as np
+import qna_io
+from citation_matching import shingles, tokenize
+
+"""
+Near-duplicate question detection and pruning.
+
+Questions are compared without looking at every pair. With the default
+'minhash' backend each question's word shingles (citation_matching.shingles)
+get a MinHash signature of DEDUP_PERMUTATIONS values, and the signatures are
+cut into DEDUP_BANDS bands: questions that agree on a whole band share an LSH
+bucket and become a candidate pair. The 'embedding' backend does the same with
+random-hyperplane signatures of the questions' vectors from the embedding index
+(embedding_index.py). Candidates are then checked exactly (Jaccard similarity of
+the shingle sets >= DEDUP_THRESHOLD, or cosine >= DEDUP_COSINE), so the cost is
+the signatures plus the candidates, not n^2.
+
+Two questions that differ in a number (a date, an amount, a clause) or a
+negation are never merged, however alike they read: "... ended September 30,
+2023?" and "... ended September 30, 2024?" ask for different facts.
+
+Accepted pairs are clustered with union-find. The first question of each
+cluster (in file and row order) is kept and the others are removed from their
+files; every removed record is written, with the question it duplicates and
+their similarity, to a report under Dedup/, so nothing is lost for good.
+
+`python dedup_questions.py [FILE ...] [--dry-run]` prunes the given files as one
+collection (default: the question bank, then every QnA/test_qna_* file as
+another); --dry-run only writes the report.
+
+Config (environment):
+DEDUP_BACKEND         'minhash' or 'embedding'                          (default minhash)
+DEDUP_THRESHOLD       Jaccard similarity of word shingles to merge at    (default 0.8)
+DEDUP_COSINE          Embedding cosine similarity to merge at            (default 0.95)
+DEDUP_NGRAM           Words per shingle                                  (default 1)
+DEDUP_PERMUTATIONS    MinHash signature length                           (default 120)
+DEDUP_BANDS           LSH bands the signature is cut into                (default 20)
+DEDUP_RECALL_SAMPLE   Questions compared pairwise by `recall`            (default 2000)
+
+With b bands of r values a pair of similarity s becomes a candidate with
+probability 1 - (1 - s^r)^b: for 20 bands of 6 that is 0.998 at 0.8 and 0.27 at
+0.5. More bands (or fewer permutations) catch more pairs below the threshold at
+the cost of more candidates to check. `python dedup_questions.py recall [FILE ...]`
+checks this on real questions: it computes the exact Jaccard similarity of every
+pair (of up to DEDUP_RECALL_SAMPLE questions) and reports the share of pairs at
+or above DEDUP_THRESHOLD that LSH made candidates, next to the expected share.
+"""
+
+DEDUP_BACKEND = os.getenv("DEDUP_BACKEND", "minhash")
+DEDUP_THRESHOLD = float(os.getenv("DEDUP_THRESHOLD", 0.8))
+DEDUP_COSINE = float(os.getenv("DEDUP_COSINE", 0.95))
+DEDUP_NGRAM = int(os.getenv("DEDUP_NGRAM", 1))
+DEDUP_PERMUTATIONS = int(os.getenv("DEDUP_PERMUTATIONS", 120))
+DEDUP_BANDS = int(os.getenv("DEDUP_BANDS", 20))
+DEDUP_RECALL_SAMPLE = int(os.getenv("DEDUP_RECALL_SAMPLE", 2000))
+# Random hyperplanes per band of the embedding backend's signatures.
+HYPERPLANE_BITS = 8
+REPORT_DIR = 'Dedup'
+BANK_NAME = 'questions_bank'
+# Tokens that change what a question asks even when the rest is the same.
+NEGATIONS = frozenset(['not', 'no', 'non', 'never', 'nor', 'without', 'except', 'excluding'])
+DIGIT = re.compile(r"\d")
+# MinHash permutations are (a * x + b) mod the Mersenne prime 2^61 - 1, a and b uniform in [1, p).
+MERSENNE = np.uint64((1 << 61) - 1)
+LOW_29 = np.uint64((1 << 29) - 1)
+LOW_32 = np.uint64(0xFFFFFFFF)
+PERMUTATION_BLOCK = 16
+# Candidate pairs checked at a time by jaccard.
+PAIR_BLOCK = 1 << 16
+SEED = 42
+
+
+def _distinct_shingles(texts, n):
+    """(text index, 32-bit shingle hash) arrays with each text's shingles once, sorted by text."""
+    index, hashes = shingles(texts, n)
+    hashes = (hashes ^ (hashes >> np.uint64(32))) & LOW_32
+    order = np.lexsort((hashes, index))
+    index, hashes = index[order], hashes[order]
+    keep = np.ones(len(index), dtype=bool)
+    keep[1:] = (index[1:] != index[:-1]) | (hashes[1:] != hashes[:-1])
+    return index[keep], hashes[keep]
+
+
+def _permute(a, b, x):
+    """
+    (a * x + b) mod 2^61 - 1 for a, b < 2^61 and 32-bit x, without overflowing
+    uint64: a is split into 32-bit halves and 2^61 = 1 folds the high bits back.
+    """
+    low = (a & LOW_32) * x
+    high = (a >> np.uint64(32)) * x
+    # high * 2^32 = (high >> 29) * 2^61 + (high & LOW_29) * 2^32
+    total = (high >> np.uint64(29)) + ((high & LOW_29) << np.uint64(32))
+    total += (low >> np.uint64(61)) + (low & MERSENNE) + b
+    return total % MERSENNE
+
+
+def minhash_signatures(index, hashes, count, permutations=DEDUP_PERMUTATIONS, seed=SEED):
+    """
+    MinHash signature of each of `count` texts from their (text index, hash)
+    shingle arrays, computed PERMUTATION_BLOCK permutations at a time to bound
+    memory. Texts without shingles get all-max signatures; leave them out.
+
+    Returns:
+        np.ndarray: (count, permutations) uint64 signatures
+    """
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, MERSENNE, size=permutations, dtype=np.uint64)
+    b = rng.integers(1, MERSENNE, size=permutations, dtype=np.uint64)
+    counts = np.bincount(index, minlength=count)
+    present = np.nonzero(counts)[0]
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))[present]
+    signatures = np.full((count, permutations), np.iinfo(np.uint64).max, dtype=np.uint64)
+    if len(hashes) == 0:
+        return signatures
+    for block in range(0, permutations, PERMUTATION_BLOCK):
+        columns = slice(block, block + PERMUTATION_BLOCK)
+        permuted = _permute(a[columns, None], b[columns, None], hashes[None, :])
+        signatures[present, columns] = np.minimum.reduceat(permuted, starts, axis=1).T
+    return signatures
+
+
+def hyperplane_signatures(vectors, bands=DEDUP_BANDS, bits=HYPERPLANE_BITS, seed=SEED):
+    """Sign bits of each vector against bands * bits random hyperplanes, as a (len, bands * bits) uint8 array."""
+    rng = np.random.default_rng(seed)
+    planes = rng.standard_normal((vectors.shape[1], bands * bits)).astype(np.float32)
+    return (vectors @ planes > 0).astype(np.uint8)
+
+
+def candidate_pairs(signatures, bands=DEDUP_BANDS):
+    """
+    (i, j) pairs, i < j, of rows that agree on at least one whole band of their
+    signatures: the LSH buckets.
+
+    Returns:
+        np.ndarray: (pairs, 2) int64, sorted and without repeats
+    """
+    rows = signatures.shape[1] // bands
+    pairs = []
+    for band in range(bands):
+        columns = np.ascontiguousarray(signatures[:, band * rows:(band + 1) * rows])
+        keys = columns.view(np.dtype((np.void, columns.dtype.itemsize * rows))).ravel()
+        _, bucket, sizes = np.unique(keys, return_inverse=True, return_counts=True)
+        shared = np.nonzero(sizes[bucket] > 1)[0]
+        if len(shared) == 0:
+            continue
+        shared = shared[np.argsort(bucket[shared], kind='stable')]
+        for _, members in itertools.groupby(shared.tolist(), key=bucket.__getitem__):
+            pairs.extend(itertools.combinations(members, 2))
+    if not pairs:
+        return np.zeros((0, 2), dtype=np.int64)
+    # One int64 per pair makes removing the pairs found by several bands a flat sort.
+    count = np.int64(len(signatures))
+    codes = np.unique(np.asarray(pairs, dtype=np.int64) @ np.array([count, 1], dtype=np.int64))
+    return np.stack([codes // count, codes % count], axis=1)
+
+
+def jaccard(index, hashes, count, pairs):
+    """Exact Jaccard similarity of the shingle sets of each pair, from sorted distinct (text index, hash) arrays."""
+    counts = np.bincount(index, minlength=count)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    return np.concatenate([np.zeros(0)] + [
+        _jaccard_block(hashes, counts, starts, pairs[block:block + PAIR_BLOCK])
+        for block in range(0, len(pairs), PAIR_BLOCK)
+    ])
+
+
+def _jaccard_block(hashes, counts, starts, pairs):
+    owners, positions = [], []
+    for side in (pairs[:, 0], pairs[:, 1]):
+        lengths = counts[side]
+        offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        owners.append(np.repeat(np.arange(len(pairs)), lengths))
+        positions.append(np.repeat(starts[side], lengths) + offsets)
+    owner = np.concatenate(owners)
+    values = hashes[np.concatenate(positions)]
+    order = np.lexsort((values, owner))
+    owner, values = owner[order], values[order]
+    # Each set holds a shingle once, so a repeat within a pair is a shared shingle.
+    shared = (owner[1:] == owner[:-1]) & (values[1:] == values[:-1])
+    intersection = np.bincount(owner[1:][shared], minlength=len(pairs))
+    union = counts[pairs[:, 0]] + counts[pairs[:, 1]] - intersection
+    return np.divide(intersection, union, out=np.zeros(len(pairs)), where=union > 0)
+
+
+def _key_tokens(text):
+    return frozenset(token for token in tokenize(text) if token in NEGATIONS or DIGIT.search(token))
+
+
+def _clusters(count, pairs):
+    """Union-find over `pairs`; root[i] is the first (lowest) index of i's cluster."""
+    parent = list(range(count))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for i, j in pairs:
+        root_i, root_j = find(i), find(j)
+        if root_i != root_j:
+            # The lower index becomes the root, so the kept question is the first one.
+            parent[max(root_i, root_j)] = min(root_i, root_j)
+    return np.fromiter((find(i) for i in range(count)), dtype=np.int64, count=count)
+
+
+def _minhash_pairs(texts):
+    index, hashes = _distinct_shingles(texts, DEDUP_NGRAM)
+    candidates = candidate_pairs(minhash_signatures(index, hashes, len(texts)), DEDUP_BANDS)
+
+    def similarity(pairs):
+        return jaccard(index, hashes, len(texts), pairs)
+
+    return candidates, similarity(candidates), similarity
+
+
+def _embedding_pairs(texts):
+    import embedding_index
+
+    index = embedding_index.get_index()
+    index.add(texts)
+    vectors = index.vectors(texts)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    candidates = candidate_pairs(hyperplane_signatures(vectors), DEDUP_BANDS)
+
+    def similarity(pairs):
+        return np.einsum('ij,ij->i', vectors[pairs[:, 0]], vectors[pairs[:, 1]]).astype(np.float64)
+
+    return candidates, similarity(candidates), similarity
+
+
+def find_duplicates(texts, backend=DEDUP_BACKEND, threshold=None):
+    """
+    Cluster near-duplicate texts.
+
+    Identical texts (after normalization) are merged outright; the distinct ones
+    go through the LSH backend, and a candidate pair is merged when its exact
+    similarity reaches `threshold` and the two have the same numbers and
+    negations. Texts without words are left alone.
+
+    Args:
+        texts (list): Question texts
+        backend (str): 'minhash' or 'embedding'
+        threshold (float): Similarity to merge at (DEDUP_THRESHOLD or DEDUP_COSINE by default)
+
+    Returns:
+        tuple: (kept, similarity) arrays; kept[i] is the index of the text kept
+            for text i (i itself when it is kept) and similarity[i] is text i's
+            similarity to it
+    """
+    if backend not in ('minhash', 'embedding'):
+        raise ValueError(f"Unknown DEDUP_BACKEND {backend}; use 'minhash' or 'embedding'")
+    if threshold is None:
+        threshold = DEDUP_THRESHOLD if backend == 'minhash' else DEDUP_COSINE
+    normalized = [' '.join(tokenize(text)) for text in texts]
+    first = np.arange(len(texts))
+    distinct = {}
+    for i, text in enumerate(normalized):
+        if text:
+            first[i] = distinct.setdefault(text, i)
+    unique = np.fromiter(distinct.values(), dtype=np.int64, count=len(distinct))
+    unique_texts = [texts[i] for i in unique]
+
+    kept = np.arange(len(texts))
+    similarity = np.ones(len(texts))
+    if len(unique) == 0:
+        return kept, similarity
+    pairs_of = _minhash_pairs if backend == 'minhash' else _embedding_pairs
+    candidates, values, pair_similarity = pairs_of(unique_texts)
+    keys = [_key_tokens(text) for text in unique_texts]
+    accepted = [(i, j) for (i, j), value in zip(candidates.tolist(), values.tolist())
+                if value >= threshold and keys[i] == keys[j]]
+    roots = _clusters(len(unique), accepted)
+
+    words = np.fromiter((bool(text) for text in normalized), dtype=bool, count=len(texts))
+    kept[words] = unique[roots[np.searchsorted(unique, first[words])]]
+    # Identical texts keep similarity 1; the rest are compared with the text kept for them.
+    moved = np.nonzero(kept != np.arange(len(texts)))[0]
+    by_text = np.searchsorted(unique, first[moved])
+    by_kept = np.searchsorted(unique, kept[moved])
+    different = by_text != by_kept
+    similarity[moved[different]] = pair_similarity(np.stack([by_text[different], by_kept[different]], axis=1))
+    return kept, similarity
+
+
+def lsh_recall(texts, threshold=None, sample=DEDUP_RECALL_SAMPLE, seed=SEED):
+    """
+    Check the MinHash LSH against brute force on (up to `sample` of) the
+    distinct `texts`: the exact Jaccard similarity of every pair, and which of
+    the pairs at or above `threshold` became candidates.
+
+    Returns:
+        dict: 'questions' compared, 'pairs' at or above the threshold, 'found'
+            by LSH, 'recall', 'expected' recall (mean of 1 - (1 - s^r)^b over
+            those pairs) and 'agreement_error', the mean absolute difference
+            between their signature agreement and Jaccard similarity
+    """
+    threshold = DEDUP_THRESHOLD if threshold is None else threshold
+    texts = list({' '.join(tokenize(text)): text for text in texts if tokenize(text)}.values())
+    if len(texts) > sample:
+        texts = [texts[i] for i in np.sort(np.random.default_rng(seed).choice(len(texts), sample, replace=False))]
+    index, hashes = _distinct_shingles(texts, DEDUP_NGRAM)
+    signatures = minhash_signatures(index, hashes, len(texts))
+    pairs = np.stack(np.triu_indices(len(texts), 1), axis=1).astype(np.int64)
+    similar = pairs[jaccard(index, hashes, len(texts), pairs) >= threshold]
+    similarity = jaccard(index, hashes, len(texts), similar)
+    count = np.int64(len(texts))
+    candidates = candidate_pairs(signatures, DEDUP_BANDS) @ np.array([count, 1], dtype=np.int64)
+    found = np.isin(similar @ np.array([count, 1], dtype=np.int64), candidates)
+    rows = DEDUP_PERMUTATIONS // DEDUP_BANDS
+    agreement = (signatures[similar[:, 0]] == signatures[similar[:, 1]]).mean(axis=1)
+    return {
+        'questions': len(texts), 'pairs': len(similar), 'found': int(found.sum()),
+        'recall': found.mean() if len(similar) else float('nan'),
+        'expected': (1 - (1 - similarity ** rows) ** DEDUP_BANDS).mean() if len(similar) else float('nan'),
+        'agreement_error': np.abs(agreement - similarity).mean() if len(similar) else float('nan'),
+    }
+
+
+def dedup_files(paths, dry_run=False, backend=DEDUP_BACKEND, threshold=None):
+    """
+    Remove the near-duplicate questions of `paths`, taken together as one
+    collection, keeping the first question of each cluster, and write a report
+    of every removed record.
+
+    Args:
+        paths (list): Record files with a 'question' field, in priority order
+        dry_run (bool): Only write the report, leaving the files unchanged
+        backend (str): 'minhash' or 'embedding'
+        threshold (float): Similarity to merge at
+
+    Returns:
+        list: Report entries, one per removed record
+    """
+    locations = []
+    texts = []
+    for path in paths:
+        for row, record in enumerate(qna_io.read_records(path)):
+            locations.append((path, row))
+            texts.append(record.get('question') or '')
+    kept, similarity = find_duplicates(texts, backend, threshold)
+
+    removed = {}
+    for i in np.nonzero(kept != np.arange(len(texts)))[0].tolist():
+        removed.setdefault(locations[i][0], {})[locations[i][1]] = i
+    report = []
+    for path in paths:
+        rows = removed.get(path, {})
+        if not rows:
+            continue
+        writer = None if dry_run else qna_io.RecordWriter(path)
+        try:
+            for row, record in enumerate(qna_io.read_records(path)):
+                i = rows.get(row)
+                if i is None:
+                    if writer is not None:
+                        writer.write(record)
+                    continue
+                kept_path, kept_row = locations[kept[i]]
+                report.append({
+                    'file': path, 'row': row, 'question': texts[i], 'kept_file': kept_path, 'kept_row': kept_row,
+                    'kept_question': texts[kept[i]], 'similarity': float(similarity[i]), 'record': record,
+                })
+        except BaseException:
+            if writer is not None:
+                writer.abort()
+            raise
+        if writer is not None:
+            writer.close()
+
+    clusters = len({(entry['kept_file'], entry['kept_row']) for entry in report})
+    action = 'would remove' if dry_run else 'removed'
+    print(f"{len(texts)} questions in {len(paths)} files: {len(report)} near-duplicates in {clusters} clusters "
+          f"{action} ({backend})")
+    if report:
+        os.makedirs(REPORT_DIR, exist_ok=True)
+        label = qna_io.stem(os.path.basename(paths[0])) if len(paths) == 1 else 'collection'
+        report_path = os.path.join(REPORT_DIR, f"dedup_{label}_{time.strftime('%Y%m%dT%H%M%S')}.jsonl")
+        qna_io.write_records(report_path, report)
+        print(f"Report written to {report_path}")
+    return report
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == 'recall':
+        # python dedup_questions.py recall [FILE ...]
+        paths = sys.argv[2:] or [path for path in [qna_io.find_file(BANK_NAME)] if path] + \
+            qna_io.list_files('QnA', 'test_qna')
+        texts = [record.get('question') or '' for path in paths for record in qna_io.read_records(path)]
+        result = lsh_recall(texts)
+        print(f"{result['questions']} distinct questions, {result['pairs']} pairs with Jaccard >= {DEDUP_THRESHOLD}: "
+              f"{result['found']} found by LSH, recall {result['recall']:.3f} (expected {result['expected']:.3f}); "
+              f"signature agreement off Jaccard by {result['agreement_error']:.3f} on average")
+        sys.exit(0)
+    dry_run = '--dry-run' in sys.argv[1:]
+    files = [arg for arg in sys.argv[1:] if arg != '--dry-run']
+    if files:
+        collections = [files]
+    else:
+        bank = qna_io.find_file(BANK_NAME)
+        collections = [[bank]] if bank else []
+        collections.append(qna_io.list_files('QnA', 'test_qna'))
+    for paths in collections:
+        if paths:
+            dedup_files(paths, dry_run)
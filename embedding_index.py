@@ -0,0 +1,137 @@
+import hashlib
+import json
+import os
+import numpy as np
+
+"""
+Local embedding index for semantic similarity.
+
+Vectors live in a memory-mapped float32 file, one row per distinct text, with a
+sidecar file of text hashes giving the row order. Texts not yet in the index
+are embedded in large batches and appended; similarity over a whole run is then
+one vectorized cosine pass, so repeated texts (e.g. the many identical "not
+present in context" ground truths) are embedded exactly once.
+
+Files, under EMBEDDING_INDEX (default .embedding_index/), per embedding model:
+<model>.f32    float32 vectors, row-major
+<model>.keys   sha256 of each row's text, one per line
+<model>.json   {"dim": ...}
+
+Config (environment):
+EMBEDDING_INDEX        Directory of the index               (default .embedding_index)
+EMBEDDING_BATCH_SIZE   Texts per embedding request          (default 512)
+"""
+
+EMBEDDING_INDEX_DIR = os.getenv("EMBEDDING_INDEX", ".embedding_index")
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", 512))
+
+
+def text_key(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def _clean(text):
+    # Same as ragas: empty strings are embedded as a single space.
+    return text or " "
+
+
+class EmbeddingIndex:
+    def __init__(self, embeddings=None, path=EMBEDDING_INDEX_DIR, namespace=None, batch_size=EMBEDDING_BATCH_SIZE):
+        if embeddings is None:
+            from langchain_openai import OpenAIEmbeddings
+            import rate_limiter
+            # The model ragas uses for answer_similarity by default.
+            embeddings = OpenAIEmbeddings(**rate_limiter.embeddings_kwargs())
+        self.embeddings = embeddings
+        self.batch_size = batch_size
+        namespace = namespace or getattr(embeddings, 'model', None) or type(embeddings).__name__
+        os.makedirs(path, exist_ok=True)
+        base = os.path.join(path, namespace.replace('/', '_'))
+        self._vectors_path = base + '.f32'
+        self._keys_path = base + '.keys'
+        self._meta_path = base + '.json'
+        self._load()
+
+    def _load(self):
+        self.dim = None
+        if os.path.exists(self._meta_path):
+            with open(self._meta_path, 'r') as f:
+                self.dim = json.load(f)['dim']
+        self._rows = {}
+        if os.path.exists(self._keys_path):
+            with open(self._keys_path, 'r') as f:
+                for row, line in enumerate(f):
+                    self._rows[line.strip()] = row
+        self._vectors = None
+        if self.dim and self._rows:
+            # Vectors are written before their keys, so drop any tail left by a crash.
+            expected = len(self._rows) * self.dim * 4
+            if os.path.getsize(self._vectors_path) > expected:
+                with open(self._vectors_path, 'r+b') as f:
+                    f.truncate(expected)
+            self._vectors = np.memmap(self._vectors_path, dtype=np.float32, mode='r', shape=(len(self._rows), self.dim))
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __contains__(self, text):
+        return text_key(_clean(text)) in self._rows
+
+    def add(self, texts):
+        """Embed and append every text not already in the index. Returns how many were added."""
+        missing = {}
+        for text in texts:
+            text = _clean(text)
+            key = text_key(text)
+            if key not in self._rows and key not in missing:
+                missing[key] = text
+        if not missing:
+            return 0
+
+        items = list(missing.items())
+        for start in range(0, len(items), self.batch_size):
+            batch = items[start:start + self.batch_size]
+            vectors = np.asarray(self.embeddings.embed_documents([text for _, text in batch]), dtype=np.float32)
+            if self.dim is None:
+                self.dim = vectors.shape[1]
+                with open(self._meta_path, 'w') as f:
+                    json.dump({'dim': self.dim}, f)
+            with open(self._vectors_path, 'ab') as f:
+                f.write(vectors.tobytes())
+            with open(self._keys_path, 'a') as f:
+                f.write(''.join(key + '\n' for key, _ in batch))
+            print(f"Embedded {min(start + self.batch_size, len(items))}/{len(items)} new texts")
+        self._load()
+        return len(items)
+
+    def vectors(self, texts):
+        """Matrix of the embeddings of `texts` (which must already be in the index), one row each."""
+        rows = np.fromiter((self._rows[text_key(_clean(text))] for text in texts), dtype=np.int64, count=len(texts))
+        return np.asarray(self._vectors[rows])
+
+    def similarities(self, texts_a, texts_b):
+        """
+        Cosine similarity of each pair (texts_a[i], texts_b[i]) in one vectorized
+        pass, embedding any texts the index has not seen yet.
+
+        Returns:
+            np.ndarray: One similarity per pair
+        """
+        if len(texts_a) == 0:
+            return np.zeros(0, dtype=np.float32)
+        self.add(list(texts_a) + list(texts_b))
+        a = self.vectors(texts_a)
+        b = self.vectors(texts_b)
+        a /= np.linalg.norm(a, axis=1, keepdims=True)
+        b /= np.linalg.norm(b, axis=1, keepdims=True)
+        return np.einsum('ij,ij->i', a, b)
+
+
+_index = None
+
+
+def get_index():
+    global _index
+    if _index is None:
+        _index = EmbeddingIndex()
+    return _index
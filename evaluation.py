@@ -3,9 +3,23 @@ import os
 from ragas import EvaluationDataset
 from ragas import evaluate
 from ragas.llms import LangchainLLMWrapper
+from ragas.run_config import RunConfig
+from ragas.embeddings import LangchainEmbeddingsWrapper
 from ragas.metrics import  answer_correctness, answer_relevancy, answer_similarity
 from langchain_community.chat_models import ChatOpenAI
+import copy
 import json
+import hashlib
+import itertools
+import numpy as np
+import openai
+import llm_cache
+import rate_limiter
+import token_usage
+import embedding_index
+import cascade
+import qna_io
+import results_store
 
 """
 Metric	            Compares To 	Uses Embedding or LLM?	 What It Checks
@@ -15,7 +29,53 @@ answer_relevance	query	        LLM                    	 Does the generated answe
 """
 
 
-llm = ChatOpenAI(model="gpt-4o-mini")
+# Judge calls and embeddings are replayed from the disk cache when their inputs are unchanged.
+llm_cache.enable()
+# Calls are admitted by the shared OpenAI rate-limit scheduler (rate_limiter.py).
+llm = ChatOpenAI(model="gpt-4o-mini", **rate_limiter.chat_model_kwargs())
+evaluator_llm = LangchainLLMWrapper(llm)
+embeddings = LangchainEmbeddingsWrapper(llm_cache.cached_embeddings())
+
+METRICS = [answer_relevancy, answer_correctness, answer_similarity]
+# 'index' computes semantic_similarity from the local embedding index in one
+# vectorized pass; 'ragas' leaves it to answer_similarity inside evaluate().
+SIMILARITY_BACKEND = os.getenv("SIMILARITY_BACKEND", "index")
+# Decide what cheap signals can (see cascade.py) and judge only the rest.
+EVAL_CASCADE = os.getenv("EVAL_CASCADE", "true").lower() == "true"
+# Rows are scored by one evaluate() call per file ('file') or across every pending file ('all').
+EVAL_BATCH = os.getenv("EVAL_BATCH", "file")
+# Rows per evaluate() call; every row is checkpointed once its chunk is scored.
+EVAL_CHECKPOINT_ROWS = int(os.getenv("EVAL_CHECKPOINT_ROWS", 32))
+RESULTS_BATCH_ROWS = 500
+SCORED_METRICS = ('answer_relevancy', 'answer_correctness', 'semantic_similarity')
+# What evaluation adds to a file_ans record; 'decided_by' only with EVAL_CASCADE.
+SCORE_FIELDS = SCORED_METRICS + ('decided_by',)
+RUN_CONFIG = RunConfig(
+    max_workers=int(os.getenv("EVAL_MAX_WORKERS", 16)),
+    timeout=int(os.getenv("EVAL_TIMEOUT", 180)),
+    max_retries=int(os.getenv("EVAL_MAX_RETRIES", 10)),
+    # Transient failures only; a call refused by the token budget is not retried.
+    exception_types=(openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError),
+)
+
+
+def _sample(q_n_a):
+    return {
+        "user_input": q_n_a.get('question', ''),
+        "response": q_n_a.get('response', ''),
+        "reference": q_n_a.get('ground_truth', '')
+    }
+
+
+def _row_scores(scores):
+    # Older ragas releases name the answer_similarity column 'semantic_similarity'.
+    similarity = scores.get('semantic_similarity', scores.get('answer_similarity'))
+    # Stored as one-element lists, the shape a single-row evaluate() result has always had.
+    return {
+        'answer_relevancy': [scores.get('answer_relevancy')],
+        'answer_correctness': [scores.get('answer_correctness')],
+        'semantic_similarity': [similarity],
+    }
 
 
 def evaluate_rags(question, ai_response, ground_truth, contextList=None):
@@ -25,28 +85,310 @@ def evaluate_rags(question, ai_response, ground_truth, contextList=None):
         "response": ai_response,
         "reference": ground_truth
     }
-    evaluator_llm = LangchainLLMWrapper(llm)
     evaluationDataset = EvaluationDataset.from_list([dataset])
-    result = evaluate(dataset=evaluationDataset, metrics=[answer_relevancy, answer_correctness, answer_similarity],llm=evaluator_llm)
+    result = evaluate(dataset=evaluationDataset, metrics=METRICS, llm=evaluator_llm, embeddings=embeddings)
     return result
 
+
+def _tag_calls(metric):
+    """A copy of the ragas `metric` whose OpenAI calls are accounted to it and to the row's question."""
+    tagged = copy.copy(metric)
+    score = tagged.single_turn_ascore
+
+    async def single_turn_ascore(sample, *args, **kwargs):
+        with token_usage.tagged(metric=metric.name, question_hash=results_store.question_hash(sample.user_input)):
+            return await score(sample, *args, **kwargs)
+
+    tagged.single_turn_ascore = single_turn_ascore
+    return tagged
+
+
+def _judge(q_n_a_s, metrics, run_config):
+    """ragas evaluate() over `q_n_a_s` with `metrics`; one score dict per record."""
+    if not q_n_a_s or not metrics:
+        return [{} for _ in q_n_a_s]
+    evaluationDataset = EvaluationDataset.from_list([_sample(q_n_a) for q_n_a in q_n_a_s])
+    result = evaluate(
+        dataset=evaluationDataset,
+        metrics=[_tag_calls(metric) for metric in metrics],
+        llm=evaluator_llm,
+        embeddings=embeddings,
+        run_config=run_config
+    )
+    return result.scores
+
+
+def evaluate_batch(q_n_a_s, run_config=RUN_CONFIG):
+    """
+    Score many QnA records, sending each one to the ragas judge only for the
+    metrics the cheap cascade could not decide.
+
+    Args:
+        q_n_a_s (list): Records with 'question', 'response' and 'ground_truth'
+        run_config (RunConfig): Worker count, timeout and retries for ragas
+
+    Returns:
+        list: One dict of metric -> [score] per record, in the same order
+    """
+    if not q_n_a_s:
+        return []
+    judged = METRICS
+    if SIMILARITY_BACKEND == 'index':
+        judged = [metric for metric in METRICS if metric is not answer_similarity]
+    similarity = None
+    if SIMILARITY_BACKEND == 'index' or EVAL_CASCADE:
+        similarity = semantic_similarity(q_n_a_s)
+
+    n = len(q_n_a_s)
+    if EVAL_CASCADE:
+        values, tiers = cascade.decide(cascade.cheap_signals(q_n_a_s, similarity))
+    else:
+        values = {metric: np.full(n, np.nan) for metric in cascade.JUDGED_METRICS}
+        tiers = {metric: np.full(n, 'judge', dtype=object) for metric in cascade.JUDGED_METRICS}
+
+    # Rows that still need the same judge metrics share one evaluate() call.
+    groups = {}
+    for i in range(n):
+        needed = tuple(
+            metric.name for metric in judged
+            if metric.name not in values or np.isnan(values[metric.name][i])
+        )
+        groups.setdefault(needed, []).append(i)
+    scores = [{} for _ in q_n_a_s]
+    for needed, indices in groups.items():
+        metrics = [metric for metric in judged if metric.name in needed]
+        for i, row_scores in zip(indices, _judge([q_n_a_s[i] for i in indices], metrics, run_config)):
+            scores[i] = dict(row_scores)
+
+    rows = []
+    for i, row_scores in enumerate(scores):
+        for metric in cascade.JUDGED_METRICS:
+            if not np.isnan(values[metric][i]):
+                row_scores[metric] = float(values[metric][i])
+        if SIMILARITY_BACKEND == 'index':
+            row_scores['semantic_similarity'] = float(similarity[i])
+        row = _row_scores(row_scores)
+        if EVAL_CASCADE:
+            row['decided_by'] = {metric: str(tiers[metric][i]) for metric in cascade.JUDGED_METRICS}
+        rows.append(row)
+    return rows
+
+
+def semantic_similarity(q_n_a_s):
+    """Cosine similarity of every response to its ground truth, as one array."""
+    with token_usage.tagged(metric='semantic_similarity'):
+        return embedding_index.get_index().similarities(
+            [q_n_a.get('response', '') for q_n_a in q_n_a_s],
+            [q_n_a.get('ground_truth', '') for q_n_a in q_n_a_s]
+        )
+
+
+def checkpoint_path(dst):
+    return qna_io.stem(dst) + '.log.jsonl'
+
+
+def _question_hash(q_n_a):
+    return hashlib.sha256(json.dumps(_sample(q_n_a), sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def _complete(metrics):
+    return all(
+        value and value[0] is not None and not np.isnan(value[0])
+        for metric, value in metrics.items() if metric in SCORED_METRICS
+    )
+
+
+def load_checkpoint(path, complete_only=True):
+    """
+    Entries already logged at `path`, as row index -> (question hash, metrics).
+    Unless `complete_only` is False, entries with missing or NaN scores are left
+    out so those rows are evaluated again. A later entry for the same row
+    replaces an earlier one.
+    """
+    done = {}
+    if not os.path.exists(path):
+        return done
+    for entry in qna_io.read_records(path):
+        index = entry.pop('index')
+        question_hash = entry.pop('question_hash')
+        if not complete_only or _complete(entry):
+            done[index] = (question_hash, entry)
+    return done
+
+
+def append_checkpoint(f, index, q_n_a, metrics):
+    qna_io.append_record(f, {'index': index, 'question_hash': _question_hash(q_n_a), **metrics})
+    f.flush()
+    os.fsync(f.fileno())
+
+
+def scored_rows(paths):
+    """
+    Question hash -> metrics of every completely scored row in the given
+    file_eval files, for seed_checkpoint.
+    """
+    scored = {}
+    for path in paths:
+        for q_n_a in qna_io.read_records(path):
+            metrics = {field: q_n_a[field] for field in SCORE_FIELDS if field in q_n_a}
+            if all(metric in metrics for metric in SCORED_METRICS) and _complete(metrics):
+                scored[_question_hash(q_n_a)] = metrics
+    return scored
+
+
+def seed_checkpoint(src, dst, scored):
+    """
+    Log the earlier scores in `scored` (see scored_rows) for the rows of `src`
+    whose question, response and ground truth are unchanged, so that
+    evaluate_files only scores the rows that did change.
+
+    Returns:
+        int: Number of rows seeded
+    """
+    path = checkpoint_path(dst)
+    logged = load_checkpoint(path)
+    seeded = 0
+    with open(path, 'a') as f:
+        for i, q_n_a in enumerate(qna_io.read_records(src)):
+            metrics = scored.get(_question_hash(q_n_a))
+            if metrics is None or i in logged:
+                continue
+            qna_io.append_record(f, {'index': i, 'question_hash': _question_hash(q_n_a), **metrics})
+            seeded += 1
+        f.flush()
+        os.fsync(f.fileno())
+    return seeded
+
+
+def _pending_rows(files, checkpoints):
+    """(file number, row index, record) of every row not already in its file's checkpoint, streamed."""
+    for n, (src, dst) in enumerate(files):
+        logged = checkpoints[n]
+        resumed = 0
+        for i, q_n_a in enumerate(qna_io.read_records(src)):
+            entry = logged.pop(i, None)
+            if entry is not None and entry[0] == _question_hash(q_n_a):
+                resumed += 1
+                continue
+            yield n, i, q_n_a
+        if resumed:
+            print(f"Resuming {src}: {resumed} rows already evaluated")
+
+
+def _result_file(dst):
+    return qna_io.stem(os.path.basename(dst))
+
+
+def evaluate_files(files, run_id=None):
+    """
+    Evaluate every row of the given files and write each file's rows, with
+    their metrics, to its destination.
+
+    Rows are streamed from the sources and scored EVAL_CHECKPOINT_ROWS at a
+    time; each row's metrics are appended to a per-file log as soon as its
+    chunk is scored. A run that dies part way resumes from the log, and the
+    final file is built by streaming the source again and merging in the log.
+
+    Scores are also recorded in the results store under `run_id` as each
+    chunk finishes, and every row of a completed file once more at the end
+    (rows resumed from the log included).
+
+    The OpenAI calls of each chunk are accounted to the run, file, metric and
+    question (see token_usage.py). Once the token budget is reached no further
+    chunk is started: the logs are kept, so a later run resumes from them.
+
+    Args:
+        files (list): (file_ans path, file_eval path) pairs
+        run_id (str): Results store run, a new one is started if None
+
+    Raises:
+        token_usage.BudgetExceeded: If the token budget stopped the evaluation
+    """
+    store = results_store.get_store()
+    run_id = store.start_run('evaluation', run_id)
+    ledger = token_usage.get_ledger()
+    checkpoints = [load_checkpoint(checkpoint_path(dst)) for _, dst in files]
+    logs = [open(checkpoint_path(dst), 'a') for _, dst in files]
+    pending = _pending_rows(files, checkpoints)
+    evaluated = 0
+    try:
+        while True:
+            chunk = list(itertools.islice(pending, EVAL_CHECKPOINT_ROWS))
+            if not chunk:
+                break
+            ledger.check('evaluation')
+            numbers = {n for n, _, _ in chunk}
+            file = _result_file(files[numbers.pop()][1]) if len(numbers) == 1 else None
+            try:
+                with token_usage.tagged(run_id=run_id, stage='evaluation', file=file):
+                    scores = evaluate_batch([q_n_a for _, _, q_n_a in chunk])
+            except Exception:
+                # A call the budget refused surfaces as whatever error its caller raised.
+                ledger.check('evaluation')
+                raise
+            scored = {}
+            for (n, i, q_n_a), metrics in zip(chunk, scores):
+                append_checkpoint(logs[n], i, q_n_a, metrics)
+                scored.setdefault(n, []).append((i, {**q_n_a, **metrics}))
+            for n, rows in scored.items():
+                store.put_rows(run_id, 'evaluation', _result_file(files[n][1]), rows)
+            evaluated += len(chunk)
+            print(f"Evaluated {evaluated} rows")
+    except token_usage.BudgetExceeded:
+        for log in logs:
+            log.close()
+        raise
+
+    decided = []
+    for (src, dst), log in zip(files, logs):
+        log.close()
+        # Every row now has an entry; rows that still failed keep their NaN scores.
+        done = load_checkpoint(checkpoint_path(dst), complete_only=False)
+
+        def merged():
+            for i, q_n_a in enumerate(qna_io.read_records(src)):
+                q_n_a.update(done[i][1])
+                if 'decided_by' in q_n_a:
+                    decided.append(q_n_a['decided_by'])
+                yield q_n_a
+
+        rows = []
+        with qna_io.RecordWriter(dst) as writer:
+            for i, q_n_a in enumerate(merged()):
+                writer.write(q_n_a)
+                rows.append((i, q_n_a))
+                if len(rows) >= RESULTS_BATCH_ROWS:
+                    store.put_rows(run_id, 'evaluation', _result_file(dst), rows)
+                    rows = []
+        store.put_rows(run_id, 'evaluation', _result_file(dst), rows)
+        os.remove(checkpoint_path(dst))
+
+    if EVAL_CASCADE:
+        cascade.print_tier_report({
+            metric: np.array([d[metric] for d in decided], dtype=object) for metric in cascade.JUDGED_METRICS
+        })
+
+
 if __name__ == "__main__":
-    for file in os.listdir('QnA'):
-        file2 = file.replace('ans', 'eval')
-        if not file.endswith('.json') or not file.startswith('file_ans') or os.path.exists(f'QnA/{file2}'):
+    files = []
+    for file in qna_io.list_files('QnA', 'file_ans'):
+        name = qna_io.stem(file).replace('file_ans', 'file_eval')
+        if qna_io.find_file(name):
             continue
+        files.append((file, name + '.jsonl'))
 
-        print("Processing file: ", file)
-        with open(f'QnA/{file}', 'r') as f:
-            q_n_a_s = json.loads(f.read())
-            for q_n_a in q_n_a_s:
-                question = q_n_a.get('question', '')
-                ai_response = q_n_a.get('response', '')
-                ground_truth = q_n_a.get('ground_truth', '')
-                result = evaluate_rags(question, ai_response, ground_truth)
-                print(result)
-                q_n_a['answer_relevancy'] = result['answer_relevancy']
-                q_n_a['answer_correctness'] = result['answer_correctness']
-                q_n_a['semantic_similarity'] = result['semantic_similarity']
-            with open(f'QnA/{file2}', 'w') as f2:
-                f2.write(json.dumps(q_n_a_s))
\ No newline at end of file
+    run_id = results_store.get_store().start_run('evaluation')
+    print(f"Recording results as run {run_id}")
+    try:
+        if EVAL_BATCH == 'all':
+            print(f"Processing {len(files)} files in one batch")
+            evaluate_files(files, run_id)
+        else:
+            for src, dst in files:
+                print("Processing file: ", src)
+                evaluate_files([(src, dst)], run_id)
+    except token_usage.BudgetExceeded as e:
+        print(f"{e}; re-run to evaluate the remaining rows")
+    llm_cache.print_stats()
+    rate_limiter.print_stats()
+    token_usage.print_summary()
@@ -1,13 +1,16 @@
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain.prompts import PromptTemplate
 from langchain.chat_models import ChatOpenAI
+import asyncio
 import json
 import os
-import requests
 from dotenv import load_dotenv
-
-X_API_KEY = "d31fc0b9-95fb-465d-a08b-e2cd53500503"
-X_API_SECRET="XDarrFdrMedvjtc9CB/3aKEteW3mNtavsJYoPyFziic="
+import qna_io
+import llm_cache
+import rate_limiter
+import token_usage
+import dedup_questions
+from chunk_store import ChunkStore, export_chunks
 
 # Define the prompt template for question generation
 QUESTION_GENERATION_TEMPLATE = """
@@ -39,6 +42,71 @@ Ensure each question is:
 IMPORTANT: Return ONLY the JSON array, no additional text or explanation.
 """
 
+# Pages sent to the LLM at once by generate_question_bank; rate_limiter.py may admit fewer.
+GENERATION_CONCURRENCY = int(os.getenv("GENERATION_CONCURRENCY", 8))
+# Rounds of generate_question_bank: pages whose call failed are sent again in the next one.
+GENERATION_ATTEMPTS = int(os.getenv("GENERATION_ATTEMPTS", 3))
+# Prune near-duplicate questions from a freshly generated bank (see dedup_questions.py).
+GENERATION_DEDUP = os.getenv("GENERATION_DEDUP", "true").lower() == "true"
+
+_chain = None
+
+
+def get_chain():
+    """The prompt | llm chain, built once and shared by every page."""
+    global _chain
+    if _chain is None:
+        # Load environment variables
+        load_dotenv()
+        # Replay unchanged pages from the disk cache instead of calling OpenAI again.
+        llm_cache.enable()
+
+        # Initialize LLM
+        llm = ChatOpenAI(
+            temperature=0.7,
+            model_name="gpt-4o-mini",
+            **rate_limiter.chat_model_kwargs()
+        )
+
+        # Create prompt template
+        prompt = PromptTemplate(
+            input_variables=["chunks", "num_questions"],
+            template=QUESTION_GENERATION_TEMPLATE
+        )
+
+        # Create the runnable chain using pipe syntax
+        _chain = prompt | llm
+    return _chain
+
+
+def _chain_input(chunks, num_questions):
+    # Format chunks as a string with newlines
+    return {
+        "chunks": "\n--------End of Chunk--------\n".join(chunks),
+        "num_questions": num_questions
+    }
+
+
+def parse_questions(response_text):
+    """
+    Parse the LLM response into a list of questions.
+
+    Raises:
+        json.JSONDecodeError: If the response is not a JSON array
+    """
+    # Clean the response text to ensure it's valid JSON
+    # Remove any leading/trailing whitespace and non-JSON text
+    cleaned_text = response_text.strip()
+    if cleaned_text.startswith('```json'):
+        cleaned_text = cleaned_text[7:]  # Remove ```json
+    if cleaned_text.endswith('```'):
+        cleaned_text = cleaned_text[:-3]  # Remove ```
+    cleaned_text = cleaned_text.strip()
+
+    # Parse the JSON result
+    return json.loads(cleaned_text)
+
+
 def generate_questions(chunks=[], num_questions=2):
     """
     Generate questions from text content using LangChain.
@@ -48,134 +116,135 @@ def generate_questions(chunks=[], num_questions=2):
         num_questions (int): Number of questions to generate per chunk
         
     Returns:
-        list: List of dictionaries containing questions and metadata
+        list: List of dictionaries containing questions and metadata, empty if
+        the response could not be parsed
+
+    Raises:
+        openai.OpenAIError: If the call still fails after the rate limiter's retries
     """
-    # Load environment variables
-    load_dotenv()
-    
-    # Initialize LLM
-    llm = ChatOpenAI(
-        temperature=0.7,
-        model_name="gpt-4o-mini"
-    )
-    
-    # Create prompt template
-    prompt = PromptTemplate(
-        input_variables=["chunks", "num_questions"],
-        template=QUESTION_GENERATION_TEMPLATE
-    )
-    
-    # Create the runnable chain using pipe syntax
-    chain = prompt | llm
-    
-    # Format chunks as a string with newlines
-    chunks_text = "\n--------End of Chunk--------\n".join(chunks)
-    
+    # Generate questions using the new pipe syntax
+    result = get_chain().invoke(_chain_input(chunks, num_questions))
+
+    # Get the raw text from the message
+    response_text = result.content
+    print("Raw response:", response_text)
+
     try:
-        # Generate questions using the new pipe syntax
-        result = chain.invoke({
-            "chunks": chunks_text,
-            "num_questions": num_questions
-        })
-        
-        # Get the raw text from the message
-        response_text = result.content
-        print("Raw response:", response_text)
-        
-        # Clean the response text to ensure it's valid JSON
-        # Remove any leading/trailing whitespace and non-JSON text
-        cleaned_text = response_text.strip()
-        if cleaned_text.startswith('```json'):
-            cleaned_text = cleaned_text[7:]  # Remove ```json
-        if cleaned_text.endswith('```'):
-            cleaned_text = cleaned_text[:-3]  # Remove ```
-        cleaned_text = cleaned_text.strip()
-        
-        # Parse the JSON result
-        questions = json.loads(cleaned_text)
-        print("\nParsed questions:", json.dumps(questions, indent=2))
-        return questions
-                
+        questions = parse_questions(response_text)
     except json.JSONDecodeError as e:
         print(f"Error parsing questions: {e}")
         print(f"Raw result: {response_text}")
-        print(f"Cleaned text attempted to parse: {cleaned_text}")
-        return []
-    except Exception as e:
-        print(f"Error generating questions: {e}")
         return []
+    print("\nParsed questions:", json.dumps(questions, indent=2))
+    return questions
+
+
+def resolve_relevant_chunks(question, chunks):
+    """Replace the chunk ids in question['relevant_chunks'] with the chunk texts."""
+    if isinstance(question['relevant_chunks'], str):
+        question['relevant_chunks'] = [chunks[int(chunk) - 1] for chunk in question['relevant_chunks'].split(',')]
+    else:
+        question['relevant_chunks'] = [chunks[i - 1] for i in question['relevant_chunks']]
+    return question
 
-def get_total_pages(project_id, doc):
-    url = f"http://localhost:8001/project/{project_id}/document/chunks"  
-    data = {
-        "content_key": doc['content_key'],
-        'page': 1,
-        'page_size': 40
-    }
-    headers = {
-        "X-API-Key": X_API_KEY,
-        "X-API-Secret": X_API_SECRET
-    }
-    response = requests.post(url, headers=headers, json=data)
-    return response.json()['total_pages']
 
-def get_list_of_chunks(project_id, doc, page_number=1):
+async def generate_question_bank(pages, output_path, num_questions=2, concurrency=GENERATION_CONCURRENCY):
     """
-    Get a list of chunks for a given document
-    total_pages
-    total_chunks
+    Generate questions for every page of chunks, `concurrency` LLM calls at a time.
+
+    Questions are validated and appended to `output_path` (one JSON object per
+    line) as soon as their page completes, so nothing is held until the end.
+    Pages whose call failed are sent again, up to GENERATION_ATTEMPTS rounds;
+    pages whose response did not parse are not, as the LLM cache would replay it.
+    No round is started once the token budget is reached.
+
+    Args:
+        pages (list): List of pages, each a list of chunk texts
+        output_path (str): JSONL file to append questions to
+        num_questions (int): Number of questions to generate per page
+        concurrency (int): Maximum LLM calls in flight
+
+    Returns:
+        int: Number of questions written
+
+    Raises:
+        token_usage.BudgetExceeded: If the token budget left pages without questions
     """
-    documents = get_list_of_documents(project_id)
-    page_size = 40
-    url = f"http://localhost:8001/project/{project_id}/document/chunks"
-    headers = {
-        "X-API-Key": X_API_KEY,
-        "X-API-Secret": X_API_SECRET
-    }
-    data = {
-        "content_key": doc['content_key'],
-        'page': page_number,
-        'page_size': page_size
-    }
-    response = requests.post(url, headers=headers, json=data)
-    return [X['content'] for X in response.json()['chunks']]
+    inputs = [
+        _chain_input([f"Chunk {i}: {chunk}" for i, chunk in enumerate(chunks, 1)], num_questions)
+        for chunks in pages
+    ]
+    written = 0
+    remaining = list(range(len(pages)))
+    ledger = token_usage.get_ledger()
+    with open(output_path, 'a') as f:
+        for attempt in range(1, GENERATION_ATTEMPTS + 1):
+            if not remaining or ledger.budget_reached():
+                break
+            if attempt > 1:
+                print(f"Retrying {len(remaining)} failed pages (attempt {attempt}/{GENERATION_ATTEMPTS})")
+            failed = []
+            async for n, result in get_chain().abatch_as_completed(
+                [inputs[index] for index in remaining], config={"max_concurrency": concurrency},
+                return_exceptions=True
+            ):
+                index = remaining[n]
+                if isinstance(result, Exception):
+                    print(f"Error generating questions for page {index + 1}: {result}")
+                    failed.append(index)
+                    continue
+                try:
+                    questions = parse_questions(result.content)
+                except json.JSONDecodeError as e:
+                    print(f"Error parsing questions for page {index + 1}: {e}")
+                    continue
+                for question in questions:
+                    try:
+                        resolve_relevant_chunks(question, pages[index])
+                    except Exception as e:
+                        print(e)
+                        continue
+                    f.write(json.dumps(question) + "\n")
+                    written += 1
+                f.flush()
+                print(f"Page {index + 1}/{len(pages)} done, {written} questions so far")
+            remaining = sorted(failed)
+    if remaining:
+        print(f"No questions for pages {', '.join(str(index + 1) for index in remaining)} "
+              f"after {GENERATION_ATTEMPTS} attempts")
+        ledger.check('generation')
+    return written
 
 
-def get_list_of_documents(project_id):
-    url = f"http://localhost:8001/v3/project/{project_id}/knowledgebase"
-    headers = {
-        "X-API-Key": X_API_KEY,
-        "X-API-Secret": X_API_SECRET,
-    }
-    data = {
-        "page": 1,
-        "page_size": 100,
-        "project_id": project_id
-    }
-    response = requests.post(url, headers=headers, json=data)
-    return response.json()['docs']
+def generate_bank(store, content_keys, output_path='questions_bank.jsonl', num_questions=2, page_size=40):
+    """
+    Write a fresh question bank to `output_path` from the documents' chunks in
+    `store`, `num_questions` per page of `page_size` chunks. Overlapping pages
+    yield paraphrases of one question; unless GENERATION_DEDUP is off, all but
+    the first of each are pruned.
+    """
+    pages = []
+    for content_key in content_keys:
+        for page in range(1, store.total_pages(content_key, page_size) + 1):
+            pages.append(store.chunks(content_key, page, page_size))
+
+    # Start a fresh bank; questions are appended as their pages complete.
+    open(output_path, 'w').close()
+    with token_usage.tagged(stage='generation', file=qna_io.stem(os.path.basename(output_path))):
+        asyncio.run(generate_question_bank(pages, output_path, num_questions))
+        if GENERATION_DEDUP:
+            dedup_questions.dedup_files([output_path])
 
 
 if __name__ == "__main__":
     project_id = "a6b6387a63c0481ca0373d"
-    docs = get_list_of_documents(project_id)
-    questions_bank = []
-    for doc in docs:
-        pages = get_total_pages(project_id, doc)
-        for page in range(1, pages + 1):
-            chunks = get_list_of_chunks(project_id, doc, page)
-            chunks_with_ids = [f"Chunk {i}: {chunk}" for i, chunk in enumerate(chunks, 1)]
-            questions = generate_questions(chunks_with_ids, 2)
-            for question in questions:
-                print(chunks_with_ids)
-                print(question)
-                try:
-                    if isinstance(question['relevant_chunks'], str):
-                        question['relevant_chunks'] = [chunks[int(chunk) - 1] for chunk in question['relevant_chunks'].split(',')]
-                    else:
-                        question['relevant_chunks'] = [chunks[i - 1] for i in question['relevant_chunks']]
-                    questions_bank.append(question)
-                except Exception as e:
-                    print(e)
-    with open('questions_bank.json', 'w') as f:
-        json.dump(questions_bank, f) 
\ No newline at end of file
+    # Pull every document's chunks once, then read pages from the local store.
+    store = ChunkStore()
+    docs = asyncio.run(export_chunks(project_id, store))
+    try:
+        generate_bank(store, [doc['content_key'] for doc in docs])
+    except token_usage.BudgetExceeded as e:
+        print(e)
+    llm_cache.print_stats()
+    rate_limiter.print_stats()
+    token_usage.print_summary()
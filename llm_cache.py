@@ -0,0 +1,220 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from typing import Iterator, List, Optional, Sequence, Tuple
+from langchain_core.caches import BaseCache
+from langchain_core.globals import set_llm_cache
+from langchain_core.load import dumps, loads
+from langchain_core.stores import ByteStore
+
+"""
+Persistent, content-addressed cache for LLM and embedding calls.
+
+LLM responses are cached through langchain's global LLM cache, keyed by the
+sha256 of the model/parameter string and the prompt, so both question
+generation and the ragas judge (via LangchainLLMWrapper) replay unchanged calls
+from disk. Embeddings go through CacheBackedEmbeddings backed by the same
+SQLite file, namespaced by embedding model.
+
+Entries older than LLM_CACHE_MAX_AGE_DAYS are dropped, and the least recently
+used entries are evicted once the cache grows past LLM_CACHE_MAX_MB.
+
+Config (environment):
+LLM_CACHE               Path of the SQLite cache            (default .llm_cache.sqlite)
+LLM_CACHE_MAX_MB        Size cap in megabytes               (default 1024)
+LLM_CACHE_MAX_AGE_DAYS  Age cap in days                     (default 30)
+LLM_CACHE_DISABLED      Set to 'true' to bypass the cache
+"""
+
+LLM_CACHE_PATH = os.getenv("LLM_CACHE", ".llm_cache.sqlite")
+LLM_CACHE_MAX_MB = float(os.getenv("LLM_CACHE_MAX_MB", 1024))
+LLM_CACHE_MAX_AGE_DAYS = float(os.getenv("LLM_CACHE_MAX_AGE_DAYS", 30))
+LLM_CACHE_DISABLED = os.getenv("LLM_CACHE_DISABLED", "false").lower() == "true"
+
+
+class CacheDB:
+    """Key/value table shared by the LLM and embedding caches, with hit/miss stats per kind."""
+
+    def __init__(self, path=LLM_CACHE_PATH, max_mb=LLM_CACHE_MAX_MB, max_age_days=LLM_CACHE_MAX_AGE_DAYS):
+        self.path = path
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.max_age = max_age_days * 24 * 3600
+        self.stats = {}
+        # Async lookups run in langchain's executor threads.
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY,
+                kind TEXT,
+                value BLOB,
+                size INTEGER,
+                created_at REAL,
+                accessed_at REAL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed_at)")
+        self._conn.commit()
+
+    def _count(self, kind, hit):
+        counts = self.stats.setdefault(kind, {'hits': 0, 'misses': 0})
+        counts['hits' if hit else 'misses'] += 1
+
+    def get_many(self, kind, keys):
+        now = time.time()
+        values = []
+        with self._lock:
+            for key in keys:
+                row = self._conn.execute(
+                    "SELECT value, created_at FROM entries WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None and now - row[1] > self.max_age:
+                    self._conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+                    row = None
+                if row is not None:
+                    self._conn.execute("UPDATE entries SET accessed_at = ? WHERE key = ?", (now, key))
+                self._count(kind, row is not None)
+                values.append(row[0] if row is not None else None)
+            self._conn.commit()
+        return values
+
+    def put_many(self, kind, items):
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO entries (key, kind, value, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?, ?)",
+                [(key, kind, value, len(value), now, now) for key, value in items]
+            )
+            self._conn.commit()
+
+    def delete_many(self, keys):
+        with self._lock:
+            self._conn.executemany("DELETE FROM entries WHERE key = ?", [(key,) for key in keys])
+            self._conn.commit()
+
+    def keys(self, kind, prefix=None):
+        with self._lock:
+            rows = self._conn.execute("SELECT key FROM entries WHERE kind = ?", (kind,)).fetchall()
+        return [row[0] for row in rows if prefix is None or row[0].startswith(prefix)]
+
+    def clear(self, kind):
+        with self._lock:
+            self._conn.execute("DELETE FROM entries WHERE kind = ?", (kind,))
+            self._conn.commit()
+
+    def evict(self):
+        """Drop expired entries, then least recently used ones until under the size cap."""
+        with self._lock:
+            expired = self._conn.execute(
+                "DELETE FROM entries WHERE created_at < ?", (time.time() - self.max_age,)
+            ).rowcount
+            total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+            evicted = 0
+            if total > self.max_bytes:
+                excess = total - self.max_bytes
+                for key, size in self._conn.execute(
+                    "SELECT key, size FROM entries ORDER BY accessed_at"
+                ).fetchall():
+                    if excess <= 0:
+                        break
+                    self._conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+                    excess -= size
+                    evicted += 1
+            self._conn.commit()
+        return expired, evicted
+
+
+class SQLiteLLMCache(BaseCache):
+    """langchain LLM cache keyed by sha256(llm_string, prompt)."""
+
+    def __init__(self, db):
+        self.db = db
+
+    @staticmethod
+    def _key(prompt, llm_string):
+        return "llm:" + hashlib.sha256(f"{llm_string}\0{prompt}".encode('utf-8')).hexdigest()
+
+    def lookup(self, prompt, llm_string):
+        value = self.db.get_many('llm', [self._key(prompt, llm_string)])[0]
+        if value is None:
+            return None
+        return loads(value.decode('utf-8') if isinstance(value, bytes) else value)
+
+    def update(self, prompt, llm_string, return_val):
+        self.db.put_many('llm', [(self._key(prompt, llm_string), dumps(return_val).encode('utf-8'))])
+
+    def clear(self, **kwargs):
+        self.db.clear('llm')
+
+
+class SQLiteByteStore(ByteStore):
+    """ByteStore for CacheBackedEmbeddings on top of the cache table."""
+
+    def __init__(self, db):
+        self.db = db
+
+    def mget(self, keys: Sequence[str]) -> List[Optional[bytes]]:
+        return self.db.get_many('embedding', ["emb:" + key for key in keys])
+
+    def mset(self, key_value_pairs: Sequence[Tuple[str, bytes]]) -> None:
+        self.db.put_many('embedding', [("emb:" + key, value) for key, value in key_value_pairs])
+
+    def mdelete(self, keys: Sequence[str]) -> None:
+        self.db.delete_many(["emb:" + key for key in keys])
+
+    def yield_keys(self, *, prefix: Optional[str] = None) -> Iterator[str]:
+        for key in self.db.keys('embedding', "emb:" + (prefix or "")):
+            yield key[len("emb:"):]
+
+
+_db = None
+
+
+def get_db():
+    global _db
+    if _db is None:
+        _db = CacheDB()
+        expired, evicted = _db.evict()
+        if expired or evicted:
+            print(f"LLM cache: dropped {expired} expired and evicted {evicted} least recently used entries")
+    return _db
+
+
+def enable():
+    """Route every langchain LLM call in this process through the disk cache."""
+    if LLM_CACHE_DISABLED:
+        return
+    set_llm_cache(SQLiteLLMCache(get_db()))
+
+
+def cached_embeddings(underlying=None):
+    """
+    Wrap `underlying` (default: OpenAIEmbeddings, the model ragas uses) so that
+    documents and queries are embedded once per model and text.
+    """
+    from langchain.embeddings import CacheBackedEmbeddings
+    from langchain_openai import OpenAIEmbeddings
+    import rate_limiter
+
+    if underlying is None:
+        underlying = OpenAIEmbeddings(**rate_limiter.embeddings_kwargs())
+    if LLM_CACHE_DISABLED:
+        return underlying
+    namespace = getattr(underlying, 'model', None) or type(underlying).__name__
+    store = SQLiteByteStore(get_db())
+    return CacheBackedEmbeddings.from_bytes_store(
+        underlying, store, namespace=f"{namespace}:", query_embedding_cache=True, key_encoder='sha256'
+    )
+
+
+def print_stats():
+    if _db is None:
+        return
+    for kind, counts in sorted(_db.stats.items()):
+        total = counts['hits'] + counts['misses']
+        rate = counts['hits'] / total if total else 0
+        print(f"{kind} cache: {counts['hits']} hits, {counts['misses']} misses ({rate:.1%} hit rate)")
+    _db.evict()
@@ -0,0 +1,255 @@
+import asyncio
+import json
+import os
+import random
+import time
+import numpy as np
+from dotenv import load_dotenv
+import odin_client
+import qna_io
+import chats
+from chats import ChatPool
+
+load_dotenv()
+
+"""
+Open-loop load test of the chat agent.
+
+Questions from QnA/test_qna_* are replayed with Poisson arrivals: a single step
+at LOADTEST_RATE, or a stepped ramp from LOADTEST_RAMP_START requests/s in
+LOADTEST_RAMP_STEPS steps of LOADTEST_RAMP_STEP. Arrivals never wait for earlier
+requests to finish (open loop); each request is asked (streamed or polled) exactly as
+chats.py does, and its latency is measured from its scheduled arrival. The
+odin_client connection pool is widened to LOADTEST_MAX_IN_FLIGHT for the test,
+so requests do not queue for a connection on the client and the latency is the
+server's.
+
+Per step: offered rate, throughput (answers completed per second), error rate
+and P50/P90/P99 latency. The first step whose P90 exceeds LOADTEST_SLO_P90 or
+whose error rate exceeds LOADTEST_SLO_ERROR_RATE is reported as the saturation
+point. Output in LoadTest/: per-request records (loadtest_<time>.jsonl), the
+step summary (loadtest_<time>_summary.json) and the saturation curve
+(loadtest_<time>_saturation.png).
+
+Config (environment):
+LOADTEST_MODE            'ramp' or 'poisson'                        (default ramp)
+LOADTEST_RATE            Requests/s in poisson mode                 (default 1)
+LOADTEST_RAMP_START      First step's requests/s                    (default 0.5)
+LOADTEST_RAMP_STEP       Increase per step                          (default 0.5)
+LOADTEST_RAMP_STEPS      Number of steps                            (default 6)
+LOADTEST_STEP_DURATION   Seconds per step                           (default 60)
+LOADTEST_MAX_IN_FLIGHT   Arrivals beyond this many in flight are dropped and counted as errors (default 256)
+LOADTEST_SLO_P90         Latency SLO on P90, seconds                (default 30)
+LOADTEST_SLO_ERROR_RATE  Error rate SLO                             (default 0.01)
+LOADTEST_SEED            Seed for arrivals and question order       (default 0)
+"""
+
+PROJECT_ID = os.getenv("PROJECT_ID")
+LOADTEST_MODE = os.getenv("LOADTEST_MODE", "ramp")
+LOADTEST_RATE = float(os.getenv("LOADTEST_RATE", 1))
+LOADTEST_RAMP_START = float(os.getenv("LOADTEST_RAMP_START", 0.5))
+LOADTEST_RAMP_STEP = float(os.getenv("LOADTEST_RAMP_STEP", 0.5))
+LOADTEST_RAMP_STEPS = int(os.getenv("LOADTEST_RAMP_STEPS", 6))
+LOADTEST_STEP_DURATION = float(os.getenv("LOADTEST_STEP_DURATION", 60))
+LOADTEST_MAX_IN_FLIGHT = int(os.getenv("LOADTEST_MAX_IN_FLIGHT", 256))
+LOADTEST_SLO_P90 = float(os.getenv("LOADTEST_SLO_P90", 30))
+LOADTEST_SLO_ERROR_RATE = float(os.getenv("LOADTEST_SLO_ERROR_RATE", 0.01))
+LOADTEST_SEED = int(os.getenv("LOADTEST_SEED", 0))
+OUTPUT_DIR = 'LoadTest'
+
+
+def build_schedule(mode=LOADTEST_MODE, duration=LOADTEST_STEP_DURATION):
+    """List of (rate, duration) steps."""
+    if mode == 'poisson':
+        return [(LOADTEST_RATE, duration)]
+    if mode == 'ramp':
+        return [(LOADTEST_RAMP_START + i * LOADTEST_RAMP_STEP, duration) for i in range(LOADTEST_RAMP_STEPS)]
+    raise ValueError(f"Unknown LOADTEST_MODE {mode!r}, expected 'ramp' or 'poisson'")
+
+
+def load_questions(directory='QnA'):
+    return [q_n_a['question'] for file in qna_io.list_files(directory, 'test_qna') for q_n_a in qna_io.read_records(file)]
+
+
+def arrival_times(schedule, rng):
+    """(step, offset in seconds from the start) of every arrival, Poisson within each step."""
+    arrivals = []
+    start = 0.0
+    for step, (rate, duration) in enumerate(schedule):
+        if rate > 0:
+            # Enough exponential gaps to cover the step with room to spare, then cut at its end.
+            gaps = rng.exponential(1 / rate, size=int(rate * duration * 1.5) + 20)
+            times = start + np.cumsum(gaps)
+            arrivals.extend((step, t) for t in times[times < start + duration])
+        start += duration
+    return arrivals
+
+
+async def _request(pool, question, project_id, step, scheduled, started):
+    stats = chats.new_stats()
+    record = {'step': step, 'question': question, 'scheduled': scheduled - started}
+    chat_id = None
+    try:
+        chat_id = await pool.acquire()
+        await chats.ask_question_async(question, project_id, chat_id, stats=stats)
+    except Exception as e:
+        stats['outcome'] = 'error'
+        record['error'] = f"{type(e).__name__}: {e}"
+    finally:
+        if chat_id is not None:
+            pool.release(chat_id)
+    finished = time.monotonic()
+    record.update({
+        'finished': finished - started,
+        'latency': finished - scheduled if stats['outcome'] == 'answered' else None,
+        'timing': stats,
+    })
+    return record
+
+
+async def run_load(schedule, questions, project_id, max_in_flight=LOADTEST_MAX_IN_FLIGHT, seed=LOADTEST_SEED):
+    """
+    Fire the schedule's arrivals open loop and wait for every request to finish.
+
+    Returns:
+        list: One record per arrival (dropped arrivals included)
+    """
+    rng = np.random.default_rng(seed)
+    order = random.Random(seed)
+    questions = list(questions)
+    order.shuffle(questions)
+    pool = ChatPool(project_id, size=max_in_flight)
+    # One connection per request in flight, so none of the latency is client-side queueing.
+    pool_size = odin_client.POOL_SIZE
+    if pool_size < max_in_flight:
+        odin_client.configure(pool_size=max_in_flight)
+    tasks = []
+    records = []
+    in_flight = 0
+
+    async def tracked(coroutine):
+        nonlocal in_flight
+        in_flight += 1
+        try:
+            return await coroutine
+        finally:
+            in_flight -= 1
+
+    announced = -1
+    started = time.monotonic()
+    for n, (step, offset) in enumerate(arrival_times(schedule, rng)):
+        scheduled = started + offset
+        delay = scheduled - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        question = questions[n % len(questions)]
+        if step != announced:
+            print(f"Step {step + 1}/{len(schedule)}: {schedule[step][0]:g} requests/s")
+            announced = step
+        if in_flight >= max_in_flight:
+            records.append({'step': step, 'question': question, 'scheduled': offset, 'finished': offset,
+                            'latency': None, 'timing': {'outcome': 'dropped'}})
+            continue
+        tasks.append(asyncio.ensure_future(tracked(_request(pool, question, project_id, step, scheduled, started))))
+    records.extend(await asyncio.gather(*tasks))
+    await odin_client.aclose()
+    if odin_client.POOL_SIZE != pool_size:
+        odin_client.configure(pool_size=pool_size)
+    return records
+
+
+def summarize(records, schedule, slo_p90=LOADTEST_SLO_P90, slo_error_rate=LOADTEST_SLO_ERROR_RATE):
+    """Per-step rate, throughput, error rate and latency percentiles, and the first step that breaks the SLO."""
+    step = np.array([r['step'] for r in records], dtype=np.int64)
+    finished = np.array([r['finished'] for r in records], dtype=np.float64)
+    answered = np.array([r['timing'].get('outcome') == 'answered' for r in records], dtype=bool)
+    latency = np.array([np.nan if r['latency'] is None else r['latency'] for r in records], dtype=np.float64)
+    starts = np.concatenate(([0.0], np.cumsum([duration for _, duration in schedule])[:-1]))
+
+    steps = []
+    saturation = None
+    for i, (rate, duration) in enumerate(schedule):
+        mask = step == i
+        total = int(mask.sum())
+        ok = answered & mask
+        # Throughput counts answers completed during the step, whatever step they arrived in.
+        done = answered & (finished >= starts[i]) & (finished < starts[i] + duration)
+        step_latency = latency[ok]
+        summary = {
+            'step': i + 1,
+            'offered_rate': rate,
+            'arrivals': total,
+            'answered': int(ok.sum()),
+            'throughput': done.sum() / duration,
+            'error_rate': (total - ok.sum()) / total if total else 0.0,
+        }
+        for q in (50, 90, 99):
+            summary[f'p{q}'] = float(np.percentile(step_latency, q)) if len(step_latency) else None
+        breaks = summary['error_rate'] > slo_error_rate or summary['p90'] is None or summary['p90'] > slo_p90
+        if saturation is None and total and breaks:
+            saturation = summary
+        steps.append(summary)
+    return {'steps': steps, 'saturation': saturation, 'slo': {'p90': slo_p90, 'error_rate': slo_error_rate}}
+
+
+def print_summary(summary):
+    print(f"\n{'step':>4} {'rate':>7} {'arrivals':>8} {'thruput':>8} {'errors':>7} {'p50':>7} {'p90':>7} {'p99':>7}")
+    for s in summary['steps']:
+        latencies = ''.join(f" {s[k]:>7.2f}" if s[k] is not None else f" {'-':>7}" for k in ('p50', 'p90', 'p99'))
+        print(f"{s['step']:>4} {s['offered_rate']:>7.2f} {s['arrivals']:>8} {s['throughput']:>8.2f} "
+              f"{s['error_rate']:>7.1%}{latencies}")
+    saturation = summary['saturation']
+    slo = summary['slo']
+    if saturation is None:
+        print(f"\nSLO (P90 <= {slo['p90']}s, errors <= {slo['error_rate']:.1%}) held at every step")
+    else:
+        print(f"\nSLO (P90 <= {slo['p90']}s, errors <= {slo['error_rate']:.1%}) breaks at "
+              f"{saturation['offered_rate']:g} requests/s (step {saturation['step']})")
+
+
+def plot_saturation_curve(summary, path):
+    import matplotlib.pyplot as plt
+
+    steps = summary['steps']
+    rates = [s['offered_rate'] for s in steps]
+    fig, (ax1, ax2) = plt.subplots(2, 1, figsize=(10, 8), sharex=True)
+    fig.suptitle('Saturation Curve', fontsize=16)
+    for q, color in ((50, 'green'), (90, 'orange'), (99, 'red')):
+        ax1.plot(rates, [s[f'p{q}'] if s[f'p{q}'] is not None else np.nan for s in steps], marker='o', color=color,
+                 label=f'P{q} latency')
+    ax1.axhline(summary['slo']['p90'], color='orange', linestyle='--', label='P90 SLO')
+    ax1.set_ylabel('Latency (s)', fontsize=12)
+    ax1.legend()
+    ax1.grid(True, linestyle='--', alpha=0.7)
+    ax2.plot(rates, [s['throughput'] for s in steps], marker='o', color='skyblue', label='Throughput (answers/s)')
+    ax2.plot(rates, rates, linestyle=':', color='grey', label='Offered rate')
+    ax2b = ax2.twinx()
+    ax2b.plot(rates, [s['error_rate'] for s in steps], marker='x', color='red', label='Error rate')
+    ax2b.set_ylabel('Error rate', fontsize=12)
+    ax2.set_xlabel('Offered rate (requests/s)', fontsize=12)
+    ax2.set_ylabel('Requests/s', fontsize=12)
+    ax2.legend(loc='upper left')
+    ax2b.legend(loc='upper right')
+    ax2.grid(True, linestyle='--', alpha=0.7)
+    plt.tight_layout()
+    plt.savefig(path, bbox_inches='tight', dpi=150)
+    plt.close()
+
+
+if __name__ == "__main__":
+    schedule = build_schedule()
+    questions = load_questions()
+    print(f"Load test: {len(schedule)} step(s) of {LOADTEST_STEP_DURATION:g}s, {len(questions)} questions to replay")
+    records = asyncio.run(run_load(schedule, questions, PROJECT_ID))
+
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    base = os.path.join(OUTPUT_DIR, f"loadtest_{time.strftime('%Y%m%dT%H%M%S')}")
+    qna_io.write_records(base + '.jsonl', records)
+    summary = summarize(records, schedule)
+    with open(base + '_summary.json', 'w') as f:
+        json.dump(summary, f, indent=4)
+    print_summary(summary)
+    try:
+        plot_saturation_curve(summary, base + '_saturation.png')
+    except ImportError:
+        print("matplotlib is not installed; skipping the saturation curve plot")
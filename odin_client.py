@@ -0,0 +1,134 @@
+import os
+import asyncio
+import requests
+from requests.adapters import HTTPAdapter
+from dotenv import load_dotenv
+
+load_dotenv()
+
+"""
+Shared HTTP client for the Odin API.
+
+All scripts talk to the backend through this module so that connections are
+kept alive and pooled, and the base URL and auth headers live in one place.
+
+Config (environment):
+ODIN_BASE_URL     Base URL of the backend            (default http://localhost:8001)
+X_API_KEY         API key sent as X-API-KEY
+X_API_SECRET      API secret sent as X-API-SECRET
+ODIN_POOL_SIZE    Max pooled connections per client  (default 32)
+ODIN_TIMEOUT      Per-request timeout in seconds     (default 300)
+"""
+
+BASE_URL = os.getenv("ODIN_BASE_URL", "http://localhost:8001")
+X_API_KEY = os.getenv("X_API_KEY")
+X_API_SECRET = os.getenv("X_API_SECRET")
+POOL_SIZE = int(os.getenv("ODIN_POOL_SIZE", 32))
+TIMEOUT = float(os.getenv("ODIN_TIMEOUT", 300))
+
+_session = None
+# httpx clients are bound to the event loop they were first used on.
+_async_clients = {}
+
+
+def configure(base_url=None, api_key=None, api_secret=None, pool_size=None, timeout=None):
+    """
+    Override the environment config. Existing clients are dropped so the next
+    request picks up the new settings.
+    """
+    global BASE_URL, X_API_KEY, X_API_SECRET, POOL_SIZE, TIMEOUT, _session
+    if base_url is not None:
+        BASE_URL = base_url
+    if api_key is not None:
+        X_API_KEY = api_key
+    if api_secret is not None:
+        X_API_SECRET = api_secret
+    if pool_size is not None:
+        POOL_SIZE = pool_size
+    if timeout is not None:
+        TIMEOUT = timeout
+    if _session is not None:
+        _session.close()
+    _session = None
+    _async_clients.clear()
+
+
+def url(path):
+    if path.startswith('http://') or path.startswith('https://'):
+        return path
+    return BASE_URL.rstrip('/') + path
+
+
+def auth_headers():
+    headers = {
+        "X-API-KEY": X_API_KEY,
+        "X-API-SECRET": X_API_SECRET
+    }
+    # httpx rejects None header values where requests silently drops them.
+    return {name: value for name, value in headers.items() if value is not None}
+
+
+def get_session():
+    global _session
+    if _session is None:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.headers.update(auth_headers())
+        _session = session
+    return _session
+
+
+def get(path, **kwargs):
+    kwargs.setdefault('timeout', TIMEOUT)
+    return get_session().get(url(path), **kwargs)
+
+
+def post(path, **kwargs):
+    kwargs.setdefault('timeout', TIMEOUT)
+    return get_session().post(url(path), **kwargs)
+
+
+def delete(path, **kwargs):
+    kwargs.setdefault('timeout', TIMEOUT)
+    return get_session().delete(url(path), **kwargs)
+
+
+def get_async_client():
+    import httpx
+
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = httpx.AsyncClient(
+            headers=auth_headers(),
+            limits=httpx.Limits(max_connections=POOL_SIZE, max_keepalive_connections=POOL_SIZE),
+            timeout=TIMEOUT
+        )
+        _async_clients[loop] = client
+    return client
+
+
+async def aget(path, **kwargs):
+    return await get_async_client().get(url(path), **kwargs)
+
+
+async def apost(path, **kwargs):
+    return await get_async_client().post(url(path), **kwargs)
+
+
+async def adelete(path, **kwargs):
+    # httpx.delete does not take a body, so go through the generic request.
+    return await get_async_client().request("DELETE", url(path), **kwargs)
+
+
+def astream(method, path, **kwargs):
+    """Streamed request, used as `async with odin_client.astream(...) as response:`."""
+    return get_async_client().stream(method, url(path), **kwargs)
+
+
+async def aclose():
+    client = _async_clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
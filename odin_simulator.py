@@ -0,0 +1,570 @@
+import ast
+import email.parser
+import email.policy
+import json
+import math
+import os
+import random
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from dotenv import load_dotenv
+import qna_io
+
+load_dotenv()
+
+"""
+Local stand-in for the Odin API, for benchmarking and regression-testing the
+harness without the full stack.
+
+Implements the endpoints the scripts use: knowledge add (file upload) and
+delete, document chunks, the knowledgebase listing, chat create, message submit
+(optionally streamed as server-sent events) and message / chat history fetch.
+Documents and answers come from the existing data: every QnA/test_qna_* record
+contributes its contexts as chunks of the document named in its metadata, its
+answer (the file_ans_* response when there is one, else the ground truth) and
+its contexts as citations; questions_bank records contribute their relevant
+chunks. Unknown questions get a placeholder answer citing chunks drawn from the
+corpus.
+
+Randomness is seeded per request from SIM_SEED and the request itself (the
+question, or the method, path and body, and how many times it was seen), so the
+same requests see the same latencies and faults whatever order concurrent
+requests arrive in.
+
+Latency distributions are written 'const:S', 'uniform:A,B', 'exp:MEAN' or
+'lognormal:MEDIAN,SIGMA' (seconds).
+
+Config (environment):
+SIM_HOST                  Address to listen on                                  (default 127.0.0.1)
+SIM_PORT                  Port to listen on                                     (default 8001)
+SIM_SEED                  Seed for latencies, faults and placeholder answers    (default 0)
+SIM_REQUEST_LATENCY       Time to serve any request                             (default const:0.005)
+SIM_ANSWER_LATENCY        Time for an answer to be ready after submission       (default lognormal:2,0.5)
+SIM_FIRST_TOKEN_LATENCY   Time to the first streamed token                      (default lognormal:0.5,0.3)
+SIM_ERROR_RATE            Fraction of requests answered with a 500              (default 0)
+SIM_RATE_LIMIT            Requests/s before answering 429, 0 for no limit       (default 0)
+SIM_BURST                 Requests allowed in a burst above the rate limit      (default 10)
+SIM_STREAM                Stream answers when asked to ('true'/'false')         (default true)
+SIM_INGEST_DELAY          Seconds before an async (sync=false) upload has chunks (default 2)
+SIM_CHUNK_SIZE            Characters per chunk of an uploaded file              (default 1000)
+"""
+
+SIM_HOST = os.getenv("SIM_HOST", "127.0.0.1")
+SIM_PORT = int(os.getenv("SIM_PORT", 8001))
+SIM_SEED = int(os.getenv("SIM_SEED", 0))
+SIM_REQUEST_LATENCY = os.getenv("SIM_REQUEST_LATENCY", "const:0.005")
+SIM_ANSWER_LATENCY = os.getenv("SIM_ANSWER_LATENCY", "lognormal:2,0.5")
+SIM_FIRST_TOKEN_LATENCY = os.getenv("SIM_FIRST_TOKEN_LATENCY", "lognormal:0.5,0.3")
+SIM_ERROR_RATE = float(os.getenv("SIM_ERROR_RATE", 0))
+SIM_RATE_LIMIT = float(os.getenv("SIM_RATE_LIMIT", 0))
+SIM_BURST = int(os.getenv("SIM_BURST", 10))
+SIM_STREAM = os.getenv("SIM_STREAM", "true").lower() == "true"
+SIM_INGEST_DELAY = float(os.getenv("SIM_INGEST_DELAY", 2))
+SIM_CHUNK_SIZE = int(os.getenv("SIM_CHUNK_SIZE", 1000))
+
+QUESTIONS_BANK_DOCUMENT = 'questions_bank'
+PLACEHOLDER_CITATIONS = 3
+
+
+def parse_distribution(spec):
+    """
+    A sampler for a latency distribution spec such as 'lognormal:2,0.5'.
+
+    Returns:
+        callable: rng -> seconds (never negative)
+    """
+    kind, _, args = spec.partition(':')
+    params = [float(x) for x in args.split(',') if x.strip()]
+    if kind == 'const' and len(params) == 1:
+        return lambda rng: max(params[0], 0.0)
+    if kind == 'uniform' and len(params) == 2:
+        return lambda rng: max(rng.uniform(*params), 0.0)
+    if kind == 'exp' and len(params) == 1:
+        return lambda rng: rng.expovariate(1 / params[0]) if params[0] > 0 else 0.0
+    if kind == 'lognormal' and len(params) == 2:
+        return lambda rng: rng.lognormvariate(math.log(params[0]), params[1]) if params[0] > 0 else 0.0
+    raise ValueError(f"Bad latency distribution {spec!r}, expected const:S, uniform:A,B, exp:MEAN or lognormal:MEDIAN,SIGMA")
+
+
+def _literal_list(value):
+    """contexts, metadata and relevant_chunks are stored as Python list reprs."""
+    if isinstance(value, list):
+        return value
+    try:
+        parsed = ast.literal_eval(value or '[]')
+    except (ValueError, SyntaxError):
+        return [value] if value else []
+    return parsed if isinstance(parsed, list) else [parsed]
+
+
+def _source_name(metadata):
+    source = metadata.get('source') if isinstance(metadata, dict) else None
+    return os.path.basename(source) if source else None
+
+
+class Corpus:
+    """Documents (content key -> chunk texts) and known answers (question -> (answer, citations))."""
+
+    def __init__(self):
+        self.documents = {}
+        self.answers = {}
+        self._seen = {}
+
+    def _add_chunk(self, content_key, chunk):
+        seen = self._seen.setdefault(content_key, set())
+        if chunk and chunk not in seen:
+            seen.add(chunk)
+            self.documents.setdefault(content_key, []).append(chunk)
+
+    def add_record(self, record):
+        question = record.get('question')
+        contexts = [c for c in _literal_list(record.get('contexts') or record.get('relevant_chunks')) if isinstance(c, str)]
+        metadata = _literal_list(record.get('metadata'))
+        for i, chunk in enumerate(contexts):
+            # metadata lines up with contexts when both are present.
+            source = _source_name(metadata[i] if i < len(metadata) else (metadata[0] if metadata else None))
+            self._add_chunk(source or QUESTIONS_BANK_DOCUMENT, chunk)
+        if not question:
+            return
+        answer = record.get('response') if isinstance(record.get('response'), str) else None
+        answer = answer if answer and answer != 'failed' else record.get('ground_truth')
+        # Later files (file_ans after test_qna) fill in or override what earlier ones had.
+        known_answer, known_citations = self.answers.get(question, (None, []))
+        self.answers[question] = (answer or known_answer, contexts or known_citations)
+
+    def set_document(self, content_key, chunks):
+        self.documents[content_key] = list(chunks)
+        self._seen[content_key] = set(chunks)
+
+    def delete_document(self, content_key):
+        self._seen.pop(content_key, None)
+        return self.documents.pop(content_key, None) is not None
+
+    @classmethod
+    def load(cls, qna_dir='QnA', bank='questions_bank'):
+        corpus = cls()
+        files = []
+        if os.path.isdir(qna_dir):
+            files = qna_io.list_files(qna_dir, 'test_qna') + qna_io.list_files(qna_dir, 'file_ans')
+        bank_path = qna_io.find_file(bank)
+        if bank_path:
+            files.append(bank_path)
+        for path in files:
+            for record in qna_io.read_records(path):
+                corpus.add_record(record)
+        return corpus
+
+
+class TokenBucket:
+    """Token bucket rate limiter; `take` returns 0 when a request may go ahead, else seconds to wait."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self._tokens = float(self.burst)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            return (1 - self._tokens) / self.rate
+
+
+class Simulator:
+    """
+    State and behaviour of the simulated API; `OdinSimulatorServer` serves it over HTTP.
+
+    Args:
+        corpus (Corpus): Documents and answers to serve, loaded from QnA/ and the question bank if None
+        seed (int): Seed for every random choice
+        request_latency, answer_latency, first_token_latency (str): Latency distribution specs
+        error_rate (float): Fraction of requests answered with a 500
+        rate_limit (float): Requests/s before answering 429 (0 for no limit), with `burst` headroom
+        stream (bool): Stream answers when a submission asks for it
+        ingest_delay (float): Seconds before an async upload has chunks
+        chunk_size (int): Characters per chunk of an uploaded file
+    """
+
+    def __init__(self, corpus=None, seed=SIM_SEED, request_latency=SIM_REQUEST_LATENCY, answer_latency=SIM_ANSWER_LATENCY,
+                 first_token_latency=SIM_FIRST_TOKEN_LATENCY, error_rate=SIM_ERROR_RATE, rate_limit=SIM_RATE_LIMIT,
+                 burst=SIM_BURST, stream=SIM_STREAM, ingest_delay=SIM_INGEST_DELAY, chunk_size=SIM_CHUNK_SIZE):
+        self.corpus = corpus if corpus is not None else Corpus.load()
+        self.seed = seed
+        self.request_latency = parse_distribution(request_latency)
+        self.answer_latency = parse_distribution(answer_latency)
+        self.first_token_latency = parse_distribution(first_token_latency)
+        self.error_rate = error_rate
+        self.limiter = TokenBucket(rate_limit, burst) if rate_limit > 0 else None
+        self.stream = stream
+        self.ingest_delay = ingest_delay
+        self.chunk_size = chunk_size
+        self.chats = {}
+        self.pending_documents = {}
+        self.counters = {'requests': 0, 'errors': 0, 'rate_limited': 0, 'messages': 0, 'streamed': 0}
+        self.answer_times = []
+        self._occurrences = {}
+        self._lock = threading.Lock()
+        self._all_chunks = [chunk for chunks in self.corpus.documents.values() for chunk in chunks]
+
+    def rng(self, *key):
+        """Random generator for the n-th occurrence of `key`, independent of request interleaving."""
+        key = ':'.join(str(k) for k in key)
+        with self._lock:
+            n = self._occurrences.get(key, 0)
+            self._occurrences[key] = n + 1
+        return random.Random(f"{self.seed}:{key}:{n}")
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self.counters[name] += amount
+
+    def admit(self, method, path, body):
+        """
+        Request latency, fault injection and rate limiting for one request.
+
+        Returns:
+            tuple: (status, headers, body) to answer with instead, or None to serve the request
+        """
+        self._count('requests')
+        rng = self.rng('request', method, path, body)
+        time.sleep(self.request_latency(rng))
+        if self.limiter is not None:
+            wait = self.limiter.take()
+            if wait > 0:
+                self._count('rate_limited')
+                return 429, {'Retry-After': str(max(1, math.ceil(wait)))}, {'detail': 'Rate limit exceeded'}
+        if self.error_rate > 0 and rng.random() < self.error_rate:
+            self._count('errors')
+            return 500, {}, {'detail': 'Simulated server error'}
+        return None
+
+    # Chats
+
+    def create_chat(self, form):
+        with self._lock:
+            chat_id = f"chat{len(self.chats) + 1:06d}"
+            self.chats[chat_id] = {'name': form.get('name'), 'project_id': form.get('project_id'), 'messages': []}
+        return 200, {'chat_id': chat_id, 'name': form.get('name')}
+
+    def _answer(self, question):
+        known = self.corpus.answers.get(question)
+        answer, citations = known if known else (None, [])
+        rng = self.rng('answer', question)
+        if not citations and self._all_chunks:
+            citations = rng.sample(self._all_chunks, min(PLACEHOLDER_CITATIONS, len(self._all_chunks)))
+        return answer or f"Simulated answer to: {question}", citations
+
+    def submit_message(self, form):
+        """
+        Record a message and when it will be answered.
+
+        Returns:
+            tuple: (status, body), or (200, message) with the message's stream timing when streaming
+        """
+        chat = self.chats.get(form.get('chat_id'))
+        question = form.get('message')
+        if chat is None or not question:
+            return 404 if chat is None else 422, {'detail': 'Unknown chat' if chat is None else 'Empty message'}
+        answer, citations = self._answer(question)
+        rng = self.rng('latency', question)
+        latency = self.answer_latency(rng)
+        first_token = min(self.first_token_latency(rng), latency)
+        now = time.time()
+        with self._lock:
+            self.counters['messages'] += 1
+            message_id = f"msg{self.counters['messages']:08d}"
+            self.answer_times.append(latency)
+        message = {
+            'id': message_id,
+            'message_id': message_id,
+            'message': question,
+            'created_at': now,
+            'ready_at': now + latency,
+            'first_token_at': now + first_token,
+            '_response': answer,
+            '_citations': citations,
+        }
+        with self._lock:
+            chat['messages'].append(message)
+        return 200, message
+
+    def public_message(self, message, now=None):
+        """The message as the API returns it; the response only appears once it is ready."""
+        now = time.time() if now is None else now
+        ready = now >= message['ready_at']
+        return {
+            'id': message['id'],
+            'message_id': message['message_id'],
+            'message': message['message'],
+            'created_at': message['created_at'],
+            'response': message['_response'] if ready else None,
+            'citation_source': {
+                'source_mapping': [{'match_string': chunk} for chunk in message['_citations']]
+            } if ready else None,
+        }
+
+    def stream_events(self, message):
+        """Yield (delay before the event, SSE payload) pairs for a streamed answer."""
+        self._count('streamed')
+        tokens = re.findall(r'\S+\s*', message['_response']) or [message['_response']]
+        first = message['first_token_at'] - message['created_at']
+        rest = message['ready_at'] - message['first_token_at']
+        step = rest / max(len(tokens) - 1, 1)
+        previous = 0.0
+        for i, token in enumerate(tokens):
+            at = first + i * step
+            yield at - previous, {'token': token}
+            previous = at
+        yield 0.0, self.public_message(message, now=message['ready_at'])
+
+    def get_message(self, chat_id, message_id):
+        chat = self.chats.get(chat_id)
+        for message in (chat or {}).get('messages', []):
+            if message['id'] == message_id:
+                return 200, self.public_message(message)
+        return 404, {'detail': 'Message not found'}
+
+    def get_chat(self, chat_id):
+        chat = self.chats.get(chat_id)
+        if chat is None:
+            return 404, {'detail': 'Chat not found'}
+        now = time.time()
+        return 200, {'chat_id': chat_id, 'name': chat['name'],
+                     'messages': [self.public_message(message, now) for message in list(chat['messages'])]}
+
+    # Knowledge base
+
+    def _ingest_pending(self):
+        now = time.time()
+        with self._lock:
+            ready = [key for key, (at, _) in self.pending_documents.items() if at <= now]
+            for key in ready:
+                self.corpus.set_document(key, self.pending_documents.pop(key)[1])
+
+    def document_chunks(self, body):
+        self._ingest_pending()
+        chunks = self.corpus.documents.get(body.get('content_key'))
+        if chunks is None:
+            return 404, {'detail': 'Document not found'}
+        page = int(body.get('page', 1))
+        page_size = max(int(body.get('page_size', 20)), 1)
+        start = (page - 1) * page_size
+        return 200, {
+            'chunks': [{'content': chunk} for chunk in chunks[start:start + page_size]],
+            'total_chunks': len(chunks),
+            'total_pages': max(math.ceil(len(chunks) / page_size), 1),
+            'page': page,
+        }
+
+    def knowledgebase(self, body):
+        self._ingest_pending()
+        page = int(body.get('page', 1))
+        page_size = max(int(body.get('page_size', 100)), 1)
+        keys = sorted(self.corpus.documents)
+        start = (page - 1) * page_size
+        return 200, {
+            'docs': [{'content_key': key, 'name': key, 'total_chunks': len(self.corpus.documents[key])}
+                     for key in keys[start:start + page_size]],
+            'total': len(keys),
+        }
+
+    def add_file(self, fields, files, sync):
+        upload = files.get('file')
+        if upload is None:
+            return 422, {'detail': 'No file'}
+        filename, content = upload
+        text = content.decode('utf-8', errors='ignore')
+        chunks = [text[i:i + self.chunk_size] for i in range(0, len(text), self.chunk_size)] or ['']
+        if sync:
+            with self._lock:
+                self.corpus.set_document(filename, chunks)
+        else:
+            with self._lock:
+                self.pending_documents[filename] = (time.time() + self.ingest_delay, chunks)
+        return 200, {'status': 'uploaded' if sync else 'processing', 'content_key': filename}
+
+    def delete_knowledge(self, body):
+        deleted = []
+        for resource in body.get('resources') or []:
+            name = resource.get('name')
+            with self._lock:
+                self.pending_documents.pop(name, None)
+                if self.corpus.delete_document(name):
+                    deleted.append(name)
+        return 200, {'deleted': deleted}
+
+
+def _parse_multipart(content_type, body):
+    """(form fields, {name: (filename, bytes)}) of a multipart/form-data body."""
+    message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+        b'Content-Type: ' + content_type.encode('latin-1') + b'\r\n\r\n' + body
+    )
+    fields = {}
+    files = {}
+    for part in message.iter_parts():
+        name = part.get_param('name', header='content-disposition')
+        payload = part.get_payload(decode=True) or b''
+        if part.get_filename():
+            files[name] = (part.get_filename(), payload)
+        else:
+            fields[name] = payload.decode('utf-8', errors='replace')
+    return fields, files
+
+
+ROUTES = [
+    ('POST', re.compile(r'^/chat/create$'), 'create_chat'),
+    ('POST', re.compile(r'^/v3/chat/message$'), 'message'),
+    ('GET', re.compile(r'^/project/[^/]+/chat/(?P<chat_id>[^/]+)/message/(?P<message_id>[^/]+)$'), 'get_message'),
+    ('GET', re.compile(r'^/project/[^/]+/chat/(?P<chat_id>[^/]+)$'), 'get_chat'),
+    ('POST', re.compile(r'^/project/[^/]+/document/chunks$'), 'document_chunks'),
+    ('POST', re.compile(r'^/v3/project/[^/]+/knowledgebase$'), 'knowledgebase'),
+    ('POST', re.compile(r'^/v3/project/knowledge/add/file$'), 'add_file'),
+    ('DELETE', re.compile(r'^/project/knowledge/delete$'), 'delete_knowledge'),
+]
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    simulator = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_stream(self, message):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        def chunk(text):
+            data = text.encode('utf-8')
+            self.wfile.write(f"{len(data):x}\r\n".encode('ascii') + data + b"\r\n")
+            self.wfile.flush()
+
+        for delay, event in self.simulator.stream_events(message):
+            if delay > 0:
+                time.sleep(delay)
+            chunk(f"data: {json.dumps(event)}\n\n")
+        chunk("data: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def _handle(self, method):
+        parsed = urlparse(self.path)
+        raw = self._body()
+        rejected = self.simulator.admit(method, parsed.path, raw)
+        if rejected is not None:
+            status, headers, body = rejected
+            return self._send_json(status, body, headers)
+        for route_method, pattern, name in ROUTES:
+            match = pattern.match(parsed.path)
+            if route_method == method and match:
+                return self._dispatch(name, match.groupdict(), parse_qs(parsed.query), raw)
+        self._send_json(404, {'detail': 'Not found'})
+
+    def _dispatch(self, name, params, query, raw):
+        sim = self.simulator
+        content_type = self.headers.get('Content-Type', '')
+        if content_type.startswith('multipart/form-data'):
+            form, files = _parse_multipart(content_type, raw)
+        elif content_type.startswith('application/x-www-form-urlencoded'):
+            form, files = {k: v[0] for k, v in parse_qs(raw.decode('utf-8'), keep_blank_values=True).items()}, {}
+        else:
+            form, files = (json.loads(raw) if raw else {}), {}
+
+        if name == 'message':
+            status, message = sim.submit_message(form)
+            if status == 200 and form.get('stream') == 'true' and sim.stream:
+                return self._send_stream(message)
+            if status == 200:
+                return self._send_json(200, {'message_id': message['id'], 'chat_id': form.get('chat_id')})
+            return self._send_json(status, message)
+        if name == 'create_chat':
+            result = sim.create_chat(form)
+        elif name == 'get_message':
+            result = sim.get_message(params['chat_id'], params['message_id'])
+        elif name == 'get_chat':
+            result = sim.get_chat(params['chat_id'])
+        elif name == 'document_chunks':
+            result = sim.document_chunks(form)
+        elif name == 'knowledgebase':
+            result = sim.knowledgebase(form)
+        elif name == 'add_file':
+            result = sim.add_file(form, files, sync=query.get('sync', ['true'])[0] == 'true')
+        else:
+            result = sim.delete_knowledge(form)
+        self._send_json(*result)
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_DELETE(self):
+        self._handle('DELETE')
+
+
+class OdinSimulatorServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, simulator, host=SIM_HOST, port=SIM_PORT):
+        handler = type('Handler', (_Handler,), {'simulator': simulator})
+        super().__init__((host, port), handler)
+        self.simulator = simulator
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+
+def start(simulator=None, host=SIM_HOST, port=SIM_PORT):
+    """
+    Serve `simulator` (a default one if None) from a background thread. Pass
+    port=0 for a free port; point the scripts at it with
+    odin_client.configure(base_url=server.url) and stop it with server.shutdown().
+
+    Returns:
+        OdinSimulatorServer: The running server
+    """
+    server = OdinSimulatorServer(simulator or Simulator(), host, port)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    simulator = Simulator()
+    server = OdinSimulatorServer(simulator)
+    print(f"Odin simulator on {server.url}: {len(simulator.corpus.documents)} documents, "
+          f"{len(simulator.corpus.answers)} known questions")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(f"\nServed {simulator.counters}")
+        sys.exit(0)
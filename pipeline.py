@@ -0,0 +1,543 @@
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from functools import partial
+from dotenv import load_dotenv
+import qna_io
+import results_store
+import chunk_store
+import chats
+import uploader
+import citation_evalutation
+import retriever_evalutation
+import analysis
+import token_usage
+from upload_manifest import file_digest
+
+load_dotenv()
+
+"""
+One entry point for the whole evaluation, run as a graph of cached tasks.
+
+stage       task                             output
+upload      upload                           the knowledge base (only when DATASET_DIR exists)
+export      export                           chunks.sqlite, runs every time
+generate    generate                         questions_bank.jsonl
+chat        chat:N, per QnA/test_qna_N       QnA/file_ans_N.jsonl
+evaluate    evaluate:N, after chat:N         QnA/file_eval_N.jsonl
+citation    citation                         RetriverEval/citation_eval.jsonl
+retriever   retriever                        RetriverEval/retriever_eval.jsonl
+analyze     analyze                          the analysis.py report of the current file_eval_N
+
+Each task is stamped with a hash of its input files, the outputs of the tasks
+it depends on, its stage's config variables and the values its dependencies
+returned (export returns a digest of the knowledge base's chunks). Stamps and
+output hashes are kept in PIPELINE_STATE; a task whose stamp is unchanged and
+whose outputs are as it left them is skipped, and a task that reruns to the
+same outputs lets everything after it skip.
+
+When a chat or evaluate task reruns under the same config, records done before
+are not redone: answers are reused by question and scores by (question,
+response, ground truth), so editing one question asks and judges only that one.
+
+Ready tasks of different stages run in parallel on PIPELINE_WORKERS threads;
+tasks of one stage run one at a time, each being concurrent inside, except
+the chat tasks, whose stale files are answered together in one call so that
+questions of every file share one chat pool.
+
+`python pipeline.py [STAGE|TASK ...] [--force] [--dry-run] [--adopt]`
+STAGE|TASK   Run only these stages or tasks (default: all); others' outputs are used as they are
+--force      Rerun the selected tasks from scratch, e.g. after changing their code
+--dry-run    Print which tasks would run and why, without running them
+--adopt      Reuse every existing answer and score, whatever produced it, to take over
+             the outputs of the standalone scripts without asking or judging again
+
+file_ans_N always answers test_qna_N, as it does when chats.py is run on its own.
+
+Config (environment):
+PIPELINE_STATE     Path of the task state store           (default .pipeline.sqlite)
+PIPELINE_WORKERS   Tasks run at once                      (default 4)
+"""
+
+PROJECT_ID = os.getenv("PROJECT_ID")
+PIPELINE_STATE_PATH = os.getenv("PIPELINE_STATE", ".pipeline.sqlite")
+PIPELINE_WORKERS = int(os.getenv("PIPELINE_WORKERS", 4))
+QNA_DIR = 'QnA'
+BANK_PATH = 'questions_bank.jsonl'
+# The bank as the repo ships it; --adopt converts it to BANK_PATH instead of generating one.
+LEGACY_BANK_PATH = 'questions_bank.json'
+CITATION_OUTPUT_PATH = 'RetriverEval/citation_eval.jsonl'
+RETRIEVER_OUTPUT_PATH = 'RetriverEval/retriever_eval.jsonl'
+STAGES = ('upload', 'export', 'generate', 'chat', 'evaluate', 'citation', 'retriever', 'analyze')
+# Environment variables a stage's outputs depend on; changing one reruns the stage.
+STAGE_CONFIG = {
+    'upload': ('PROJECT_ID', 'DATASET_DIR'),
+    'export': ('PROJECT_ID', 'ODIN_BASE_URL'),
+    'generate': ('GENERATION_DEDUP', 'DEDUP_BACKEND', 'DEDUP_THRESHOLD', 'DEDUP_COSINE', 'DEDUP_NGRAM',
+                 'DEDUP_PERMUTATIONS', 'DEDUP_BANDS'),
+    'chat': ('PROJECT_ID', 'ODIN_BASE_URL'),
+    'evaluate': ('SIMILARITY_BACKEND', 'EVAL_CASCADE', 'CASCADE_EXACT_F1', 'CASCADE_TOLERANCE'),
+    'citation': ('PROJECT_ID', 'ODIN_BASE_URL', 'CITATION_NGRAM', 'CITATION_MATCH_THRESHOLD'),
+    'retriever': ('PROJECT_ID', 'ODIN_BASE_URL', 'RETRIEVER_K', 'CITATION_NGRAM', 'CITATION_MATCH_THRESHOLD'),
+    'analyze': ('RESULTS_STORE', 'BOOTSTRAP_RESAMPLES', 'BOOTSTRAP_CONFIDENCE', 'BOOTSTRAP_SEED'),
+}
+# Files --adopt reuses records from, besides the stage's own outputs.
+ADOPTED_FILES = {'chat': (QNA_DIR, 'file_ans'), 'evaluate': (QNA_DIR, 'file_eval')}
+# What chats.py adds to a test_qna record, in the order it adds them.
+ANSWER_FIELDS = ('timing', 'response')
+
+
+def stamp(*parts):
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def directory_listing(directory):
+    """(name, size, mtime) of every file in `directory`; cheaper than hashing a dataset on every run."""
+    listing = []
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if os.path.isfile(path):
+            st = os.stat(path)
+            listing.append((name, st.st_size, st.st_mtime_ns))
+    return listing
+
+
+def earlier_answers(paths):
+    """Question -> the answer fields of its last successful answer in the given file_ans files."""
+    answers = {}
+    for path in paths:
+        for q_n_a in qna_io.read_records(path):
+            if q_n_a.get('response') not in (None, 'failed'):
+                answers[q_n_a.get('question')] = {field: q_n_a[field] for field in ANSWER_FIELDS if field in q_n_a}
+    return answers
+
+
+class PipelineState:
+    """Stamp, config stamp, output hashes and returned value of every task's last successful run."""
+
+    def __init__(self, path=PIPELINE_STATE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS tasks (
+                name TEXT PRIMARY KEY,
+                stamp TEXT,
+                config_stamp TEXT,
+                outputs TEXT,
+                value TEXT,
+                finished_at REAL
+            )
+        """)
+        self._conn.commit()
+
+    def get(self, name):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT stamp, config_stamp, outputs, value FROM tasks WHERE name = ?", (name,)
+            ).fetchone()
+        if row is None:
+            return None
+        return {'stamp': row[0], 'config_stamp': row[1], 'outputs': json.loads(row[2]), 'value': json.loads(row[3])}
+
+    def put(self, name, task_stamp, config_stamp, outputs, value):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO tasks (name, stamp, config_stamp, outputs, value, finished_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (name, task_stamp, config_stamp, json.dumps(outputs), json.dumps(value), time.time())
+            )
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class Task:
+    """
+    One cached unit of work of a stage.
+
+    `run(earlier)` writes the task's `outputs` and returns a JSON value for
+    the tasks that depend on it; `earlier` lists earlier output files of the
+    stage whose records it may reuse. `fingerprint`, if given, is called for
+    anything else the task's result depends on, and an `always` task runs on
+    every pipeline run.
+
+    A task with a `batch` item runs together with the other tasks of its stage
+    that are ready at the same time, as one `run(items, earlier)` call over
+    the items of those that are not up to date.
+    """
+
+    def __init__(self, name, stage, run, inputs=(), outputs=(), deps=(), fingerprint=None, always=False,
+                 batch=None):
+        self.name = name
+        self.stage = stage
+        self.run = run
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.deps = list(deps)
+        self.fingerprint = fingerprint
+        self.always = always
+        self.batch = batch
+
+
+class Pipeline:
+    def __init__(self, state, force=False, adopt=False, workers=PIPELINE_WORKERS):
+        self.state = state
+        self.force = force
+        self.adopt = adopt
+        self.workers = workers
+        self.tasks = {}
+        self.values = {}
+        # One results store run per stage for the whole pipeline run.
+        self.run_ids = {stage: results_store.new_run_id(stage) for stage in ('chat', 'evaluation', 'citation', 'retriever')}
+        self._lock = threading.Lock()
+        self._digests = {}
+        self._earlier = {}
+        self._indexes = {}
+
+    def add(self, task):
+        self.tasks[task.name] = task
+        return task
+
+    def digest(self, path):
+        """sha256 of a file (None if missing), hashed again only when its size or mtime changes."""
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        key = (path, st.st_size, st.st_mtime_ns)
+        with self._lock:
+            if key in self._digests:
+                return self._digests[key]
+        value = file_digest(path)
+        with self._lock:
+            self._digests[key] = value
+        return value
+
+    def value(self, name):
+        """What task `name` returned this run, or on its last recorded run."""
+        if name in self.values:
+            return self.values[name]
+        record = self.state.get(name)
+        return record['value'] if record else None
+
+    def config_stamp(self, task):
+        config = {name: os.getenv(name) for name in STAGE_CONFIG[task.stage]}
+        return stamp(task.stage, config, [(dep, self.value(dep)) for dep in task.deps])
+
+    def task_stamp(self, task, config_stamp):
+        paths = task.inputs + [path for dep in task.deps for path in self.tasks[dep].outputs]
+        fingerprint = task.fingerprint() if task.fingerprint else None
+        return stamp(config_stamp, [(path, self.digest(path)) for path in paths], fingerprint)
+
+    def check(self, task):
+        """(why the task must run, or None if it is up to date, its stamp, config stamp, last record)."""
+        record = self.state.get(task.name)
+        config_stamp = self.config_stamp(task)
+        task_stamp = self.task_stamp(task, config_stamp)
+        if self.force:
+            reason = 'forced'
+        elif task.always:
+            reason = 'runs every time'
+        elif record is None:
+            reason = 'never run'
+        elif record['config_stamp'] != config_stamp:
+            reason = 'config or upstream value changed'
+        elif record['stamp'] != task_stamp:
+            reason = 'inputs changed'
+        elif any(self.digest(path) != digest for path, digest in record['outputs'].items()):
+            reason = 'outputs missing or modified'
+        else:
+            reason = None
+        return reason, task_stamp, config_stamp, record
+
+    def earlier_outputs(self, stage, config_stamp):
+        """
+        Output files of the stage's tasks last run under `config_stamp` (with
+        --adopt, every file of the stage), fixed at the stage's first task of
+        the run so that tasks do not reuse each other's fresh output.
+        """
+        with self._lock:
+            if stage not in self._earlier:
+                paths = set()
+                for task in self.tasks.values():
+                    record = self.state.get(task.name) if task.stage == stage else None
+                    if record and (self.adopt or record['config_stamp'] == config_stamp):
+                        paths.update(path for path in task.outputs if os.path.exists(path))
+                if self.adopt and stage in ADOPTED_FILES:
+                    paths.update(qna_io.list_files(*ADOPTED_FILES[stage]))
+                self._earlier[stage] = sorted(paths)
+            return self._earlier[stage]
+
+    def index(self, stage, build):
+        """`build()`, computed once per stage and run."""
+        with self._lock:
+            if stage not in self._indexes:
+                self._indexes[stage] = build()
+            return self._indexes[stage]
+
+    def execute(self, tasks):
+        """
+        Run those of `tasks` (one task, or a batch of one stage) that are not
+        up to date.
+
+        Returns:
+            dict: Task name -> 'up to date' or 'done in ...'
+        """
+        status = {}
+        stale = []
+        for task in tasks:
+            reason, task_stamp, config_stamp, record = self.check(task)
+            if reason is None:
+                self.values[task.name] = record['value']
+                status[task.name] = 'up to date'
+                continue
+            print(f"[{task.name}] running: {reason}")
+            stale.append((task, task_stamp, config_stamp))
+        if not stale:
+            return status
+        start = time.monotonic()
+        task, _, config_stamp = stale[0]
+        earlier = [] if self.force else self.earlier_outputs(task.stage, config_stamp)
+        if task.batch is None:
+            value = task.run(earlier)
+        else:
+            value = task.run([task.batch for task, _, _ in stale], earlier)
+        for task, task_stamp, config_stamp in stale:
+            self.values[task.name] = value
+            # Stamped after the run, so a dependency's value is what this run used.
+            self.state.put(task.name, task_stamp, config_stamp,
+                           {path: self.digest(path) for path in task.outputs}, value)
+            status[task.name] = f"done in {time.monotonic() - start:.1f}s"
+        return status
+
+    def plan(self, names):
+        """
+        Print why each task would run. A task after one that reruns is up to
+        date only if that one's outputs come out the same.
+        """
+        stale = set()
+        for name in names:
+            task = self.tasks[name]
+            reason = self.check(task)[0]
+            rerun = [dep for dep in task.deps if dep in stale]
+            if reason is None and rerun:
+                reason = f"if {rerun[0]} changes its outputs"
+            if reason is not None and not task.always:
+                stale.add(name)
+            print(f"{name:<20} {reason or 'up to date'}")
+
+    def run(self, names):
+        """
+        Run the named tasks (in graph order) as their dependencies finish.
+
+        Returns:
+            dict: Task name -> 'up to date', 'done in ...', 'failed' or 'blocked'
+        """
+        pending = [self.tasks[name] for name in names]
+        waiting = set(names)
+        status = {}
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while pending or running:
+                busy = {tasks[0].stage for tasks in running.values()}
+                ready = []
+                for task in list(pending):
+                    if any(dep in waiting for dep in task.deps):
+                        continue
+                    failed = [dep for dep in task.deps if status.get(dep) in ('failed', 'blocked')]
+                    if failed:
+                        pending.remove(task)
+                        waiting.discard(task.name)
+                        status[task.name] = 'blocked'
+                        print(f"[{task.name}] blocked: {failed[0]} did not finish")
+                        continue
+                    ready.append(task)
+                for task in ready:
+                    if len(running) >= self.workers:
+                        break
+                    if task.stage in busy:
+                        continue
+                    batch = [task]
+                    if task.batch is not None:
+                        batch = [other for other in ready if other.stage == task.stage]
+                    for other in batch:
+                        pending.remove(other)
+                    running[executor.submit(self.execute, batch)] = batch
+                    busy.add(task.stage)
+                if not running:
+                    continue
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    batch = running.pop(future)
+                    waiting.difference_update(task.name for task in batch)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        for task in batch:
+                            status[task.name] = 'failed'
+                            print(f"[{task.name}] failed: {type(e).__name__}: {e}")
+                        continue
+                    for task in batch:
+                        status[task.name] = result[task.name]
+                        print(f"[{task.name}] {status[task.name]}")
+        return status
+
+    def run_upload(self, earlier):
+        uploader.upload_files()
+
+    def run_export(self, earlier):
+        store = chunk_store.ChunkStore()
+        try:
+            docs = asyncio.run(chunk_store.export_chunks(PROJECT_ID, store))
+            content_keys = sorted(doc['content_key'] for doc in docs)
+            return {'content_keys': content_keys, 'digest': store.digest(content_keys)}
+        finally:
+            store.close()
+
+    def run_generate(self, earlier):
+        if self.adopt and not os.path.exists(BANK_PATH) and os.path.exists(LEGACY_BANK_PATH):
+            qna_io.convert(LEGACY_BANK_PATH)
+            return None
+        import generate_qna
+
+        export = self.value('export')
+        if not export:
+            raise RuntimeError("No export recorded; run the export stage first")
+        store = chunk_store.ChunkStore()
+        try:
+            generate_qna.generate_bank(store, export['content_keys'], BANK_PATH)
+        finally:
+            store.close()
+        return None
+
+    def run_chat(self, files, earlier):
+        answers = self.index('chat', lambda: earlier_answers(earlier))
+        reused = 0
+
+        def answered(q_n_a):
+            nonlocal reused
+            fields = answers.get(q_n_a.get('question'))
+            if fields is None:
+                return None
+            reused += 1
+            return {**q_n_a, **fields}
+
+        asyncio.run(chats.answer_files(files, PROJECT_ID, self.run_ids['chat'], answered=answered))
+        print(f"{len(files)} files answered, {reused} answers reused")
+        return None
+
+    def run_evaluate(self, src, dst, earlier):
+        import evaluation
+
+        scored = self.index('evaluate', lambda: evaluation.scored_rows(earlier))
+        if scored:
+            evaluation.seed_checkpoint(src, dst, scored)
+        evaluation.evaluate_files([(src, dst)], self.run_ids['evaluation'])
+        return None
+
+    def run_citation(self, earlier):
+        citation_evalutation.evaluate_bank(BANK_PATH, CITATION_OUTPUT_PATH, PROJECT_ID, run_id=self.run_ids['citation'])
+        return None
+
+    def run_retriever(self, earlier):
+        asyncio.run(retriever_evalutation.retrieve_bank(BANK_PATH, RETRIEVER_OUTPUT_PATH, PROJECT_ID))
+        retriever_evalutation.score_file(RETRIEVER_OUTPUT_PATH, run_id=self.run_ids['retriever'])
+        return None
+
+    def run_analyze(self, earlier):
+        # Evaluate tasks that were up to date wrote nothing under this run, so record their
+        # current scores in it too and report exactly the file_eval set of the pipeline.
+        store = results_store.get_store()
+        run_id = store.start_run('evaluation', self.run_ids['evaluation'])
+        for task in self.tasks.values():
+            for path in task.outputs if task.stage == 'evaluate' else ():
+                if os.path.exists(path):
+                    store.put_rows(run_id, 'evaluation', qna_io.stem(os.path.basename(path)),
+                                   enumerate(qna_io.read_records(path)))
+        try:
+            analysis.report([run_id])
+        except ImportError:
+            print("matplotlib or seaborn is not installed; skipping the metric correlation plot")
+        return None
+
+
+def _file_number(path, prefix):
+    number = qna_io.stem(os.path.basename(path))[len(prefix) + 1:]
+    return (0, int(number), number) if number.isdigit() else (1, 0, number)
+
+
+def build_tasks(pipeline):
+    """Add every task of the evaluation to `pipeline`, in dependency order."""
+    upload = []
+    if os.path.isdir(uploader.DATASET_DIR):
+        pipeline.add(Task('upload', 'upload', pipeline.run_upload, inputs=['deleted_files.txt'],
+                          fingerprint=partial(directory_listing, uploader.DATASET_DIR)))
+        upload = ['upload']
+    pipeline.add(Task('export', 'export', pipeline.run_export, deps=upload, always=True))
+    pipeline.add(Task('generate', 'generate', pipeline.run_generate, outputs=[BANK_PATH], deps=['export']))
+
+    answered = []
+    sources = sorted(qna_io.list_files(QNA_DIR, 'test_qna'), key=lambda path: _file_number(path, 'test_qna'))
+    for src in sources:
+        number = _file_number(src, 'test_qna')[2]
+        answers = os.path.join(QNA_DIR, f'file_ans_{number}.jsonl')
+        scores = os.path.join(QNA_DIR, f'file_eval_{number}.jsonl')
+        chat = pipeline.add(Task(f'chat:{number}', 'chat', pipeline.run_chat,
+                                 inputs=[src], outputs=[answers], deps=['export'], batch=(src, answers)))
+        evaluate = pipeline.add(Task(f'evaluate:{number}', 'evaluate', partial(pipeline.run_evaluate, answers, scores),
+                                     outputs=[scores], deps=[chat.name]))
+        answered += [chat.name, evaluate.name]
+
+    for name, run, output in (('citation', pipeline.run_citation, CITATION_OUTPUT_PATH),
+                              ('retriever', pipeline.run_retriever, RETRIEVER_OUTPUT_PATH)):
+        pipeline.add(Task(name, name, run, inputs=[BANK_PATH], outputs=[output], deps=['export', 'generate']))
+    pipeline.add(Task('analyze', 'analyze', pipeline.run_analyze, deps=answered))
+
+
+def main(args):
+    flags = {arg for arg in args if arg.startswith('--')}
+    names = [arg for arg in args if not arg.startswith('--')]
+    if flags - {'--force', '--dry-run', '--adopt'}:
+        print("Usage: python pipeline.py [STAGE|TASK ...] [--force] [--dry-run] [--adopt]")
+        return 1
+
+    state = PipelineState()
+    pipeline = Pipeline(state, force='--force' in flags, adopt='--adopt' in flags)
+    build_tasks(pipeline)
+    unknown = [name for name in names if name not in pipeline.tasks and name not in STAGES]
+    if unknown:
+        print(f"Unknown stage or task: {', '.join(unknown)}\nStages: {', '.join(STAGES)}")
+        return 1
+    selected = [name for name, task in pipeline.tasks.items() if not names or name in names or task.stage in names]
+    if 'upload' not in pipeline.tasks:
+        print(f"DATASET_DIR {uploader.DATASET_DIR} not found; skipping the upload stage")
+
+    if '--dry-run' in flags:
+        pipeline.plan(selected)
+        state.close()
+        return 0
+    status = pipeline.run(selected)
+    state.close()
+    token_usage.print_summary()
+
+    outcomes = {}
+    for value in status.values():
+        outcome = 'done' if value.startswith('done') else value
+        outcomes[outcome] = outcomes.get(outcome, 0) + 1
+    print("Pipeline summary:", outcomes)
+    return 1 if outcomes.get('failed') or outcomes.get('blocked') else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
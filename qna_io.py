@@ -0,0 +1,204 @@
+import json
+import os
+import re
+import sys
+
+"""
+Streaming readers and writers for the QnA artifacts.
+
+Records (test_qna_*, file_ans_*, file_eval_*, questions_bank, ...) are stored as
+JSONL, one JSON object per line, so stages can append as they go and read a
+record at a time. The original JSON array files are still readable: arrays are
+decoded incrementally, one element at a time, so neither format is ever loaded
+whole.
+
+`python qna_io.py convert [DIR_OR_FILE ...]` rewrites the JSON array files
+(default: everything under QnA/) as JSONL next to the originals; pass --remove
+to delete the .json files once converted.
+"""
+
+READ_CHUNK_SIZE = 1 << 16
+EXTENSIONS = ('.jsonl', '.json')
+_WHITESPACE = re.compile(r'[\s,]*')
+
+
+def _iter_json_array(f, chunk_size=READ_CHUNK_SIZE):
+    """Yield the elements of the JSON array in `f` without reading it whole."""
+    decoder = json.JSONDecoder()
+    buffer = ''
+    started = False
+    eof = False
+    while True:
+        position = _WHITESPACE.match(buffer).end()
+        if not started and position < len(buffer):
+            if buffer[position] != '[':
+                raise ValueError(f"Expected a JSON array in {getattr(f, 'name', f)}")
+            started = True
+            position = _WHITESPACE.match(buffer, position + 1).end()
+        if started and position < len(buffer) and buffer[position] == ']':
+            return
+        try:
+            if position >= len(buffer):
+                raise ValueError
+            record, end = decoder.raw_decode(buffer, position)
+        except ValueError:
+            # Element not complete yet: read more and try again.
+            if eof:
+                if buffer[position:].strip():
+                    raise ValueError(f"Truncated JSON array in {getattr(f, 'name', f)}")
+                return
+            chunk = f.read(chunk_size)
+            eof = not chunk
+            buffer = buffer[position:] + chunk
+            continue
+        yield record
+        buffer = buffer[end:]
+
+
+def read_records(path):
+    """
+    Records of a .jsonl or .json (array) file, one at a time.
+
+    Blank lines in JSONL are skipped, and so is a final line left half written
+    by a crash.
+    """
+    with open(path, 'r') as f:
+        if not path.endswith('.jsonl'):
+            yield from _iter_json_array(f)
+            return
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                # Only the last line can lack its newline.
+                if line.endswith('\n'):
+                    raise
+                print(f"Skipping truncated last record of {path}")
+
+
+def load_records(path):
+    """All records of `path` as a list; for small files and callers that need random access."""
+    return list(read_records(path))
+
+
+class RecordWriter:
+    """
+    Write records one at a time to `path` (.jsonl, or a JSON array for .json).
+
+    Records go to a temporary file that replaces `path` on close, so a reader
+    never sees a half-written artifact. Use as a context manager; on an
+    exception the temporary file is discarded.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        self._array = not path.endswith('.jsonl')
+        self._tmp_path = path + '.tmp'
+        self._f = open(self._tmp_path, 'w')
+        if self._array:
+            self._f.write('[')
+
+    def write(self, record):
+        if self._array and self.count:
+            self._f.write(', ')
+        self._f.write(json.dumps(record))
+        if not self._array:
+            self._f.write('\n')
+        self.count += 1
+
+    def close(self):
+        if self._f.closed:
+            return
+        if self._array:
+            self._f.write(']')
+        self._f.close()
+        os.replace(self._tmp_path, self.path)
+
+    def abort(self):
+        self._f.close()
+        os.remove(self._tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def write_records(path, records):
+    """Stream `records` (any iterable) to `path`. Returns how many were written."""
+    with RecordWriter(path) as writer:
+        for record in records:
+            writer.write(record)
+    return writer.count
+
+
+def append_record(f, record):
+    """Append one record to an open JSONL file."""
+    f.write(json.dumps(record) + '\n')
+
+
+def find_file(path_without_extension):
+    """The .jsonl or .json file for a name like 'QnA/file_eval_3', preferring JSONL; None if neither exists."""
+    for extension in EXTENSIONS:
+        if os.path.exists(path_without_extension + extension):
+            return path_without_extension + extension
+    return None
+
+
+def stem(file):
+    """'file_ans_3.jsonl' -> 'file_ans_3'."""
+    for extension in EXTENSIONS:
+        if file.endswith(extension):
+            return file[:-len(extension)]
+    return None
+
+
+def list_files(directory, prefix):
+    """
+    Paths of the record files in `directory` named `prefix` or `prefix_<suffix>`
+    (file_ans_3, citation_eval_bk), one per stem; when both a .jsonl and a .json
+    exist, the JSONL one wins. Dotted stems such as the file_eval_3.log
+    checkpoint logs are not record files and are left out.
+    """
+    pattern = re.compile(re.escape(prefix) + r'(_\w+)?')
+    found = {}
+    for file in sorted(os.listdir(directory)):
+        name = stem(file)
+        if name is None or not pattern.fullmatch(name):
+            continue
+        if name not in found or file.endswith('.jsonl'):
+            found[name] = os.path.join(directory, file)
+    return list(found.values())
+
+
+def convert(path, remove=False):
+    """Rewrite the JSON array file `path` as JSONL. Returns the new path."""
+    dst = path[:-len('.json')] + '.jsonl'
+    count = write_records(dst, read_records(path))
+    print(f"Converted {path} -> {dst} ({count} records)")
+    if remove:
+        os.remove(path)
+    return dst
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    if not args or args[0] != 'convert':
+        print("Usage: python qna_io.py convert [--remove] [DIR_OR_FILE ...]")
+        sys.exit(1)
+    remove = '--remove' in args
+    targets = [arg for arg in args[1:] if arg != '--remove'] or ['QnA']
+    for target in targets:
+        if os.path.isdir(target):
+            paths = [os.path.join(target, file) for file in sorted(os.listdir(target)) if file.endswith('.json')]
+        else:
+            paths = [target]
+        for path in paths:
+            convert(path, remove)
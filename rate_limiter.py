@@ -0,0 +1,510 @@
+import asyncio
+import email.utils
+import json
+import os
+import random
+import threading
+import time
+from collections import deque
+import httpx
+from dotenv import load_dotenv
+import token_usage
+
+load_dotenv()
+
+"""
+Shared scheduler for the OpenAI calls of a process (judge, generator, embeddings).
+
+The OpenAI clients built here send every request through an httpx transport
+that admits it only when its lane (one per API key and endpoint kind, chat or
+embeddings) has
+- a request and enough tokens left in its per-minute token buckets; a request's
+  tokens are estimated from its body (prompt characters / 4 plus its completion
+  allowance) and corrected with the usage its response reports, and
+- room under the lane's concurrency limit.
+
+The concurrency limit is adapted AIMD style: it grows by about one per limit's
+worth of successful calls, halves on a 429, and drops by a quarter when a call
+takes more than OPENAI_LATENCY_FACTOR times the lane's recent median (queueing
+on the server). A 429 pauses the lane for its Retry-After (or an exponential
+backoff) and the request is retried, up to OPENAI_MAX_ATTEMPTS times, so a rate
+limit delays rows instead of dropping them. A 429 for exhausted quota is not
+retried.
+
+Bucket sizes come from OPENAI_RPM / OPENAI_TPM, or else from the
+x-ratelimit-limit-* headers of the first response; a bucket never holds more
+than the x-ratelimit-remaining-* headers say is left. With several keys in
+OPENAI_API_KEYS each request goes to the lane that can take it first.
+
+Every request is also held against the run's token budget and its usage
+recorded by token_usage.py, with or without rate limiting.
+
+Config (environment):
+OPENAI_API_KEYS              Comma-separated keys to spread calls over    (default OPENAI_API_KEY)
+OPENAI_RPM, OPENAI_TPM       Chat requests / tokens per minute per key    (default from response headers)
+OPENAI_EMBEDDING_RPM, OPENAI_EMBEDDING_TPM   The same for embedding calls
+OPENAI_INITIAL_CONCURRENCY   Starting concurrency limit of a lane         (default 4)
+OPENAI_MAX_CONCURRENCY       Highest concurrency limit of a lane          (default 64)
+OPENAI_LATENCY_FACTOR        Latency over this times the median counts as congestion, 0 = off (default 4)
+OPENAI_MAX_ATTEMPTS          Attempts per request when rate limited      (default 8)
+OPENAI_RATE_LIMIT            Set to 'false' to send requests without scheduling them
+"""
+
+OPENAI_API_KEYS = [key for key in os.getenv("OPENAI_API_KEYS", os.getenv("OPENAI_API_KEY", "")).split(',') if key]
+OPENAI_RATE_LIMIT = os.getenv("OPENAI_RATE_LIMIT", "true").lower() == "true"
+OPENAI_INITIAL_CONCURRENCY = float(os.getenv("OPENAI_INITIAL_CONCURRENCY", 4))
+OPENAI_MAX_CONCURRENCY = float(os.getenv("OPENAI_MAX_CONCURRENCY", 64))
+OPENAI_LATENCY_FACTOR = float(os.getenv("OPENAI_LATENCY_FACTOR", 4))
+OPENAI_MAX_ATTEMPTS = int(os.getenv("OPENAI_MAX_ATTEMPTS", 8))
+
+
+def _per_minute(name):
+    value = os.getenv(name)
+    return float(value) if value else None
+
+
+# kind -> (requests per minute, tokens per minute); None = learn from the response headers.
+LIMITS = {
+    'chat': (_per_minute("OPENAI_RPM"), _per_minute("OPENAI_TPM")),
+    'embeddings': (_per_minute("OPENAI_EMBEDDING_RPM"), _per_minute("OPENAI_EMBEDDING_TPM")),
+}
+# Completion tokens assumed for a chat request that sets no max_tokens.
+COMPLETION_ESTIMATE = 256
+CHARS_PER_TOKEN = 4
+RATE_LIMIT_DECREASE = 0.5
+LATENCY_DECREASE = 0.75
+# Latencies kept per lane for the median, and how many before latency counts.
+LATENCY_WINDOW = 64
+LATENCY_MIN_SAMPLES = 16
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 60.0
+# How often a waiting async request checks again while its lane is at its concurrency limit.
+ASYNC_POLL = 0.05
+
+
+class TokenBucket:
+    """Per-minute budget refilled continuously; a None capacity is unlimited until set."""
+
+    def __init__(self, per_minute=None):
+        self.capacity = per_minute
+        self.level = per_minute
+        self._updated = time.monotonic()
+
+    def _refill(self, now):
+        if self.capacity is not None:
+            self.level = min(self.capacity, self.level + (now - self._updated) * self.capacity / 60)
+        self._updated = now
+
+    def wait_time(self, amount, now):
+        """Seconds until `amount` is available (a request larger than the bucket waits for a full one)."""
+        self._refill(now)
+        if self.capacity is None:
+            return 0.0
+        needed = min(amount, self.capacity)
+        return 0.0 if self.level >= needed else (needed - self.level) * 60 / self.capacity
+
+    def take(self, amount):
+        if self.capacity is not None:
+            self.level -= amount
+
+    def learn(self, per_minute):
+        if self.capacity is None and per_minute:
+            self.capacity = self.level = per_minute
+
+    def clamp(self, remaining, now):
+        self._refill(now)
+        if self.capacity is not None and remaining is not None:
+            self.level = min(self.level, remaining)
+
+
+class Lane:
+    """One API key's budget, concurrency limit and feedback state for one kind of call."""
+
+    def __init__(self, key, kind, initial=OPENAI_INITIAL_CONCURRENCY):
+        rpm, tpm = LIMITS[kind]
+        self.key = key
+        self.kind = kind
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.limit = initial
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.last_decrease = 0.0
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.stats = {'calls': 0, 'rate_limited': 0, 'congested': 0}
+
+    def wait_time(self, tokens, now):
+        """Seconds until a request of `tokens` can start here; None while at the concurrency limit."""
+        if self.in_flight >= int(self.limit):
+            return None
+        return max(self.paused_until - now, self.requests.wait_time(1, now), self.tokens.wait_time(tokens, now))
+
+    def median_latency(self):
+        ordered = sorted(self.latencies)
+        return ordered[len(ordered) // 2] if ordered else None
+
+
+class Lease:
+    def __init__(self, lane, tokens):
+        self.lane = lane
+        self.tokens = tokens
+        self.started = time.monotonic()
+
+
+def _header_number(headers, name):
+    try:
+        return float(headers[name])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def retry_after(headers):
+    """Seconds the server asks us to wait (retry-after-ms or retry-after, seconds or HTTP date), or None."""
+    milliseconds = _header_number(headers, 'retry-after-ms')
+    if milliseconds is not None:
+        return milliseconds / 1000
+    value = headers.get('retry-after')
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+class Scheduler:
+    """Admits requests into lanes and adapts each lane from its responses; shared by sync and async callers."""
+
+    def __init__(self, keys=None, initial=OPENAI_INITIAL_CONCURRENCY, max_concurrency=OPENAI_MAX_CONCURRENCY,
+                 latency_factor=OPENAI_LATENCY_FACTOR):
+        keys = keys if keys is not None else OPENAI_API_KEYS
+        self.max_concurrency = max_concurrency
+        self.latency_factor = latency_factor
+        self.lanes = {kind: [Lane(key, kind, initial) for key in keys or [None]] for kind in LIMITS}
+        self._condition = threading.Condition()
+
+    def _try_acquire(self, kind, tokens):
+        """(lease, None) when a lane takes the request now, else (None, seconds to wait or None)."""
+        now = time.monotonic()
+        ready = []
+        soonest = None
+        for lane in self.lanes[kind]:
+            wait = lane.wait_time(tokens, now)
+            if wait is None:
+                continue
+            if wait <= 0:
+                ready.append(lane)
+            elif soonest is None or wait < soonest:
+                soonest = wait
+        if not ready:
+            return None, soonest
+        lane = min(ready, key=lambda lane: lane.in_flight / lane.limit)
+        lane.in_flight += 1
+        lane.requests.take(1)
+        lane.tokens.take(tokens)
+        return Lease(lane, tokens), None
+
+    def acquire(self, kind, tokens):
+        with self._condition:
+            while True:
+                lease, wait = self._try_acquire(kind, tokens)
+                if lease is not None:
+                    return lease
+                # A finished call notifies; a budget refill does not, so wake up for it.
+                self._condition.wait(timeout=wait)
+
+    async def aacquire(self, kind, tokens):
+        while True:
+            with self._condition:
+                lease, wait = self._try_acquire(kind, tokens)
+            if lease is not None:
+                return lease
+            await asyncio.sleep(min(wait, 1.0) if wait is not None else ASYNC_POLL)
+
+    def _decrease(self, lane, factor, now):
+        # One decrease per round trip, however many calls of that round trip report it.
+        if now - lane.last_decrease < (lane.median_latency() or 1.0):
+            return
+        lane.limit = max(1.0, lane.limit * factor)
+        lane.last_decrease = now
+
+    def finish(self, lease, response, attempt, used_tokens=None):
+        """
+        Feed a response back into its lane.
+
+        Returns:
+            float: Seconds the lane now waits before its next call when the
+            response was a 429, else None
+        """
+        with self._condition:
+            lane = lease.lane
+            now = time.monotonic()
+            lane.in_flight -= 1
+            lane.stats['calls'] += 1
+            headers = response.headers
+            prefix = 'x-ratelimit-remaining-'
+            lane.requests.learn(_header_number(headers, 'x-ratelimit-limit-requests'))
+            lane.tokens.learn(_header_number(headers, 'x-ratelimit-limit-tokens'))
+            lane.requests.clamp(_header_number(headers, prefix + 'requests'), now)
+            lane.tokens.clamp(_header_number(headers, prefix + 'tokens'), now)
+            delay = None
+            if response.status_code == 429:
+                lane.stats['rate_limited'] += 1
+                delay = retry_after(headers)
+                if delay is None:
+                    delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (attempt - 1)) * random.uniform(0.5, 1.0)
+                lane.paused_until = max(lane.paused_until, now + delay)
+                self._decrease(lane, RATE_LIMIT_DECREASE, now)
+            else:
+                latency = now - lease.started
+                if used_tokens is not None:
+                    lane.tokens.take(used_tokens - lease.tokens)
+                median = lane.median_latency()
+                lane.latencies.append(latency)
+                if (self.latency_factor and len(lane.latencies) >= LATENCY_MIN_SAMPLES
+                        and latency > self.latency_factor * median):
+                    lane.stats['congested'] += 1
+                    self._decrease(lane, LATENCY_DECREASE, now)
+                elif response.status_code < 400:
+                    lane.limit = min(self.max_concurrency, lane.limit + 1 / lane.limit)
+            self._condition.notify_all()
+        return delay
+
+    def abandon(self, lease):
+        """Release a lease whose request failed without a response."""
+        with self._condition:
+            lease.lane.in_flight -= 1
+            self._condition.notify_all()
+
+    def report(self):
+        """Per lane: calls, 429s, congestion signals and the concurrency limit it settled on."""
+        with self._condition:
+            return [
+                {'kind': lane.kind, 'key': f"...{lane.key[-4:]}" if lane.key else None, 'limit': round(lane.limit, 1),
+                 **lane.stats}
+                for lanes in self.lanes.values() for lane in lanes if lane.stats['calls']
+            ]
+
+
+def classify(request):
+    """(kind, estimated tokens) of an OpenAI request, or (None, 0) for anything not scheduled."""
+    path = request.url.path
+    kind = 'chat' if path.endswith('/chat/completions') else 'embeddings' if path.endswith('/embeddings') else None
+    if kind is None:
+        return None, 0
+    try:
+        body = json.loads(request.content or b'{}')
+    except ValueError:
+        return kind, COMPLETION_ESTIMATE
+    if kind == 'embeddings':
+        texts = body.get('input') or []
+        texts = [texts] if isinstance(texts, str) else texts
+        # Pre-tokenized input is a list of token ids.
+        return kind, sum(len(text) if isinstance(text, list) else len(str(text)) // CHARS_PER_TOKEN + 1
+                         for text in texts)
+    prompt = sum(len(json.dumps(message.get('content'))) for message in body.get('messages') or [])
+    completion = body.get('max_completion_tokens') or body.get('max_tokens') or COMPLETION_ESTIMATE
+    return kind, prompt // CHARS_PER_TOKEN + completion * body.get('n', 1)
+
+
+def _model(request):
+    try:
+        return json.loads(request.content or b'{}').get('model')
+    except (ValueError, AttributeError):
+        return None
+
+
+def _usage(response):
+    try:
+        return response.json()['usage']
+    except (ValueError, KeyError, TypeError):
+        return None
+
+
+def _used_tokens(response):
+    usage = _usage(response)
+    return usage.get('total_tokens') if isinstance(usage, dict) else None
+
+
+def _quota_exhausted(response):
+    try:
+        return response.json()['error']['code'] == 'insufficient_quota'
+    except (ValueError, KeyError, TypeError):
+        return False
+
+
+def _authorize(request, key):
+    if key:
+        request.headers['Authorization'] = f"Bearer {key}"
+
+
+def _streamed(response):
+    return response.headers.get('content-type', '').startswith('text/event-stream')
+
+
+def _over_budget(request):
+    """What a call the token budget does not allow gets instead: a 402 the OpenAI client raises without retrying."""
+    return httpx.Response(
+        402, headers={'x-should-retry': 'false'}, request=request,
+        json={'error': {'message': "Token budget reached (see token_usage.py)", 'type': 'budget_exceeded',
+                        'code': 'budget_exceeded'}}
+    )
+
+
+class RateLimitedTransport(httpx.BaseTransport):
+    def __init__(self, scheduler, transport=None):
+        self.scheduler = scheduler
+        self.transport = transport or httpx.HTTPTransport()
+
+    def handle_request(self, request):
+        kind, tokens = classify(request)
+        if kind is None:
+            return self.transport.handle_request(request)
+        ledger = token_usage.get_ledger()
+        reservation = ledger.reserve(kind, _model(request), tokens)
+        if reservation is None:
+            return _over_budget(request)
+        try:
+            response = self._send(request, kind, tokens)
+        except BaseException:
+            ledger.release(reservation)
+            raise
+        ledger.settle(reservation, None if _streamed(response) else _usage(response))
+        return response
+
+    def _send(self, request, kind, tokens):
+        if self.scheduler is None:
+            response = self.transport.handle_request(request)
+            if not _streamed(response):
+                response.read()
+            return response
+        for attempt in range(1, OPENAI_MAX_ATTEMPTS + 1):
+            lease = self.scheduler.acquire(kind, tokens)
+            _authorize(request, lease.lane.key)
+            try:
+                response = self.transport.handle_request(request)
+                if not _streamed(response):
+                    # Read here to learn the usage; the client gets the buffered body.
+                    response.read()
+            except Exception:
+                self.scheduler.abandon(lease)
+                raise
+            used = None if _streamed(response) else _used_tokens(response)
+            delay = self.scheduler.finish(lease, response, attempt, used)
+            if delay is None or attempt == OPENAI_MAX_ATTEMPTS or _quota_exhausted(response):
+                return response
+            print(f"OpenAI rate limit on {kind}, retrying in {delay:.1f}s (attempt {attempt}/{OPENAI_MAX_ATTEMPTS})")
+        return response
+
+
+class AsyncRateLimitedTransport(httpx.AsyncBaseTransport):
+    def __init__(self, scheduler, transport=None):
+        self.scheduler = scheduler
+        self.transport = transport or httpx.AsyncHTTPTransport()
+
+    async def handle_async_request(self, request):
+        kind, tokens = classify(request)
+        if kind is None:
+            return await self.transport.handle_async_request(request)
+        ledger = token_usage.get_ledger()
+        reservation = ledger.reserve(kind, _model(request), tokens)
+        if reservation is None:
+            return _over_budget(request)
+        try:
+            response = await self._send(request, kind, tokens)
+        except BaseException:
+            ledger.release(reservation)
+            raise
+        ledger.settle(reservation, None if _streamed(response) else _usage(response))
+        return response
+
+    async def _send(self, request, kind, tokens):
+        if self.scheduler is None:
+            response = await self.transport.handle_async_request(request)
+            if not _streamed(response):
+                await response.aread()
+            return response
+        for attempt in range(1, OPENAI_MAX_ATTEMPTS + 1):
+            lease = await self.scheduler.aacquire(kind, tokens)
+            _authorize(request, lease.lane.key)
+            try:
+                response = await self.transport.handle_async_request(request)
+                if not _streamed(response):
+                    await response.aread()
+            except BaseException:
+                # Cancelled requests give their slot back too.
+                self.scheduler.abandon(lease)
+                raise
+            used = None if _streamed(response) else _used_tokens(response)
+            delay = self.scheduler.finish(lease, response, attempt, used)
+            if delay is None or attempt == OPENAI_MAX_ATTEMPTS or _quota_exhausted(response):
+                return response
+            print(f"OpenAI rate limit on {kind}, retrying in {delay:.1f}s (attempt {attempt}/{OPENAI_MAX_ATTEMPTS})")
+        return response
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+
+_scheduler = None
+_clients = None
+_lock = threading.Lock()
+
+
+def get_scheduler():
+    global _scheduler
+    with _lock:
+        if _scheduler is None:
+            _scheduler = Scheduler()
+        return _scheduler
+
+
+def openai_clients():
+    """
+    (openai.OpenAI, openai.AsyncOpenAI) sharing the process-wide scheduler (none
+    with OPENAI_RATE_LIMIT=false) and token ledger, built once.
+    """
+    global _clients
+    import openai
+
+    scheduler = get_scheduler() if OPENAI_RATE_LIMIT else None
+    with _lock:
+        if _clients is None:
+            key = {'api_key': OPENAI_API_KEYS[0]} if OPENAI_API_KEYS else {}
+            _clients = (
+                openai.OpenAI(http_client=openai.DefaultHttpxClient(transport=RateLimitedTransport(scheduler)), **key),
+                openai.AsyncOpenAI(
+                    http_client=openai.DefaultAsyncHttpxClient(transport=AsyncRateLimitedTransport(scheduler)), **key
+                ),
+            )
+        return _clients
+
+
+def _model_kwargs(endpoint):
+    client, async_client = openai_clients()
+    kwargs = {'client': endpoint(client), 'async_client': endpoint(async_client)}
+    if OPENAI_API_KEYS:
+        kwargs['openai_api_key'] = OPENAI_API_KEYS[0]
+    return kwargs
+
+
+def chat_model_kwargs():
+    """Keyword arguments that send a langchain ChatOpenAI's calls through the scheduler and token ledger."""
+    return _model_kwargs(lambda client: client.chat.completions)
+
+
+def embeddings_kwargs():
+    """Keyword arguments that send a langchain OpenAIEmbeddings' calls through the scheduler and token ledger."""
+    return _model_kwargs(lambda client: client.embeddings)
+
+
+def print_stats():
+    if _scheduler is None:
+        return
+    for lane in _scheduler.report():
+        print(f"OpenAI {lane['kind']} {lane['key'] or ''}: {lane['calls']} calls, {lane['rate_limited']} rate limited, "
+              f"{lane['congested']} slow, concurrency limit {lane['limit']}")
@@ -0,0 +1,376 @@
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+import numpy as np
+import qna_io
+
+"""
+Indexed store of evaluation results across runs.
+
+Every metric of every row is one row of a long table keyed by run, file, row
+and metric, alongside the question (by hash) and the source document it came
+from. Stages write as rows are scored; the analysis scripts read metric columns
+straight into NumPy arrays and compute per-run / per-document / per-file
+breakdowns with grouped array operations instead of re-parsing result files.
+
+Stages:
+evaluation   answer_relevancy, answer_correctness, semantic_similarity   (QnA/file_eval_*)
+chat         time_to_answer, submit_latency, polls, retries,             (QnA/file_ans_*, from 'timing')
+             time_to_first_token, tokens_per_second
+citation     precision_score, redundancy_score, span_*                   (RetriverEval/citation_eval*)
+retriever    recall_at_k, precision, mrr, ndcg_at_k, latency             (RetriverEval/retriever_eval*)
+
+The `usage` table holds the tokens and cost of every OpenAI call, tagged with
+the run, stage, file, metric and question it was made for (see token_usage.py).
+
+Reads cover the given runs or, by default, the latest value of every row
+(by run start time), so rescoring a file replaces its scores in the analysis
+instead of adding a second sample of the same questions.
+
+Result files written before the store existed are imported by `backfill`; the
+analysis scripts do this automatically for every file that has no rows yet.
+
+Config (environment):
+RESULTS_STORE   Path of the SQLite store                            (default results.sqlite)
+RUN_ID          Run id to record results under                      (default <stage>-<timestamp>)
+"""
+
+RESULTS_STORE_PATH = os.getenv("RESULTS_STORE", "results.sqlite")
+
+STAGES = {
+    'evaluation': {
+        'directory': 'QnA', 'prefix': 'file_eval',
+        'metrics': ['answer_relevancy', 'answer_correctness', 'semantic_similarity'],
+    },
+    'citation': {
+        'directory': 'RetriverEval', 'prefix': 'citation_eval',
+        'metrics': ['precision_score', 'redundancy_score', 'span_precision', 'span_recall', 'span_f1'],
+    },
+    'chat': {
+        # Read from each record's 'timing' (see chats.new_stats) rather than the record itself.
+        'directory': 'QnA', 'prefix': 'file_ans', 'field': 'timing',
+        'metrics': ['time_to_answer', 'submit_latency', 'polls', 'retries', 'time_to_first_token',
+                    'tokens_per_second'],
+    },
+    'retriever': {
+        'directory': 'RetriverEval', 'prefix': 'retriever_eval',
+        'metrics': ['recall_at_k', 'precision', 'mrr', 'ndcg_at_k', 'latency', 'correctness'],
+    },
+}
+
+GROUP_COLUMNS = ('run_id', 'file', 'document')
+USAGE_GROUP_COLUMNS = ('run_id', 'stage', 'file', 'question_hash', 'metric', 'kind', 'model')
+# metadata is stored as the repr of a list of dicts; the first source names the document.
+SOURCE = re.compile(r"""['"]source['"]\s*:\s*['"]([^'"]+)['"]""")
+
+
+def new_run_id(stage):
+    return os.getenv("RUN_ID") or f"{stage}-{time.strftime('%Y%m%dT%H%M%S')}"
+
+
+def question_hash(question):
+    return hashlib.sha256((question or '').encode('utf-8')).hexdigest()
+
+
+def document_of(record):
+    metadata = record.get('metadata')
+    if isinstance(metadata, list) and metadata and isinstance(metadata[0], dict):
+        source = metadata[0].get('source')
+    else:
+        match = SOURCE.search(str(metadata or ''))
+        source = match.group(1) if match else None
+    return os.path.basename(source) if source else None
+
+
+def metric_value(value):
+    """A record's metric as a float (NaN when missing); file_eval stores one-element lists."""
+    if isinstance(value, list):
+        value = value[0] if value else None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return float('nan')
+
+
+class ResultsStore:
+    def __init__(self, path=RESULTS_STORE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS runs (
+                run_id TEXT PRIMARY KEY,
+                stage TEXT,
+                started_at REAL,
+                note TEXT
+            );
+            CREATE TABLE IF NOT EXISTS questions (
+                question_hash TEXT PRIMARY KEY,
+                question TEXT
+            );
+            CREATE TABLE IF NOT EXISTS results (
+                run_id TEXT,
+                stage TEXT,
+                file TEXT,
+                row INTEGER,
+                question_hash TEXT,
+                document TEXT,
+                metric TEXT,
+                value REAL,
+                PRIMARY KEY (run_id, file, row, metric)
+            );
+            CREATE INDEX IF NOT EXISTS results_stage_metric ON results (stage, metric, run_id);
+            CREATE INDEX IF NOT EXISTS results_question ON results (question_hash);
+            CREATE TABLE IF NOT EXISTS usage (
+                run_id TEXT,
+                stage TEXT,
+                file TEXT,
+                question_hash TEXT,
+                metric TEXT,
+                kind TEXT,
+                model TEXT,
+                prompt_tokens INTEGER,
+                completion_tokens INTEGER,
+                cost REAL,
+                at REAL
+            );
+            CREATE INDEX IF NOT EXISTS usage_run ON usage (run_id, stage, metric);
+        """)
+        self._conn.commit()
+
+    def start_run(self, stage, run_id=None, note=None):
+        """Register a run (idempotent) and return its id."""
+        run_id = run_id or new_run_id(stage)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO runs (run_id, stage, started_at, note) VALUES (?, ?, ?, ?)",
+                (run_id, stage, time.time(), note)
+            )
+            self._conn.commit()
+        return run_id
+
+    def put_rows(self, run_id, stage, file, rows):
+        """
+        Record the metrics of `rows`, an iterable of (row index, record) pairs,
+        replacing earlier values for the same run, file, row and metric.
+
+        Returns:
+            int: Number of rows written
+        """
+        config = STAGES[stage]
+        metrics = config['metrics']
+        questions = []
+        values = []
+        for row, record in rows:
+            q_hash = question_hash(record.get('question'))
+            questions.append((q_hash, record.get('question')))
+            document = document_of(record)
+            source = (record.get(config['field']) or {}) if 'field' in config else record
+            for metric in metrics:
+                if metric in source:
+                    values.append((run_id, stage, file, row, q_hash, document, metric, metric_value(source[metric])))
+        with self._lock:
+            self._conn.executemany("INSERT OR IGNORE INTO questions (question_hash, question) VALUES (?, ?)", questions)
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO results (run_id, stage, file, row, question_hash, document, metric, value) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)", values
+            )
+            self._conn.commit()
+        return len(questions)
+
+    def put_usage(self, rows):
+        """Record OpenAI calls, dicts with the usage table's columns (see token_usage.py)."""
+        columns = ('run_id', 'stage', 'file', 'question_hash', 'metric', 'kind', 'model', 'prompt_tokens',
+                   'completion_tokens', 'cost', 'at')
+        with self._lock:
+            self._conn.executemany(
+                f"INSERT INTO usage ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+                [tuple(row.get(column) for column in columns) for row in rows]
+            )
+            self._conn.commit()
+
+    def usage_breakdown(self, by=('run_id', 'stage', 'metric'), run_ids=None):
+        """
+        Calls, tokens, cost and distinct questions of the recorded OpenAI calls,
+        grouped by the `by` columns of the usage table.
+
+        Returns:
+            list: One dict per group, ordered by the group columns
+        """
+        if not set(by) <= set(USAGE_GROUP_COLUMNS):
+            raise ValueError(f"Can only group usage by {USAGE_GROUP_COLUMNS}")
+        query = (f"SELECT {', '.join(by)}, COUNT(*), SUM(prompt_tokens), SUM(completion_tokens), SUM(cost), "
+                 f"COUNT(DISTINCT question_hash) FROM usage")
+        params = []
+        if run_ids:
+            query += f" WHERE run_id IN ({', '.join('?' * len(run_ids))})"
+            params.extend(run_ids)
+        query += f" GROUP BY {', '.join(by)} ORDER BY {', '.join(by)}"
+        with self._lock:
+            rows = self._conn.execute(query, params).fetchall()
+        fields = tuple(by) + ('calls', 'prompt_tokens', 'completion_tokens', 'cost', 'questions')
+        return [dict(zip(fields, row)) for row in rows]
+
+    def runs(self, stage=None):
+        query = "SELECT run_id, stage, started_at, note FROM runs"
+        params = ()
+        if stage is not None:
+            query += " WHERE stage = ?"
+            params = (stage,)
+        with self._lock:
+            rows = self._conn.execute(query + " ORDER BY started_at", params).fetchall()
+        return [dict(zip(('run_id', 'stage', 'started_at', 'note'), row)) for row in rows]
+
+    def files(self, stage):
+        """Files the stage has rows for."""
+        with self._lock:
+            rows = self._conn.execute("SELECT DISTINCT file FROM results WHERE stage = ?", (stage,)).fetchall()
+        return {file for file, in rows}
+
+    def _select(self, columns, stage, metric, run_ids):
+        """
+        Query for `columns` of the results of `metric`: every value recorded in
+        `run_ids`, or without them the latest value of each (file, row).
+        """
+        if run_ids:
+            return (f"SELECT {columns} FROM results WHERE stage = ? AND metric = ? "
+                    f"AND run_id IN ({', '.join('?' * len(run_ids))})", [stage, metric, *run_ids])
+        return (f"SELECT {columns} FROM ("
+                "SELECT results.*, ROW_NUMBER() OVER ("
+                "PARTITION BY results.file, results.row ORDER BY runs.started_at DESC, results.run_id DESC"
+                ") AS recency FROM results LEFT JOIN runs ON runs.run_id = results.run_id "
+                "WHERE results.stage = ? AND results.metric = ?"
+                ") WHERE recency = 1", [stage, metric])
+
+    def values(self, stage, metric, run_ids=None):
+        """
+        Values of `metric` as a float array (NaN for missing scores): those of
+        `run_ids`, or the latest of every row.
+        """
+        with self._lock:
+            rows = self._conn.execute(*self._select("value", stage, metric, run_ids)).fetchall()
+        return np.fromiter((np.nan if value is None else value for value, in rows), dtype=np.float64, count=len(rows))
+
+    def columns(self, stage, metric, by='run_id', run_ids=None):
+        """(group labels, values) arrays of `metric` as `values` selects them, labelled by the `by` column."""
+        if by not in GROUP_COLUMNS:
+            raise ValueError(f"Can only group by one of {GROUP_COLUMNS}")
+        with self._lock:
+            rows = self._conn.execute(*self._select(f"COALESCE({by}, ''), value", stage, metric, run_ids)).fetchall()
+        labels = np.array([label for label, _ in rows], dtype=object)
+        values = np.fromiter((np.nan if value is None else value for _, value in rows), dtype=np.float64, count=len(rows))
+        return labels, values
+
+    def by_question(self, stage, metric, run_id):
+        """
+        (question hashes, values) of `metric` in one run, sorted by hash; a
+        question scored more than once in the run gets its mean. Missing scores
+        are left out.
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT question_hash, AVG(value) FROM results WHERE stage = ? AND metric = ? AND run_id = ? "
+                "AND value IS NOT NULL GROUP BY question_hash ORDER BY question_hash", (stage, metric, run_id)
+            ).fetchall()
+        hashes = np.array([q_hash for q_hash, _ in rows], dtype=object)
+        values = np.fromiter((value for _, value in rows), dtype=np.float64, count=len(rows))
+        return hashes, values
+
+    def breakdown(self, stage, metric, by='run_id', run_ids=None, percentiles=(10, 50, 90)):
+        """
+        Count, mean and percentiles of `metric` per run, document or file.
+
+        NaN scores are dropped. Percentiles are computed for all groups at once
+        from one sort (linear interpolation, as np.percentile).
+
+        Returns:
+            dict: group -> {'count', 'avg', 'p<q>'...}
+        """
+        labels, values = self.columns(stage, metric, by, run_ids)
+        keep = ~np.isnan(values)
+        labels, values = labels[keep], values[keep]
+        if len(values) == 0:
+            return {}
+        groups, codes = np.unique(labels.astype(str), return_inverse=True)
+        counts = np.bincount(codes, minlength=len(groups))
+        means = np.bincount(codes, weights=values, minlength=len(groups)) / counts
+        order = np.lexsort((values, codes))
+        ordered = values[order]
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        stats = {'count': counts, 'avg': means}
+        for q in percentiles:
+            position = starts + (counts - 1) * (q / 100)
+            lower = np.floor(position).astype(np.int64)
+            upper = np.ceil(position).astype(np.int64)
+            stats[f'p{q}'] = ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+        return {
+            group: {name: column[i].item() for name, column in stats.items()}
+            for i, group in enumerate(groups.tolist())
+        }
+
+    def backfill(self, stage, run_id=None, directory=None):
+        """
+        Import the stage's result files (JSON or JSONL) that have no rows in the
+        store yet, as one run.
+
+        Returns:
+            int: Number of rows imported
+        """
+        config = STAGES[stage]
+        directory = directory or config['directory']
+        recorded = self.files(stage)
+        paths = [path for path in qna_io.list_files(directory, config['prefix'])
+                 if qna_io.stem(os.path.basename(path)) not in recorded]
+        if not paths:
+            return 0
+        run_id = self.start_run(stage, run_id or f"{stage}-backfill", note=f"imported from {directory}")
+        total = 0
+        for path in paths:
+            file = qna_io.stem(os.path.basename(path))
+            total += self.put_rows(run_id, stage, file, enumerate(qna_io.read_records(path)))
+        print(f"Imported {total} {stage} rows from {len(paths)} files in {directory} as run {run_id}")
+        return total
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+_store = None
+
+
+def get_store():
+    global _store
+    if _store is None:
+        _store = ResultsStore()
+    return _store
+
+
+def load_metrics(stage, run_ids=None, metrics=None):
+    """
+    {metric: list of values} for a stage, NaN scores dropped; the shape the
+    analysis scripts' load_metrics_from_files has always returned. Values are
+    those of `run_ids`, or the latest of every row. Result files the store has
+    no rows for are imported first.
+    """
+    store = get_store()
+    store.backfill(stage)
+    loaded = {}
+    for metric in metrics or STAGES[stage]['metrics']:
+        values = store.values(stage, metric, run_ids)
+        loaded[metric] = values[~np.isnan(values)].tolist()
+    return loaded
+
+
+def print_breakdown(stage, by='run_id', run_ids=None):
+    store = get_store()
+    store.backfill(stage)
+    for metric in STAGES[stage]['metrics']:
+        print(f"\n{metric} by {by}:")
+        for group, stats in store.breakdown(stage, metric, by, run_ids).items():
+            print(f"  {group or '-'}: n={stats['count']} avg={stats['avg']:.3f} "
+                  f"p10={stats['p10']:.3f} p50={stats['p50']:.3f} p90={stats['p90']:.3f}")
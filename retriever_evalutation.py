@@ -1,2 +1,169 @@
+import asyncio
+import os
+import sys
+import time
+from collections import deque
+import numpy as np
+from dotenv import load_dotenv
+import odin_client
+import qna_io
+import results_store
+import citation_matching
+from chats import ChatPool, ask_question_async
 
+load_dotenv()
 
+"""
+Ranked retrieval benchmark over the question bank.
+
+Every question is asked with the extended response, and the chunks the agent
+cites, in the order it cites them, are taken as its ranked retrieval. Each
+retrieved chunk is matched to the question's relevant chunks with the fuzzy
+matcher in citation_matching.py, and the whole bank is scored at once:
+
+recall_at_k   relevant chunks found in the top k / relevant chunks
+precision     retrieved chunks in the top k that match a relevant chunk / retrieved in the top k
+mrr           1 / rank of the first retrieved chunk that matches a relevant chunk (0 if none)
+ndcg_at_k     nDCG with graded relevance: relevant_chunks are ordered by relevance, so of m
+              chunks the first has gain m and the last gain 1; a chunk counts once, at its
+              first retrieval
+latency       seconds from submitting the question to receiving the answer
+
+Results go to RetriverEval/retriever_eval.jsonl and the results store.
+`python retriever_evalutation.py score [FILE]` rescores an existing file.
+
+Config (environment):
+RETRIEVER_K             Cut-off rank k                           (default 5)
+RETRIEVER_CONCURRENCY   Questions in flight                      (default 4)
+"""
+
+PROJECT_ID = os.getenv("PROJECT_ID")
+RETRIEVER_K = int(os.getenv("RETRIEVER_K", 5))
+RETRIEVER_CONCURRENCY = int(os.getenv("RETRIEVER_CONCURRENCY", 4))
+OUTPUT_PATH = 'RetriverEval/retriever_eval.jsonl'
+
+
+def get_ranked_chunks(message):
+    """Chunks cited in an extended chat response, in citation order, without repeats."""
+    ranked = []
+    for source in (message.get("citation_source") or {}).get("source_mapping") or []:
+        chunk = source.get("match_string")
+        if chunk and chunk not in ranked:
+            ranked.append(chunk)
+    return ranked
+
+
+async def retrieve(pool, q_n_a, project_id):
+    """Ask one question and record its ranked chunks and latency on the record."""
+    question = q_n_a['question']
+    try:
+        chat_id = await pool.acquire()
+    except RuntimeError as e:
+        print(e)
+        q_n_a.update({'retrieved_chunks': [], 'retrieval_failed': True, 'latency': None})
+        return q_n_a
+    try:
+        start = time.monotonic()
+        message = await ask_question_async(question, project_id, chat_id, extended_response=True)
+        latency = time.monotonic() - start
+    finally:
+        pool.release(chat_id)
+    failed = message == 'failed'
+    q_n_a.update({
+        'retrieved_chunks': [] if failed else get_ranked_chunks(message),
+        'retrieval_failed': failed,
+        'latency': None if failed else latency,
+    })
+    print(f"Retrieved {len(q_n_a['retrieved_chunks'])} chunks in {latency:.2f}s: {question}")
+    return q_n_a
+
+
+async def retrieve_bank(bank_path, output_path, project_id, concurrency=RETRIEVER_CONCURRENCY):
+    """Stream the question bank through the agent, writing each record with its retrieval."""
+    pool = ChatPool(project_id, size=concurrency)
+    window = deque()
+    with qna_io.RecordWriter(output_path) as writer:
+        for q_n_a in qna_io.read_records(bank_path):
+            window.append(asyncio.ensure_future(retrieve(pool, q_n_a, project_id)))
+            if len(window) >= concurrency * 4:
+                writer.write(await window.popleft())
+        while window:
+            writer.write(await window.popleft())
+    await odin_client.aclose()
+
+
+def score_retrieval(retrieved, relevant_chunks, k=RETRIEVER_K):
+    """
+    Ranked retrieval metrics for every question at once.
+
+    Args:
+        retrieved (list): Per question, retrieved chunk texts in rank order
+        relevant_chunks (list): Per question, relevant chunk texts, most relevant first
+        k (int): Cut-off rank
+
+    Returns:
+        dict: Metric name -> array with one value per question (NaN when undefined)
+    """
+    n_questions = len(retrieved)
+    depth = max([len(r) for r in retrieved] + [k])
+    n_retrieved = np.array([len(r) for r in retrieved], dtype=np.int64)
+    n_relevant = np.array([len(r) for r in relevant_chunks], dtype=np.int64)
+
+    # Relevant position matched by the item at each (question, rank); -1 for none or padding.
+    matches = citation_matching.best_matches(retrieved, relevant_chunks)
+    question = np.repeat(np.arange(n_questions), n_retrieved)
+    rank = np.arange(len(question)) - np.repeat(np.cumsum(n_retrieved) - n_retrieved, n_retrieved)
+    matched = np.full((n_questions, depth), -1, dtype=np.int64)
+    matched[question, rank] = matches
+    hit = matched >= 0
+
+    # Credit each relevant chunk only at the first rank that retrieves it.
+    first_credit = np.zeros_like(hit)
+    q, r = np.nonzero(hit)
+    _, first = np.unique(q * (n_relevant.max(initial=0) + 1) + matched[q, r], return_index=True)
+    first_credit[q[first], r[first]] = True
+
+    discount = 1 / np.log2(np.arange(2, depth + 2))
+    gain = np.where(first_credit, n_relevant[:, None] - matched, 0)
+    dcg = (gain[:, :k] * discount[:k]).sum(axis=1)
+    ideal = np.clip(n_relevant[:, None] - np.arange(k), 0, None)
+    idcg = (ideal * discount[:k]).sum(axis=1)
+
+    first_hit = np.where(hit.any(axis=1), hit.argmax(axis=1), -1)
+    top = np.minimum(n_retrieved, k)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return {
+            'recall_at_k': np.where(n_relevant > 0, first_credit[:, :k].sum(axis=1) / n_relevant, np.nan),
+            'precision': np.where(top > 0, hit[:, :k].sum(axis=1) / top, np.nan),
+            'mrr': np.where(first_hit >= 0, 1 / (first_hit + 1), 0.0),
+            'ndcg_at_k': np.where(idcg > 0, dcg / idcg, np.nan),
+        }
+
+
+def score_file(path, k=RETRIEVER_K, run_id=None):
+    """Score every retrieved record of `path` in one pass, rewrite it and record the scores."""
+    records = qna_io.load_records(path)
+    scored = [record for record in records if not record.get('retrieval_failed', True)]
+    scores = score_retrieval([r['retrieved_chunks'] for r in scored], [r['relevant_chunks'] for r in scored], k)
+    for i, record in enumerate(scored):
+        record.update({metric: values[i].item() for metric, values in scores.items()})
+        record['k'] = k
+    qna_io.write_records(path, records)
+
+    store = results_store.get_store()
+    run_id = store.start_run('retriever', run_id)
+    store.put_rows(run_id, 'retriever', qna_io.stem(os.path.basename(path)), enumerate(records))
+    print(f"Scored {len(scored)} of {len(records)} questions (k={k}), recorded as run {run_id}")
+    for metric, values in scores.items():
+        print(f"{metric}: {np.nanmean(values):.3f}" if len(values) else f"{metric}: -")
+    latencies = np.array([r['latency'] for r in scored if r.get('latency') is not None])
+    if len(latencies):
+        print(f"latency: p50 {np.percentile(latencies, 50):.2f}s, p90 {np.percentile(latencies, 90):.2f}s")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == 'score':
+        score_file(sys.argv[2] if len(sys.argv) > 2 else OUTPUT_PATH)
+        sys.exit(0)
+    asyncio.run(retrieve_bank(qna_io.find_file('questions_bank'), OUTPUT_PATH, PROJECT_ID))
+    score_file(OUTPUT_PATH)
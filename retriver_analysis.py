@@ -1,26 +1,13 @@
-import os
-import json
+import sys
 import numpy as np
+import results_store
 
-def load_metrics_from_files():
-    metrics = {
-        'correctness': [],
-        'precision': [],
-    }
-    
-    for file in os.listdir('RetriverEval'):
-        if not file.startswith('retriever_eval') or not file.endswith('.json'):
-            continue
-            
-        with open(f'RetriverEval/{file}', 'r') as f:
-            data = json.loads(f.read())
-            for entry in data:
-                for metric in metrics.keys():
-                    value = entry.get(metric)
-                    if value is not None and not np.isnan(value):
-                        metrics[metric].append(value)
-                        
-    return metrics
+def load_metrics_from_files(run_ids=None):
+    """
+    Retriever metrics from the results store: the latest score of every row, or
+    those of `run_ids`. retriever_eval* files with no rows in the store are imported first.
+    """
+    return results_store.load_metrics('retriever', run_ids)
 
 def calculate_statistics(metrics):
     stats = {}
@@ -128,6 +115,10 @@ def plot_metric_correlations(metrics):
 
 
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == 'breakdown':
+        # python retriver_analysis.py breakdown [run_id|document|file] [RUN_ID ...]
+        results_store.print_breakdown('retriever', sys.argv[2] if len(sys.argv) > 2 else 'run_id', sys.argv[3:])
+        sys.exit(0)
     metrics = load_metrics_from_files()
     print("Loaded metrics:", {k: len(v) for k, v in metrics.items()})
     for metric, values in metrics.items():
@@ -0,0 +1,236 @@
+import contextlib
+import contextvars
+import json
+import os
+import sys
+import threading
+import time
+from dotenv import load_dotenv
+import results_store
+
+load_dotenv()
+
+"""
+Token and cost accounting for the OpenAI calls of a run, with an optional budget.
+
+Every call that reaches OpenAI (LLM cache hits cost nothing and are not seen)
+is recorded by the rate_limiter.py transport with the prompt and completion
+tokens its response reports, its cost from PRICES, and the tags in effect where
+it was made: run, stage, file, metric and question (see `tagged`). Records are
+saved to the results store's `usage` table and summarized at the end of a run;
+`python token_usage.py [RUN_ID ...]` reports earlier runs from the store.
+
+With a budget, each call first reserves its estimated cost (prompt characters
+/ 4 plus its completion allowance, at the higher of the model's prices). A call
+that would take the run past the budget is not sent: the transport answers it
+with a 402 that the OpenAI client does not retry, and the stages stop taking
+new work once `budget_reached()`, leaving what they finished saved.
+
+Config (environment):
+TOKEN_BUDGET_USD      Spend cap of a run in dollars, 0 = none                     (default 0)
+TOKEN_BUDGET_TOKENS   Token cap of a run, 0 = none                                (default 0)
+TOKEN_PRICES          JSON {"model": [input, output], ...} in dollars per million
+                      tokens, merged over PRICES
+"""
+
+TOKEN_BUDGET_USD = float(os.getenv("TOKEN_BUDGET_USD", 0))
+TOKEN_BUDGET_TOKENS = int(os.getenv("TOKEN_BUDGET_TOKENS", 0))
+# Dollars per million (input, output) tokens; a model matches its longest listed prefix.
+PRICES = {
+    'gpt-4o-mini': (0.15, 0.60),
+    'gpt-4o': (2.50, 10.00),
+    'gpt-4-turbo': (10.00, 30.00),
+    'gpt-4': (30.00, 60.00),
+    'gpt-3.5-turbo': (0.50, 1.50),
+    'text-embedding-3-small': (0.02, 0.0),
+    'text-embedding-3-large': (0.13, 0.0),
+    'text-embedding-ada-002': (0.10, 0.0),
+}
+PRICES.update({model: tuple(price) for model, price in json.loads(os.getenv("TOKEN_PRICES") or '{}').items()})
+TAGS = ('run_id', 'stage', 'file', 'metric', 'question_hash')
+FLUSH_ROWS = 100
+
+_tags = contextvars.ContextVar('token_usage_tags', default={})
+
+
+class BudgetExceeded(Exception):
+    """Raised by a stage that stopped because the run's token budget was reached."""
+
+
+@contextlib.contextmanager
+def tagged(**tags):
+    """Tag the OpenAI calls made inside the block (and the tasks it starts) with `tags`, over the enclosing ones."""
+    token = _tags.set({**_tags.get(), **{name: value for name, value in tags.items() if value is not None}})
+    try:
+        yield
+    finally:
+        _tags.reset(token)
+
+
+def price(model):
+    """(input, output) dollars per token of `model`, or None if it has no price."""
+    matches = [name for name in PRICES if (model or '').startswith(name)]
+    if not matches:
+        return None
+    prompt, completion = PRICES[max(matches, key=len)]
+    return prompt / 1e6, completion / 1e6
+
+
+class Reservation:
+    def __init__(self, kind, model, tokens, cost, tags):
+        self.kind = kind
+        self.model = model
+        self.tokens = tokens
+        self.cost = cost
+        self.tags = tags
+
+
+class Ledger:
+    """Spend of the process so far, checked against the budget; shared by every thread and event loop."""
+
+    def __init__(self, budget_usd=TOKEN_BUDGET_USD, budget_tokens=TOKEN_BUDGET_TOKENS):
+        self.budget_usd = budget_usd
+        self.budget_tokens = budget_tokens
+        self.run_id = results_store.new_run_id('usage')
+        self.spent_usd = 0.0
+        self.spent_tokens = 0
+        self.reserved_usd = 0.0
+        self.reserved_tokens = 0
+        self.refused = 0
+        # (stage, metric) -> calls, prompt tokens, completion tokens, cost, question hashes
+        self.totals = {}
+        self._unpriced = set()
+        self._pending = []
+        self._lock = threading.Lock()
+
+    def reserve(self, kind, model, tokens):
+        """
+        Hold the estimated cost of a call against the budget.
+
+        Returns:
+            Reservation: To settle or release once the call is over, or None if
+            the call would exceed the budget and must not be sent
+        """
+        rates = price(model)
+        cost = tokens * max(rates) if rates else 0.0
+        with self._lock:
+            if (self.budget_usd and self.spent_usd + self.reserved_usd + cost > self.budget_usd) or \
+                    (self.budget_tokens and self.spent_tokens + self.reserved_tokens + tokens > self.budget_tokens):
+                self.refused += 1
+                return None
+            self.reserved_usd += cost
+            self.reserved_tokens += tokens
+        return Reservation(kind, model, tokens, cost, _tags.get())
+
+    def release(self, reservation):
+        with self._lock:
+            self.reserved_usd -= reservation.cost
+            self.reserved_tokens -= reservation.tokens
+
+    def settle(self, reservation, usage):
+        """Replace the reservation with what the call used; `usage` is the response's usage object."""
+        if not usage:
+            self.release(reservation)
+            return
+        prompt_tokens = usage.get('prompt_tokens') or 0
+        completion_tokens = usage.get('completion_tokens') or 0
+        rates = price(reservation.model)
+        cost = prompt_tokens * rates[0] + completion_tokens * rates[1] if rates else 0.0
+        tags = reservation.tags
+        row = {
+            **{name: tags.get(name) for name in TAGS}, 'run_id': tags.get('run_id', self.run_id),
+            'kind': reservation.kind, 'model': reservation.model, 'prompt_tokens': prompt_tokens,
+            'completion_tokens': completion_tokens, 'cost': cost, 'at': time.time(),
+        }
+        with self._lock:
+            self.reserved_usd -= reservation.cost
+            self.reserved_tokens -= reservation.tokens
+            self.spent_usd += cost
+            self.spent_tokens += prompt_tokens + completion_tokens
+            total = self.totals.setdefault((row['stage'], row['metric']), [0, 0, 0, 0.0, set()])
+            total[0] += 1
+            total[1] += prompt_tokens
+            total[2] += completion_tokens
+            total[3] += cost
+            if row['question_hash']:
+                total[4].add(row['question_hash'])
+            unpriced = rates is None and reservation.model not in self._unpriced
+            if unpriced:
+                self._unpriced.add(reservation.model)
+            self._pending.append(row)
+            flush = len(self._pending) >= FLUSH_ROWS
+        if unpriced:
+            print(f"No price for model {reservation.model}; its calls are counted at $0 (see TOKEN_PRICES)")
+        if flush:
+            self.flush()
+
+    def budget_reached(self):
+        """Whether a call was refused or the spend is at the budget; stages stop taking new work once it is."""
+        with self._lock:
+            return self.refused > 0 or (self.budget_usd and self.spent_usd >= self.budget_usd) or \
+                (self.budget_tokens and self.spent_tokens >= self.budget_tokens)
+
+    def check(self, stage):
+        """Raise BudgetExceeded if the budget is reached, for a stage to stop on."""
+        if self.budget_reached():
+            raise BudgetExceeded(
+                f"{stage} stopped at the token budget: ${self.spent_usd:.4f} and {self.spent_tokens} tokens spent, "
+                f"{self.refused} calls not sent"
+            )
+
+    def flush(self):
+        """Save the records not saved yet to the results store."""
+        with self._lock:
+            rows, self._pending = self._pending, []
+        if rows:
+            results_store.get_store().put_usage(rows)
+
+    def print_summary(self):
+        self.flush()
+        with self._lock:
+            totals = sorted(self.totals.items(), key=lambda item: (item[0][0] or '', item[0][1] or ''))
+            spent_usd, spent_tokens, refused = self.spent_usd, self.spent_tokens, self.refused
+        if not totals and not refused:
+            return
+        print("\nOpenAI usage:")
+        print_rows([
+            {'stage': stage, 'metric': metric, 'calls': calls, 'prompt_tokens': prompt, 'completion_tokens': completion,
+             'cost': cost, 'questions': len(questions)}
+            for (stage, metric), (calls, prompt, completion, cost, questions) in totals
+        ], ('stage', 'metric'))
+        budget = [f"${self.budget_usd:g}" if self.budget_usd else '', f"{self.budget_tokens} tokens" if self.budget_tokens else '']
+        budget = ' and '.join(limit for limit in budget if limit)
+        print(f"Total ${spent_usd:.4f}, {spent_tokens} tokens" + (f" of a {budget} budget" if budget else '') +
+              (f", {refused} calls not sent over budget" if refused else ''))
+
+
+def print_rows(rows, by):
+    """Print usage rows (see ResultsStore.usage_breakdown) with the cost per question where questions are tagged."""
+    print(f"  {' / '.join(by):<40} {'calls':>7} {'prompt':>10} {'completion':>10} {'cost $':>10} {'$/question':>11}")
+    for row in rows:
+        label = ' / '.join(str(row[column] or '-') for column in by)
+        per_question = f"{row['cost'] / row['questions']:.6f}" if row['questions'] else '-'
+        print(f"  {label:<40} {row['calls']:>7} {row['prompt_tokens']:>10} {row['completion_tokens']:>10} "
+              f"{row['cost']:>10.4f} {per_question:>11}")
+
+
+_ledger = None
+_ledger_lock = threading.Lock()
+
+
+def get_ledger():
+    global _ledger
+    with _ledger_lock:
+        if _ledger is None:
+            _ledger = Ledger()
+        return _ledger
+
+
+def print_summary():
+    if _ledger is not None:
+        _ledger.print_summary()
+
+
+if __name__ == "__main__":
+    run_ids = sys.argv[1:] or None
+    print_rows(results_store.get_store().usage_breakdown(run_ids=run_ids), ('run_id', 'stage', 'metric'))
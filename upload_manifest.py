@@ -0,0 +1,121 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+MANIFEST_PATH = os.environ.get("UPLOAD_MANIFEST", "upload_manifest.sqlite")
+
+"""
+Content-hash manifest of the files uploaded to the knowledge base.
+
+One row per file name with the sha256 of its content and where it is in the
+upload lifecycle. A file whose digest matches an 'uploaded' row is skipped
+without asking the server, and rows left in 'uploading' by a crashed run are
+picked up again on the next one.
+
+status      meaning
+uploading   upload started but not confirmed
+processing  accepted by an async (sync=false) upload, waiting for its chunks
+uploaded    server accepted the file and chunked it
+failed      last upload attempt failed
+"""
+
+
+def file_digest(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+class UploadManifest:
+    def __init__(self, path=MANIFEST_PATH):
+        self.path = path
+        # Shared by the upload workers, so serialise access ourselves.
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS files (
+                name TEXT PRIMARY KEY,
+                sha256 TEXT,
+                size INTEGER,
+                mtime_ns INTEGER,
+                status TEXT,
+                error TEXT,
+                attempts INTEGER DEFAULT 0,
+                updated_at REAL
+            )
+        """)
+        try:
+            # Manifests written before async uploads have no attempt counter.
+            self._conn.execute("ALTER TABLE files ADD COLUMN attempts INTEGER DEFAULT 0")
+        except sqlite3.OperationalError:
+            pass
+        self._conn.commit()
+
+    def get(self, name):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT name, sha256, size, mtime_ns, status, error, attempts FROM files WHERE name = ?", (name,)
+            ).fetchone()
+        if row is None:
+            return None
+        return dict(zip(('name', 'sha256', 'size', 'mtime_ns', 'status', 'error', 'attempts'), row))
+
+    def digest(self, name, path):
+        """
+        sha256 of the file at `path`. The stored digest is reused while size and
+        mtime are unchanged, so unchanged files are not re-read on every run.
+        """
+        stat = os.stat(path)
+        row = self.get(name)
+        if row and row['sha256'] and row['size'] == stat.st_size and row['mtime_ns'] == stat.st_mtime_ns:
+            return row['sha256'], stat
+        return file_digest(path), stat
+
+    def mark(self, name, status, sha256=None, stat=None, error=None):
+        with self._lock:
+            self._conn.execute("""
+                INSERT INTO files (name, sha256, size, mtime_ns, status, error, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(name) DO UPDATE SET
+                    sha256 = COALESCE(excluded.sha256, sha256),
+                    size = COALESCE(excluded.size, size),
+                    mtime_ns = COALESCE(excluded.mtime_ns, mtime_ns),
+                    status = excluded.status,
+                    error = excluded.error,
+                    updated_at = excluded.updated_at
+            """, (
+                name, sha256,
+                stat.st_size if stat else None,
+                stat.st_mtime_ns if stat else None,
+                status, error, time.time()
+            ))
+            self._conn.commit()
+
+    def start_attempt(self, name, sha256, stat):
+        """Mark `name` as 'uploading' and return how many attempts it has had, this one included."""
+        self.mark(name, 'uploading', sha256, stat)
+        with self._lock:
+            self._conn.execute(
+                "UPDATE files SET attempts = COALESCE(attempts, 0) + 1 WHERE name = ?", (name,)
+            )
+            self._conn.commit()
+            return self._conn.execute("SELECT attempts FROM files WHERE name = ?", (name,)).fetchone()[0]
+
+    def reset_attempts(self, name):
+        with self._lock:
+            self._conn.execute("UPDATE files SET attempts = 0 WHERE name = ?", (name,))
+            self._conn.commit()
+
+    def with_status(self, status):
+        with self._lock:
+            rows = self._conn.execute("SELECT name FROM files WHERE status = ?", (status,)).fetchall()
+        return [row[0] for row in rows]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -4,40 +4,58 @@ from typing import Dict, Optional, BinaryIO
 import json
 import os
 import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import odin_client
+from upload_manifest import UploadManifest
 
-upload_endpoint = "http://localhost:8001/v3/project/knowledge/add/file?sync=true"
+upload_endpoint = "/v3/project/knowledge/add/file?sync=true"
+async_upload_endpoint = "/v3/project/knowledge/add/file?sync=false"
 
-X_API_KEY = os.environ.get("X_API_KEY")
-X_API_SECRET = os.environ.get("X_API_SECRET")
 project_id = os.environ.get("PROJECT_ID", "89d232ad59764da2b6118e")
+DATASET_DIR = os.environ.get("DATASET_DIR", "/Users/rohitjindal/del/files/datasets")
+UPLOAD_WORKERS = int(os.environ.get("UPLOAD_WORKERS", 8))
 
-def get_chunks_of_file(filename, headers):
-    chunks_endpoint =   f"http://localhost:8001/project/{project_id}/document/chunks"
-    response = requests.post(chunks_endpoint, headers=headers, json={"content_key":filename, "page":1, "page_size":20}  )
+# Async ingestion: upload with sync=false and poll the chunk listing for completion.
+UPLOAD_SYNC = os.environ.get("UPLOAD_SYNC", "true").lower() == "true"
+POLL_INTERVAL = float(os.environ.get("UPLOAD_POLL_INTERVAL", 5))
+POLL_BATCH = int(os.environ.get("UPLOAD_POLL_BATCH", 50))
+PROCESSING_TIMEOUT = float(os.environ.get("UPLOAD_PROCESSING_TIMEOUT", 600))
+MAX_UPLOAD_ATTEMPTS = int(os.environ.get("MAX_UPLOAD_ATTEMPTS", 3))
+
+def get_chunks_of_file(filename):
+    chunks_endpoint = f"/project/{project_id}/document/chunks"
+    response = odin_client.post(chunks_endpoint, json={"content_key":filename, "page":1, "page_size":20})
 
     return response
 
-def delete_file(filename, headers):
-    delete_endpoint = "http://localhost:8001/project/knowledge/delete"
+def delete_file(filename):
+    delete_endpoint = "/project/knowledge/delete"
     key_name = filename.replace(".", "_") 
     key_name = key_name.replace("-", "_") 
     json = {"project_id": project_id, "resources":[{"name":filename ,"key":f"_{project_id}_{key_name}"}]}
-    response = requests.delete(delete_endpoint, headers=headers, json=json)
+    response = odin_client.delete(delete_endpoint, json=json)
     if response.status_code == 200:
         print(f"Deleted file: {filename}")
         time.sleep(0.5)
     else:
         print(f"Failed to delete file: {filename} with status code {response.status_code}")
 
-def should_upload_file(filename, headers):
-    resp = get_chunks_of_file(filename, headers)
+def has_extraction_error(chunks):
+    return any(
+        "Error extracting data from image" in (chunk.get('content', '') if isinstance(chunk, dict) else chunk)
+        for chunk in chunks
+    )
+
+def should_upload_file(filename):
+    resp = get_chunks_of_file(filename)
     if resp.status_code != 200:
         print(f"Failed to get chunks of file: {filename} with status code {resp.status_code}, file might not exists")
         return True
     data = resp.json()
-    if len(data['chunks']) == 0 or any("Error extracting data from image" in chunk for chunk in data['chunks']):
+    if len(data['chunks']) == 0 or has_extraction_error(data['chunks']):
         print(f"File {filename} has no chunks or error extracting data from image")
-        delete_file(filename, headers)
+        delete_file(filename)
         return True
     else:
         print(f"File {filename} has {len(data['chunks'])} chunks")
@@ -61,8 +79,9 @@ def upload_file(
         metadata (Dict): Dictionary containing metadata
         path (str): Destination path for the file
         is_quick_upload (bool): Whether to use quick upload
-        api_url (str): API endpoint URL
-        headers (Optional[Dict]): Additional headers to include in the request
+        api_url (str): API endpoint path (or absolute URL)
+        headers (Optional[Dict]): Additional headers to include in the request,
+            auth headers are added by the shared client
         
     Returns:
         Dict: Response from the server
@@ -94,7 +113,7 @@ def upload_file(
     
     try:
         # Make the POST request with multipart/form-data
-        response = requests.post(
+        response = odin_client.post(
             api_url,
             files=files,
             data=data,
@@ -115,50 +134,141 @@ def upload_file(
         files['file'][1].close()
 
 
-def upload_files():
-    api_url = "http://localhost:8001/v3/project/knowledge/add/file?sync=true"
-    project_id = "89d232ad59764da2b6118e"
-    headers = {"X-API-KEY": X_API_KEY, "X-API-SECRET": X_API_KEY}
+def _process_file(file, dataset_dir, manifest, sync=UPLOAD_SYNC, force=False):
+    """
+    Bring one file up to date with the knowledge base.
+
+    Returns 'unchanged', 'present', 'uploaded' or 'failed', or 'submitted' when
+    an async upload was accepted and the file is now waiting for its chunks.
+    """
+    file_path = os.path.join(dataset_dir, file)
+    digest, stat = manifest.digest(file, file_path)
+    row = manifest.get(file)
+    if force:
+        # Re-queued after a failed extraction, the broken copy is already deleted.
+        pass
+    elif row is not None and row['status'] == 'uploaded':
+        if row['sha256'] == digest:
+            return 'unchanged'
+        # Content changed since it was uploaded, replace the old version.
+        delete_file(file)
+        manifest.reset_attempts(file)
+    elif row is not None and row['status'] == 'processing' and row['sha256'] == digest and not sync:
+        # Submitted by an earlier async run, only its completion is outstanding.
+        return 'submitted'
+    elif not should_upload_file(file):
+        # Unknown to the manifest, or left behind by a crashed run, but already ingested.
+        manifest.mark(file, 'uploaded', digest, stat)
+        return 'present'
 
-    list_of_files = os.listdir("/Users/rohitjindal/del/files/datasets")
-    with open("deleted_files.txt", "r") as f:
-        # Read already uploaded files
-        deleted_files = set()
-        try:
+    manifest.start_attempt(file, digest, stat)
+    status = upload_file(upload_endpoint if sync else async_upload_endpoint, file_path, project_id)
+    if status != 200:
+        manifest.mark(file, 'failed', digest, stat, error=json.dumps(status))
+        return 'failed'
+    if sync:
+        manifest.mark(file, 'uploaded', digest, stat)
+        return 'uploaded'
+    manifest.mark(file, 'processing', digest, stat)
+    return 'submitted'
+
+
+def _check_processing(file, manifest, submitted_at):
+    """
+    Poll an async upload. Returns 'uploaded' once it has chunks, 'requeue' if the
+    extraction failed or timed out (the broken copy is deleted), else 'processing'.
+    """
+    resp = get_chunks_of_file(file)
+    chunks = resp.json()['chunks'] if resp.status_code == 200 else []
+    if has_extraction_error(chunks):
+        print(f"File {file} failed extraction, re-queueing")
+        delete_file(file)
+        return 'requeue'
+    if chunks:
+        manifest.mark(file, 'uploaded')
+        manifest.reset_attempts(file)
+        return 'uploaded'
+    if time.monotonic() - submitted_at > PROCESSING_TIMEOUT:
+        print(f"File {file} still has no chunks after {PROCESSING_TIMEOUT}s, re-queueing")
+        delete_file(file)
+        return 'requeue'
+    return 'processing'
+
+
+def upload_files(dataset_dir=DATASET_DIR, workers=UPLOAD_WORKERS, sync=UPLOAD_SYNC):
+    """
+    Upload every file in `dataset_dir` that the manifest does not already have
+    at its current content hash, using a pool of `workers` threads.
+
+    With `sync=False` uploads return as soon as the server accepts them; the
+    files are then polled in batches of POLL_BATCH for their chunks while the
+    remaining uploads continue, and failed extractions are uploaded again up
+    to MAX_UPLOAD_ATTEMPTS times.
+    """
+    list_of_files = sorted(
+        file for file in os.listdir(dataset_dir) if os.path.isfile(os.path.join(dataset_dir, file))
+    )
+    deleted_files = set()
+    if os.path.exists("deleted_files.txt"):
+        with open("deleted_files.txt", "r") as f:
             deleted_files = set(f.read().splitlines())
-        except:
-            # File is empty or doesn't exist yet
-            pass
-    uploaded_count = 0   
-    with open("uploaded_files.txt", "a") as f:
-        # Open in append mode to add newly uploaded files
+
+    manifest = UploadManifest()
+    counts = Counter()
+    total = len([file for file in list_of_files if file not in deleted_files])
+    # Async uploads waiting for their chunks: file -> (submitted_at, last_polled_at)
+    processing = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {}
         for file in list_of_files:
             if file in deleted_files:
                 print(f"Skipping file: {file} because it is deleted")
                 continue
-            if not should_upload_file(file, headers):
-                print(f"Skipping file: {file}")
-                continue
+            futures[executor.submit(_process_file, file, dataset_dir, manifest, sync)] = ('upload', file)
 
-            uploaded_count += 1
-            print(f"Uploading count: {uploaded_count}")
-            file_path = os.path.join("/Users/rohitjindal/del/files/datasets", file)
-            if upload_file(
-                api_url,
-                file_path,
-                project_id,
-                headers= headers
-            ) == 200:   
-                print(f"Uploaded file: {file}")
-                f.write(file + "\n")
+        while futures or processing:
+            if futures:
+                done, _ = wait(futures, timeout=POLL_INTERVAL, return_when=FIRST_COMPLETED)
             else:
-                print(f"Failed to upload file: {file}")
-            time.sleep(1)  # Reduced sleep time to 2 seconds
-
+                done = set()
+                time.sleep(POLL_INTERVAL)
 
+            now = time.monotonic()
+            for future in done:
+                kind, file = futures.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    print(f"Error processing file: {file}: {e}")
+                    result = 'failed'
 
+                if result == 'processing':
+                    processing[file] = (processing[file][0], now)
+                    continue
+                processing.pop(file, None)
+                if result == 'submitted':
+                    processing[file] = (now, now)
+                    continue
+                if result == 'requeue':
+                    if manifest.get(file)['attempts'] < MAX_UPLOAD_ATTEMPTS:
+                        futures[executor.submit(_process_file, file, dataset_dir, manifest, sync, True)] = ('upload', file)
+                        continue
+                    manifest.mark(file, 'failed', error="extraction failed")
+                    result = 'failed'
+                counts[result] += 1
+                print(f"[{sum(counts.values())}/{total}] {result}: {file}")
 
+            # Poll the files that have waited longest, one batch at a time.
+            polling = {file for kind, file in futures.values() if kind == 'poll'}
+            due = sorted(
+                (last, file) for file, (_, last) in processing.items()
+                if file not in polling and now - last >= POLL_INTERVAL
+            )
+            for _, file in due[:max(0, POLL_BATCH - len(polling))]:
+                futures[executor.submit(_check_processing, file, manifest, processing[file][0])] = ('poll', file)
+    manifest.close()
+    print("Upload summary:", dict(counts))
 
 
 if __name__ == "__main__":
-    upload_files()
\ No newline at end of file
+    upload_files()